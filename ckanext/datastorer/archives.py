@@ -0,0 +1,332 @@
+'''
+Reading of compressed files and of the files in zip archives.
+
+Files compressed with gzip, bzip2 or xz (which needs the lzma module, from
+backports.lzma on Python 2) are decompressed as they are read, and the
+CSV, TSV and Excel files of a zip archive are read from the archive, so
+that they are never inflated on disk. Compression is detected from the
+first bytes of the file, which must be seekable (downloaded files are).
+
+The tables of a zip archive are named after the files they come from, and
+are selected and loaded like the sheets of a workbook (see ``sheets``): a
+CSV or TSV file is one table, named after its path in the archive, and
+each sheet of an Excel file a table named "<path>/<sheet>".
+'''
+import bz2
+import posixpath
+import zipfile
+import zlib
+
+from messytables import XLSTableSet, XLSXTableSet, any_tableset
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from delimited import csv_table_set
+import sheets
+
+
+# Formats of compressed files and archives, which are never parsed as they
+# are downloaded
+COMPRESSED_FORMATS = [
+    'gz',
+    'gzip',
+    'bz2',
+    'xz',
+    'zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/zip',
+    'application/x-zip-compressed',
+]
+
+# The first bytes of the files of each compression
+SIGNATURES = [
+    ('gzip', '\x1f\x8b'),
+    ('bz2', 'BZh'),
+    ('xz', '\xfd7zXZ\x00'),
+    ('zip', 'PK\x03\x04'),
+]
+
+# The formats of CSV and TSV files, as in any_tableset
+CSV_FORMATS = ['csv', 'text/csv', 'text/comma-separated-values']
+TSV_FORMATS = ['tsv', 'text/tsv', 'text/tab-separated-values']
+
+# The extensions of the files with tables in them
+TABLE_EXTENSIONS = ['csv', 'tsv', 'txt', 'xls', 'xlsx']
+
+WORKBOOK_EXTENSIONS = ['xls', 'xlsx']
+
+
+def is_compressed(resource, content_type):
+    '''Whether the resource is known to be compressed before downloading
+    it.'''
+    extension = resource.get('format', '').lower().rsplit('.', 1)[-1]
+    return (content_type in COMPRESSED_FORMATS or
+            extension in COMPRESSED_FORMATS)
+
+
+def detect(f):
+    '''Returns the compression of the file ("gzip", "bz2" or "xz"), "zip"
+    if it is a zip archive, or None. The file is read again from the
+    start.'''
+    head = f.read(6)
+    f.seek(0)
+    for compression, signature in SIGNATURES:
+        if head.startswith(signature):
+            break
+    else:
+        return None
+    if compression == 'zip':
+        # Office Open XML files (e.g. xlsx) are zip archives too
+        try:
+            names = zipfile.ZipFile(f).namelist()
+        except zipfile.BadZipfile:
+            return None
+        finally:
+            f.seek(0)
+        if '[Content_Types].xml' in names:
+            return None
+    return compression
+
+
+def is_archive(f):
+    '''Whether the file is a zip archive (of tables).'''
+    return detect(f) == 'zip'
+
+
+def open_tables(f, content_type, extension, csv_engine='messytables'):
+    '''Returns the table set of the file: a ZipArchive for a zip archive,
+    otherwise the messytables table set of the file, decompressed if
+    needed.
+
+    CSV and TSV files are read by the given ``csv_engine`` (see
+    ``delimited``). Files that can't seek (e.g. streamed downloads) are
+    never compressed, as compressed files are not streamed.
+    '''
+    extension = extension.lower()
+    compression = detect(f) if hasattr(f, 'seek') else None
+    if compression == 'zip':
+        return ZipArchive(f, csv_engine)
+    if compression is None:
+        if content_type in CSV_FORMATS or extension in CSV_FORMATS:
+            return _table_set(f, 'csv', csv_engine=csv_engine)
+        if content_type in TSV_FORMATS or extension in TSV_FORMATS:
+            return _table_set(f, 'tsv', csv_engine=csv_engine)
+        return any_tableset(f, mimetype=content_type, extension=extension)
+    f = DecompressingFile(f, compression)
+    # the format of a compressed file is e.g. "csv.gz", or just "gz"
+    extension = extension.rsplit('.', 1)[0]
+    if extension not in TABLE_EXTENSIONS:
+        extension = _sniff_extension(f)
+    return _table_set(f, extension, csv_engine=csv_engine)
+
+
+def open_table(f, content_type, extension, name=None,
+               csv_engine='messytables'):
+    '''Returns the row set of the named table (or sheet) of the file, or of
+    its first one.'''
+    table_set = open_tables(f, content_type, extension, csv_engine)
+    if isinstance(table_set, ZipArchive):
+        return table_set.table(name)
+    return sheets.find_table(table_set, name)
+
+
+def table_names(f, content_type, extension):
+    '''Returns the names of the tables (or sheets) of the file. The file is
+    read again from the start.'''
+    table_set = open_tables(f, content_type, extension)
+    if isinstance(table_set, ZipArchive):
+        names = table_set.names()
+    else:
+        names = [table.name for table in table_set.tables]
+    f.seek(0)
+    return names
+
+
+def _sniff_extension(f):
+    head = f.read(8)
+    f.seek(0)
+    if head.startswith('\xd0\xcf\x11\xe0'):
+        return 'xls'
+    if head.startswith('PK\x03\x04'):
+        return 'xlsx'
+    return 'csv'
+
+
+def _table_set(fileobj, extension, name=None, csv_engine='messytables'):
+    # the workbooks are read into memory by messytables
+    if extension == 'xls':
+        return XLSTableSet(fileobj)
+    if extension == 'xlsx':
+        return XLSXTableSet(fileobj)
+    delimiter = '\t' if extension == 'tsv' else None
+    return csv_table_set(fileobj, delimiter=delimiter, name=name,
+                         engine=csv_engine)
+
+
+def _decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    if lzma is None:
+        raise ValueError('Reading xz files needs the backports.lzma '
+                         'package')
+    return lzma.LZMADecompressor()
+
+
+class DecompressingFile(object):
+    '''
+    Reads the decompressed content of a compressed file, decompressing it
+    as it is read.
+
+    Files made of several compressed streams (e.g. by pigz or pbzip2) are
+    read as a whole. The only seek supported is back to the start, which
+    decompresses the file again from its start.
+    '''
+
+    def __init__(self, fileobj, compression, chunk_size=1024 * 64):
+        self.fileobj = fileobj
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self._start = fileobj.tell()
+        self.seek(0)
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise IOError('A compressed file can only be read again from '
+                          'the start')
+        self.fileobj.seek(self._start)
+        self._decompressor = _decompressor(self.compression)
+        self._buffer = ''
+        self._eof = False
+        self._position = 0
+
+    def tell(self):
+        return self._position
+
+    def _decompress(self, data):
+        chunks = []
+        while data:
+            try:
+                chunks.append(self._decompressor.decompress(data))
+            except EOFError:
+                # the previous stream ended at the end of the last chunk
+                self._decompressor = _decompressor(self.compression)
+                continue
+            data = self._decompressor.unused_data
+            if data:
+                # another stream follows
+                self._decompressor = _decompressor(self.compression)
+        return ''.join(chunks)
+
+    def _fill(self, size):
+        # decompresses until the buffer holds size bytes or a line
+        while not self._eof and (len(self._buffer) < size if size >= 0
+                                 else '\n' not in self._buffer):
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                self._eof = True
+            else:
+                self._buffer += self._decompress(data)
+
+    def _take(self, size):
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._position += len(data)
+        return data
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self._take(len(self._buffer))]
+            while not self._eof:
+                self._fill(self.chunk_size)
+                chunks.append(self._take(len(self._buffer)))
+            return ''.join(chunks)
+        self._fill(size)
+        return self._take(size)
+
+    def readline(self):
+        self._fill(-1)
+        end = self._buffer.find('\n') + 1
+        return self._take(end or len(self._buffer))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.fileobj.close()
+
+
+def _member_name(info):
+    name = info.filename
+    if not isinstance(name, unicode):
+        # names not flagged as UTF-8 are in the DOS code page
+        name = name.decode('cp437')
+    return name
+
+
+class ZipArchive(object):
+    '''
+    The tables of the CSV, TSV and Excel files in a zip archive.
+
+    Only the files of the tables asked for are read, one at a time, as the
+    files of an archive can't be read concurrently from the same file
+    object.
+    '''
+
+    def __init__(self, fileobj, csv_engine='messytables'):
+        self.zip_file = zipfile.ZipFile(fileobj)
+        self.csv_engine = csv_engine
+
+    def members(self):
+        '''Returns the (info, extension) tuples of the files with tables
+        in them.'''
+        members = []
+        for info in self.zip_file.infolist():
+            name = _member_name(info)
+            extension = posixpath.splitext(name)[1][1:].lower()
+            if (extension in TABLE_EXTENSIONS and
+                    not posixpath.basename(name).startswith('.') and
+                    not name.startswith('__MACOSX/')):
+                members.append((info, extension))
+        return members
+
+    def _open(self, info, extension):
+        return _table_set(self.zip_file.open(info), extension,
+                          _member_name(info), self.csv_engine)
+
+    def names(self):
+        names = []
+        for info, extension in self.members():
+            if extension in WORKBOOK_EXTENSIONS:
+                names.extend(u'{0}/{1}'.format(_member_name(info), table.name)
+                             for table in self._open(info, extension).tables)
+            else:
+                names.append(_member_name(info))
+        return names
+
+    def table(self, name=None):
+        '''Returns the row set of the named table, or of the first one.'''
+        for info, extension in self.members():
+            member_name = _member_name(info)
+            if extension in WORKBOOK_EXTENSIONS:
+                if name is None:
+                    return sheets.find_table(self._open(info, extension))
+                if name.startswith(member_name + u'/'):
+                    return sheets.find_table(self._open(info, extension),
+                                             name[len(member_name) + 1:])
+            elif name is None or name == member_name:
+                return self._open(info, extension).tables[0]
+        if name is None:
+            raise ValueError('The zip archive has no CSV, TSV or Excel '
+                             'files.')
+        raise ValueError(u'File not found in the zip archive: {0}'.format(
+            name))
@@ -0,0 +1,66 @@
+import itertools
+import threading
+
+
+class AdaptiveBatcher(object):
+    '''Splits rows into batches for datastore_create.
+
+    The number of rows per batch starts at ``initial_rows`` and is then
+    adjusted after every acknowledged batch (see ``record``), so that a
+    batch is about ``target_bytes`` of JSON and is processed by the server
+    in about ``target_seconds``, whichever is smaller. It always stays
+    between ``min_rows`` and ``max_rows``.
+
+    ``record`` may be called from several threads.
+    '''
+
+    # weight of the latest measurement in the running averages
+    SMOOTHING = 0.5
+    # never grow the batches by more than this factor at once
+    MAX_GROWTH = 2.0
+
+    def __init__(self, target_bytes=4 * 1024 * 1024, target_seconds=5.0,
+                 min_rows=10, max_rows=10000, initial_rows=100):
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self.min_rows = min_rows
+        self.max_rows = max(max_rows, min_rows)
+        self.rows = self._clamp(initial_rows)
+        self.bytes_per_row = None
+        self.rows_per_second = None
+        self._lock = threading.Lock()
+
+    def _clamp(self, rows):
+        return int(max(self.min_rows, min(self.max_rows, rows)))
+
+    def _average(self, current, measured):
+        if current is None:
+            return measured
+        return self.SMOOTHING * measured + (1 - self.SMOOTHING) * current
+
+    def batches(self, rows):
+        '''Yields lists of rows from the given iterable.'''
+        it = iter(rows)
+        while True:
+            batch = list(itertools.islice(it, self.rows))
+            if not batch:
+                return
+            yield batch
+
+    def record(self, rows, size, seconds):
+        '''Updates the batch size from a batch of ``rows`` rows that was
+        ``size`` bytes long and took ``seconds`` to be sent.'''
+        if not rows:
+            return
+        with self._lock:
+            self.bytes_per_row = self._average(self.bytes_per_row,
+                                               float(size) / rows)
+            if seconds > 0:
+                self.rows_per_second = self._average(self.rows_per_second,
+                                                     rows / float(seconds))
+
+            wanted = self.target_bytes / max(self.bytes_per_row, 1.0)
+            if self.rows_per_second and self.target_seconds:
+                wanted = min(wanted,
+                             self.rows_per_second * self.target_seconds)
+            self.rows = self._clamp(min(wanted, self.rows * self.MAX_GROWTH))
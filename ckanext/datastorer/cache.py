@@ -0,0 +1,136 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+def get_cache(cache_dir, name):
+    '''Returns the cache with the given name, under the configured
+    ckanext-datastorer.cache_dir (the system temporary directory by
+    default).'''
+    if not cache_dir:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'ckanext-datastorer')
+    return FileCache(os.path.join(cache_dir, name))
+
+
+class FileCache(object):
+    '''
+    Stores JSON documents on disk, one file per key.
+
+    Writes are atomic, so several workers can share the same directory
+    (e.g. on a network volume) and readers never see a partial document.
+    Any key can be used: keys that are not safe file names are hashed.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key, extension='.json'):
+        if not key.replace('-', '').replace('_', '').isalnum():
+            key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + extension)
+
+    def get(self, key, default=None):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return default
+
+    def _make_directory(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another worker in the meantime
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def set(self, key, value):
+        self._make_directory()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(value, f)
+            os.rename(tmp_path, self.path(key))
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def touch(self, key, extension='.json'):
+        '''Marks the file of the key as just used, see ``prune``.'''
+        try:
+            os.utime(self.path(key, extension), None)
+        except OSError:
+            pass
+
+    def prune(self, max_size=None, max_age=None):
+        '''Deletes the files of the keys not used (set or touched) for more
+        than ``max_age`` seconds, then those of the least recently used keys
+        until the cache takes at most ``max_size`` bytes. The files of a key
+        (e.g. "<key>.json" and "<key>.rows.gz") are deleted together.
+
+        Returns the number of keys deleted.
+        '''
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+        keys = {}
+        for name in names:
+            key, dot, extension = name.partition('.')
+            # skips locks and the files still being written
+            if not dot or extension == 'lock':
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # deleted by another worker in the meantime
+                continue
+            size, used, paths = keys.get(key, (0, 0, []))
+            keys[key] = (size + stat.st_size, max(used, stat.st_mtime),
+                         paths + [path])
+
+        total = sum(size for size, used, paths in keys.itervalues())
+        oldest = time.time() - max_age if max_age else None
+        deleted = 0
+        for size, used, paths in sorted(keys.itervalues(),
+                                        key=lambda entry: entry[1]):
+            if not ((oldest is not None and used < oldest) or
+                    (max_size and total > max_size)):
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            deleted += 1
+        return deleted
+
+    def lock(self, key):
+        '''Takes the exclusive lock named by the key, without waiting.
+
+        Returns the lock file, which holds the lock until it is closed, or
+        None if another process holds the lock.
+        '''
+        self._make_directory()
+        f = open(self.path(key, '.lock'), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            f.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return f
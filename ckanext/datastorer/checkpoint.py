@@ -0,0 +1,82 @@
+'''
+Checkpoints of the rows of a resource committed to the datastore, so that a
+load that failed halfway can be resumed where it stopped, instead of
+deleting the table and sending all the rows again, as long as the content
+of the resource didn't change.
+'''
+import bisect
+import hashlib
+import threading
+
+
+def file_hash(f, chunk_size=1024 * 64):
+    '''Returns the SHA1 hash of the content of the file, which is then read
+    again from the start.'''
+    content_hash = hashlib.sha1()
+    for chunk in iter(lambda: f.read(chunk_size), ''):
+        content_hash.update(chunk)
+    f.seek(0)
+    return unicode(content_hash.hexdigest())
+
+
+def merge_ranges(ranges):
+    '''Merges the overlapping and adjacent [start, end) ranges.'''
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class Checkpoint(object):
+    '''The ranges of the rows of a resource, by index, that were committed
+    to its datastore table. It is saved after each commit.'''
+
+    def __init__(self, cache, resource_id, content_hash, fields,
+                 ranges=None):
+        self.cache = cache
+        self.resource_id = resource_id
+        self.content_hash = content_hash
+        self.fields = fields
+        self.ranges = ranges or []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, cache, resource_id, content_hash, fields):
+        '''Returns the checkpoint of the previous load of the resource if it
+        had the same content and fields, otherwise a new checkpoint.'''
+        state = cache.get(resource_id)
+        if (state and state['hash'] == content_hash and
+                state['fields'] == fields):
+            return cls(cache, resource_id, content_hash, fields,
+                       state['ranges'])
+        return cls(cache, resource_id, content_hash, fields)
+
+    @property
+    def committed_rows(self):
+        return sum(end - start for start, end in self.ranges)
+
+    def is_committed(self, index):
+        i = bisect.bisect_right(self.ranges, [index, float('inf')]) - 1
+        return i >= 0 and self.ranges[i][0] <= index < self.ranges[i][1]
+
+    def pending(self, indexed_rows):
+        '''Filters out the committed ones from the (index, row) tuples.'''
+        for index, row in indexed_rows:
+            if not self.is_committed(index):
+                yield index, row
+
+    def commit(self, indexes):
+        '''Records that the rows with these indexes were committed.'''
+        ranges = merge_ranges([index, index + 1] for index in indexes)
+        with self._lock:
+            self.ranges = merge_ranges(self.ranges + ranges)
+            self.cache.set(self.resource_id, {'hash': self.content_hash,
+                                              'fields': self.fields,
+                                              'ranges': self.ranges})
+
+    def delete(self):
+        '''Forgets the checkpoint, once the load is complete.'''
+        self.cache.delete(self.resource_id)
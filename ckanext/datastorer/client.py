@@ -0,0 +1,56 @@
+import json
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CkanClient(object):
+    '''
+    Calls the CKAN action API over a pool of keep-alive connections, so
+    that consecutive requests don't each pay for a new TCP (and TLS)
+    handshake.
+
+    Sessions are safe to share between the threads of a worker, as long as
+    the pool is big enough for all of them.
+    '''
+
+    def __init__(self, site_url, apikey=None, pool_size=10):
+        self.api_url = site_url.rstrip('/') + '/api/action/'
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        if apikey:
+            self.session.headers['Authorization'] = str(apikey)
+
+    def url(self, action):
+        return self.api_url + action
+
+    def post(self, action, data, **kwargs):
+        '''Posts ``data`` (a dict or an already encoded JSON string) to the
+        given action and returns the response.'''
+        if not isinstance(data, basestring):
+            data = json.dumps(data)
+        return self.session.post(self.url(action), data=data, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(site_url, apikey=None, pool_size=10):
+    '''Returns the client of the current process for the given site and
+    API key, creating it the first time.
+
+    Clients are not shared with forked processes (e.g. celery workers), as
+    their connections would be.
+    '''
+    key = (os.getpid(), site_url.rstrip('/'), apikey)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = CkanClient(site_url, apikey, int(pool_size))
+        return _clients[key]
@@ -1,21 +1,28 @@
 import sys
 from datetime import datetime
-import itertools
 import json
-import messytables
-from messytables import (any_tableset, types_processor, headers_guess,
-                         headers_processor, type_guess, offset_processor)
+import multiprocessing
 import os
-import requests
-import urlparse
+import signal
+import time
 from pylons import config
+from paste.deploy.converters import asbool
 from ckan.lib.cli import CkanCommand
 from ckan.logic import get_action
 from ckan import model
-from ckan.model.types import make_uuid
 import ckan.plugins.toolkit as toolkit
-from common import DATA_FORMATS, TYPE_MAPPING
+from common import DATA_FORMATS, TYPE_MAPPING, get_settings
 import fetch_resource
+from client import get_client
+from batching import AdaptiveBatcher
+from cache import get_cache
+from checkpoint import Checkpoint, file_hash
+import delta
+import sheets
+import archives
+import scheduling
+from metrics import UploadMetrics, get_sink
+from parsing import parse_resource
 import logging
 
 
@@ -46,14 +53,11 @@ class Datastorer(CkanCommand):
     max_args = 2
     MAX_PER_PAGE = 50
 
-    def _get_all_packages(self, api_url, headers):
+    def _get_all_packages(self, client):
         page = 1
         while True:
-            response = requests.post(api_url +
-                                     '/current_package_list_with_resources',
-                                     '{"page": %d, "limit": %d}' %
-                                     (page, self.MAX_PER_PAGE),
-                                     headers=headers)
+            response = client.post('current_package_list_with_resources',
+                                   {'page': page, 'limit': self.MAX_PER_PAGE})
             packages = json.loads(response.content).get('result')
             if not packages:
                 raise StopIteration
@@ -72,7 +76,6 @@ class Datastorer(CkanCommand):
         cmd = self.args[0]
         self._load_config()
         #import after load config so CKAN_CONFIG evironment variable can be set
-        from ckan.lib.celery_app import celery
         import tasks
         user = get_action('get_site_user')({'model': model,
                                             'ignore_auth': True}, {})
@@ -83,18 +86,15 @@ class Datastorer(CkanCommand):
             'username': user.get('name'),
             'webstore_url': config.get('ckan.webstore_url')
         }
+        context.update(get_settings(config))
         if not config['ckan.site_url']:
             raise Exception('You have to set the "ckan.site_url" property in your ini file.')
-        api_url = urlparse.urljoin(config['ckan.site_url'], 'api/action')
+        client = get_client(config['ckan.site_url'], user.get('apikey'),
+                            context['http_pool_size'])
 
         if cmd in ('update', 'queue'):
-            headers = {
-                'content-type:': 'application/json'
-            }
             if len(self.args) == 2:
-                response = requests.post(api_url +
-                                         '/package_show',
-                                         json.dumps({"id": self.args[1]}), headers=headers)
+                response = client.post('package_show', {'id': self.args[1]})
                 if response.status_code == 200:
                     packages = [json.loads(response.content).get('result')]
                 elif response.status_code == 404:
@@ -104,15 +104,17 @@ class Datastorer(CkanCommand):
                     logger.error('Error getting dataset %s' % self.args[1])
                     sys.exit(1)
             else:
-                packages = self._get_all_packages(api_url, headers)
+                packages = self._get_all_packages(client)
 
             for package in packages:
                 for resource in package.get('resources', []):
-                    data = json.dumps(resource, {'model': model})
-
                     # skip update if the datastore is already active (a table exists)
                     if resource.get('datastore_active'):
                         continue
+                    # staging and sheet resources are loaded by the task
+                    # that created them
+                    if sheets.is_derived(resource):
+                        continue
                     mimetype = resource['mimetype']
                     if mimetype and not(mimetype in tasks.DATA_FORMATS or
                                         resource['format'].lower() in
@@ -128,27 +130,22 @@ class Datastorer(CkanCommand):
 
                     if cmd == "update":
                         logger.setLevel(0)
-                        tasks._datastorer_upload(context, resource, logger)
+                        metrics = UploadMetrics(resource['id'])
+                        try:
+                            tasks._datastorer_upload(context, resource,
+                                                     logger, metrics)
+                        finally:
+                            tasks._record_metrics(context, metrics, logger)
                     elif cmd == "queue":
-                        task_id = make_uuid()
-                        datastorer_task_status = {
-                            'entity_id': resource['id'],
-                            'entity_type': u'resource',
-                            'task_type': u'datastorer',
-                            'key': u'celery_task_id',
-                            'value': task_id,
-                            'last_updated': datetime.now().isoformat()
-                        }
                         datastorer_task_context = {
                             'model': model,
                             'user': user.get('name')
                         }
-
-                        get_action('task_status_update')(datastorer_task_context,
-                                                         datastorer_task_status)
-                        celery.send_task("datastorer.upload",
-                                     args=[json.dumps(context), data],
-                                     task_id=task_id)
+                        scheduling.queue_upload(
+                            context, resource,
+                            lambda status: get_action('task_status_update')(
+                                datastorer_task_context, status),
+                            scheduling.BULK)
         else:
             logger.error('Command %s not recognized' % (cmd,))
 
@@ -161,7 +158,9 @@ class AddToDataStore(CkanCommand):
     Usage:
 
     paster datastore_upload [package-id] -i/--ignore [package-id]
-            - Update all resources.
+                            [--workers N] [--timeout SECONDS]
+            - Update all resources, in N worker processes if given, giving
+              up on a resource after SECONDS.
     """
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -176,6 +175,12 @@ class AddToDataStore(CkanCommand):
     CkanCommand.parser.add_option('--no-hash', dest="force",
                                   action="store_true",
                                   help="Do not check hashes")
+    CkanCommand.parser.add_option('--workers', dest="workers", type="int",
+                                  default=1,
+                                  help="Number of worker processes")
+    CkanCommand.parser.add_option('--timeout', dest="timeout", type="int",
+                                  help="Seconds after which to give up on "
+                                       "a resource")
 
     def _get_all_packages(self):
         page = 1
@@ -205,6 +210,19 @@ class AddToDataStore(CkanCommand):
 
         self._load_config()
         config['ckan.activity_streams_enabled'] = False
+
+        # don't let a run overlap the previous one, e.g. from cron
+        lock = get_cache(get_settings(config)['cache_dir'],
+                         'locks').lock('datastore_upload')
+        if lock is None:
+            logger.warning('Another datastore_upload is running, exiting.')
+            return
+        try:
+            self._push_all()
+        finally:
+            lock.close()
+
+    def _push_all(self):
         user = toolkit.get_action('get_site_user')({'model': model,
                                                     'ignore_auth': True}, {})
         context = {'username': user.get('name'),
@@ -223,9 +241,27 @@ class AddToDataStore(CkanCommand):
         else:
             packages = self._get_all_packages()
 
+        resources = self._resources_to_push(packages)
+        if self.options.workers > 1:
+            statuses = self._push_in_workers(context, list(resources),
+                                             self.options.workers)
+        else:
+            statuses = (_push_with_timeout(self, context, resource,
+                                           self.options.timeout)
+                        for resource in resources)
+
         resource_status = []
+        for status in statuses:
+            resource_status.extend(status.pop('sheets', []))
+            if status['success'] is False:
+                resource_status.append(status)
+        print resource_status
+
+    def _resources_to_push(self, packages):
         for package in packages:
             for resource in package.get('resources', []):
+                if sheets.is_derived(resource):
+                    continue
                 mimetype = resource['mimetype']
                 if mimetype and not(mimetype in DATA_FORMATS or
                                     resource['format'].lower()
@@ -244,12 +280,29 @@ class AddToDataStore(CkanCommand):
                 logger.info(u'Datastore resource from resource {0} from '
                     u'package {0}'.format(resource['url'],
                                          package['name']))
-                status = self.push_to_datastore(context, resource)
-                if status['success'] is False:
-                    resource_status.append(status)
-        print resource_status
+                yield resource
 
     def push_to_datastore(self, context, resource):
+        """
+        Pushes the resource to the datastore and returns its status, with
+        the summary of the metrics of the upload, which is also logged and
+        kept in the "upload_metrics" task status of the resource.
+        """
+        metrics = UploadMetrics(resource['id'])
+        try:
+            status = self._push_to_datastore(context, resource, metrics)
+        finally:
+            summary = metrics.emit(logger, get_sink(get_settings(config)))
+        try:
+            toolkit.get_action('task_status_update')(
+                context, scheduling.metrics_status(resource['id'], summary))
+        except Exception as e:
+            logger.warning('Could not save the upload metrics of {0}: '
+                           '{1}'.format(resource['id'], e))
+        status['metrics'] = summary
+        return status
+
+    def _push_to_datastore(self, context, resource, metrics):
 
         # Get the resource's content hash, which is used to check whether the
         # resource file has changed since last time.
@@ -262,12 +315,25 @@ class AddToDataStore(CkanCommand):
             original_content_hash = ''
             check_hash = False
 
+        # remember the validators of the downloads to make conditional
+        # requests next time
+        settings = get_settings(config)
+        validators = None
+        if asbool(settings['conditional_get']):
+            validators = get_cache(settings['cache_dir'], 'validators')
+        # keep interrupted downloads to resume them next time
+        partials = None
+        if asbool(settings['resume_downloads']):
+            partials = get_cache(settings['cache_dir'], 'partials')
+
         try:
-            result = fetch_resource.download(context,
-                                             resource,
-                                             self.max_content_length,
-                                             DATA_FORMATS,
-                                             check_modified=check_hash)
+            with metrics.stage('download'):
+                result = fetch_resource.download(
+                    context, resource, self.max_content_length, DATA_FORMATS,
+                    check_modified=check_hash, validators=validators,
+                    head_request=asbool(settings['head_request']),
+                    partials=partials, metrics=metrics)
+            metrics.count('bytes_downloaded', result['length'])
         except fetch_resource.ResourceNotModified as e:
             logger.info(
                 u'Skipping unmodified resource: {0}'.format(resource['url'])
@@ -293,16 +359,50 @@ class AddToDataStore(CkanCommand):
         content_type = result['headers'].get('content-type', '')\
                                         .split(';', 1)[0]  # remove parameters
 
+        # the other sheets of a workbook (or tables of an archive) are
+        # loaded by worker processes
+        sheet = resource.get('datastorer_sheet')
+        workers = None
+        with open(result['saved_file'], 'rb') as f:
+            archive = archives.is_archive(f)
+        if not sheet and (archive or
+                          sheets.is_spreadsheet(resource, content_type)):
+            try:
+                sheet, workers = self._push_sheets(
+                    context, resource, result['saved_file'], content_type,
+                    archive)
+            except Exception as e:
+                logger.exception(e)
+                os.remove(result['saved_file'])
+                return {'success': False,
+                        'resource': resource['id'],
+                        'error': 'Error loading the sheets'}
+
+        status = self._push_file(context, resource, result, content_type,
+                                 sheet, metrics)
+        if workers is not None:
+            status['sheets'] = [sheet_status for sheet_status in workers
+                                if sheet_status['success'] is False]
+        return status
+
+    def _push_file(self, context, resource, result, content_type, sheet,
+                   metrics):
+        settings = get_settings(config)
         f = open(result['saved_file'], 'rb')
+
+        # a load of the same content that failed can be resumed, and
+        # content that was parsed before doesn't need to be parsed again
+        content_hash = None
+        if (asbool(settings['resume_uploads']) or
+                asbool(settings['content_cache'])):
+            content_hash = file_hash(f)
+
         try:
-            table_sets = any_tableset(
-                f,
-                mimetype=content_type,
-                extension=resource['format'].lower()
-            )
-            # only first sheet in xls for time being
-            row_set = table_sets.tables[0]
-            offset, headers = headers_guess(row_set.sample)
+            with metrics.stage('guess_types'):
+                rows, converter = parse_resource(settings, f, content_type,
+                                                 resource, logger, sheet,
+                                                 content_hash)
+            rows = metrics.timed(rows)
         except Exception as e:
             logger.exception(e)
             os.remove(result['saved_file'])
@@ -310,44 +410,144 @@ class AddToDataStore(CkanCommand):
                     'resource': resource['id'],
                     'error': 'Error parsing the resource'}
 
-        row_set.register_processor(headers_processor(headers))
-        row_set.register_processor(offset_processor(offset + 1))
-        row_set.register_processor(datetime_procesor())
-
-        logger.info('Header offset: {0}.'.format(offset))
-
-        guessed_types = type_guess(
-            row_set.sample,
-            [
-                messytables.types.StringType,
-                messytables.types.IntegerType,
-                messytables.types.FloatType,
-                messytables.types.DecimalType,
-                messytables.types.DateUtilType
-            ],
-            strict=True
-        )
-        logger.info('Guessed types: {0}'.format(guessed_types))
-        row_set.register_processor(types_processor(guessed_types, strict=True))
-        row_set.register_processor(stringify_processor())
-
         guessed_type_names = [TYPE_MAPPING[type(gt)] for gt in
-                              guessed_types]
+                              converter.types]
+        fields = [dict(id=name, type=typename) for name, typename
+                  in zip(converter.headers, guessed_type_names)]
+        primary_key = delta.primary_key(resource)
+
+        batcher = AdaptiveBatcher(
+            target_bytes=int(settings['batch_target_bytes']),
+            target_seconds=float(settings['batch_target_seconds']),
+            min_rows=int(settings['batch_min_rows']),
+            max_rows=int(settings['batch_max_rows']))
 
         def send_request(data):
+            data = converter.dicts(data)
             data_dict = {
                 'resource_id': resource['id'],
-                'fields': [dict(id=name, type=typename) for name, typename
-                           in zip(headers, guessed_type_names)],
+                'fields': fields,
                 'records': data,
                 'force': True,
             }
+            if primary_key:
+                data_dict['primary_key'] = primary_key
+            start = time.time()
             response = toolkit.get_action('datastore_create')(
                 context,
                 data_dict
             )
+            # the action is called directly, so measure the size the
+            # records would have over the API
+            seconds = time.time() - start
+            batcher.record(len(data), len(json.dumps(data)), seconds)
+            metrics.record_batch(len(data), seconds)
             return response
 
+        # Only load the rows that changed since the previous load, if
+        # possible
+        fingerprints_cache = None
+        fingerprints = None
+        if asbool(settings['incremental']):
+            fingerprints_cache = get_cache(settings['cache_dir'],
+                                           'fingerprints')
+            previous = delta.Fingerprints.load(fingerprints_cache,
+                                               resource['id'])
+            if previous and previous.matches(fields, primary_key):
+                logger.info('Comparing with the previous load.')
+                try:
+                    with metrics.stage('compare'):
+                        fingerprints, changes = delta.compare(previous,
+                                                              rows)
+                    try:
+                        if not changes.needs_reload:
+                            with metrics.stage('upload'):
+                                self._apply_delta(context, resource,
+                                                  converter, changes,
+                                                  batcher, metrics)
+                            fingerprints.save(fingerprints_cache,
+                                              resource['id'])
+                            return self._mark_active(context, resource,
+                                                     result['saved_file'])
+                    finally:
+                        changes.close()
+                    logger.info('{0} rows were changed or removed, loading '
+                                'all rows.'.format(changes.removed))
+                    f.seek(0)
+                    with metrics.stage('guess_types'):
+                        rows, converter = parse_resource(
+                            settings, f, content_type, resource, logger,
+                            sheet, content_hash)
+                    rows = metrics.timed(rows)
+                except Exception as e:
+                    logger.exception(e)
+                    fingerprints_cache.delete(resource['id'])
+                    os.remove(result['saved_file'])
+                    return {'success': False,
+                            'resource': resource['id'],
+                            'error': 'Error pushing data to datastore'}
+            else:
+                logger.info('No comparable previous load, loading all rows.')
+
+        checkpoint = None
+        if content_hash and asbool(settings['resume_uploads']):
+            checkpoint = Checkpoint.load(
+                get_cache(settings['cache_dir'], 'checkpoints'),
+                resource['id'], content_hash, fields)
+
+        if checkpoint and checkpoint.ranges:
+            logger.info('Resuming the previous load, {0} rows were already '
+                        'committed.'.format(checkpoint.committed_rows))
+        else:
+            self._delete_datastore(context, resource)
+
+        logger.info('Creating: {0}.'.format(resource['id']))
+
+        # record the fingerprints of the rows for the next incremental load,
+        # unless they were already computed while comparing
+        if fingerprints_cache is not None and fingerprints is None:
+            fingerprints = delta.Fingerprints(fields, primary_key)
+            rows = fingerprints.record(rows)
+
+        count = [0]
+
+        def indexed_rows():
+            for index, row in enumerate(rows):
+                count[0] = index + 1
+                yield index, row
+
+        pending = indexed_rows()
+        if checkpoint:
+            pending = checkpoint.pending(pending)
+
+        try:
+            # the batch size follows the payload size and response times
+            with metrics.stage('upload'):
+                for batch in batcher.batches(pending):
+                    send_request([row for index, row in batch])
+                    if checkpoint:
+                        checkpoint.commit(index for index, row in batch)
+        except Exception as e:
+            logger.exception(e)
+            os.remove(result['saved_file'])
+            return {'success': False,
+                    'resource': resource['id'],
+                    'error': 'Error pushing data to datastore'}
+
+        logger.info("There should be {n} entries in {res_id}.".format(
+            n=count[0],
+            res_id=resource['id']
+        ))
+
+        if checkpoint:
+            checkpoint.delete()
+
+        if fingerprints is not None:
+            fingerprints.save(fingerprints_cache, resource['id'])
+
+        return self._mark_active(context, resource, result['saved_file'])
+
+    def _delete_datastore(self, context, resource):
         # Delete any existing data before proceeding. Otherwise
         # 'datastore_create' will append to the existing datastore. And if the
         # fields have significantly changed, it may also fail.
@@ -364,67 +564,182 @@ class AddToDataStore(CkanCommand):
         except Exception as e:
             logger.exception(e)
 
-        logger.info('Creating: {0}.'.format(resource['id']))
+    def _push_sheets(self, context, resource, saved_file, content_type,
+                     archive=False):
+        """
+        Creates, updates and deletes the sheet resources of the workbook
+        (or zip archive) and starts pushing the selected sheets but the
+        first to the datastore in worker processes.
 
-        # generates chunks of data that can be loaded into ckan
-        # n is the maximum size of a chunk
-        def chunky(iterable, n):
-            it = iter(iterable)
-            while True:
-                chunk = list(
-                    itertools.imap(
-                        dict, itertools.islice(it, n)))
-                if not chunk:
-                    return
-                yield chunk
-
-        count = 0
+        Returns the name of the sheet to push into the resource itself, and
+        an iterator of the statuses of the workers, or None. When a single
+        sheet is selected, the sheet resources are left alone.
+        """
+        f = open(saved_file, 'rb')
         try:
-            for data in chunky(row_set.dicts(), 100):
-                count += len(data)
-                send_request(data)
-        except Exception as e:
-            logger.exception(e)
-            os.remove(result['saved_file'])
-            return {'success': False,
-                    'resource': resource['id'],
-                    'error': 'Error pushing data to datastore'}
+            names = archives.table_names(f, content_type, resource['format'])
+        finally:
+            f.close()
+        settings = get_settings(config)
+        selected = sheets.select_sheets(
+            names, settings['zip_tables' if archive else 'excel_sheets'])
+        if not selected:
+            logger.warning('None of the sheets {0} is selected, loading the '
+                           'first one.'.format(names))
+            selected = names[:1]
+        if len(selected) < 2:
+            return selected[0], None
+        if not resource.get('package_id'):
+            logger.warning('Resource {0} has no dataset, only pushing sheet '
+                           '{1}.'.format(resource['id'], selected[0]))
+            return selected[0], None
+
+        package = toolkit.get_action('package_show')(
+            context, {'id': resource['package_id']})
+        existing = sheets.sheet_resources(package, resource)
+
+        sheet_resources = []
+        for name in selected[1:]:
+            sheet_resource = existing.pop(name, None)
+            if sheet_resource is None:
+                sheet_resource = toolkit.get_action('resource_create')(
+                    context, sheets.new_sheet_resource(resource, name))
+            elif sheet_resource['url'] != resource['url']:
+                sheet_resource['url'] = resource['url']
+                sheet_resource = toolkit.get_action('resource_update')(
+                    context, sheet_resource)
+            sheet_resources.append(sheet_resource)
+
+        for name, sheet_resource in existing.iteritems():
+            logger.info(u'Deleting the resource of removed sheet {0}.'.format(
+                name))
+            try:
+                toolkit.get_action('datastore_delete')(
+                    context, {'resource_id': sheet_resource['id'],
+                              'force': True})
+            except toolkit.ObjectNotFound:
+                pass
+            toolkit.get_action('resource_delete')(
+                context, {'id': sheet_resource['id']})
+
+        workers = None
+        if sheet_resources:
+            logger.info(u'Pushing sheets {0} in worker processes.'.format(
+                selected[1:]))
+            workers = self._push_in_workers(context, sheet_resources,
+                                            int(settings['sheet_workers']))
+        return selected[0], workers
+
+    def _push_in_workers(self, context, resources, processes):
+        """
+        Starts pushing the resources to the datastore in a pool of worker
+        processes, returns an iterator of their statuses in the order they
+        finish.
+        """
+        if multiprocessing.current_process().daemon:
+            # worker processes can't have processes of their own
+            return [self.push_to_datastore(context, resource)
+                    for resource in resources]
+
+        global _worker_command
+        _worker_command = self
+        # the forked processes can't share the database connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(
+            _push_in_worker,
+            [(context['user'], resource, self.options.timeout)
+             for resource in resources])
+        pool.close()
+
+        def statuses():
+            for status in results:
+                yield status
+            pool.join()
+        return statuses()
+
+    def _apply_delta(self, context, resource, converter, changes, batcher,
+                     metrics):
+        """
+        Deletes the removed rows and upserts the new and changed ones.
+        """
+        logger.info('Upserting {0} rows and deleting {1} rows in {2}.'.format(
+            changes.upsert_count, len(changes.deletes), resource['id']))
 
-        logger.info("There should be {n} entries in {res_id}.".format(
-            n=count,
-            res_id=resource['id']
-        ))
+        for filters in changes.deletes:
+            toolkit.get_action('datastore_delete')(
+                context,
+                {'resource_id': resource['id'], 'filters': filters,
+                 'force': True}
+            )
 
+        method = 'upsert' if delta.primary_key(resource) else 'insert'
+        for data in batcher.batches(changes.upserts()):
+            data = converter.dicts(data)
+            start = time.time()
+            toolkit.get_action('datastore_upsert')(
+                context,
+                {'resource_id': resource['id'], 'records': data,
+                 'method': method, 'force': True}
+            )
+            seconds = time.time() - start
+            batcher.record(len(data), len(json.dumps(data)), seconds)
+            metrics.record_batch(len(data), seconds)
+
+    def _mark_active(self, context, resource, saved_file):
         resource.update({
             'webstore_url': 'active',
             'webstore_last_updated': datetime.now().isoformat()
         })
 
         toolkit.get_action('resource_update')(context, resource)
-        os.remove(result['saved_file'])
+        os.remove(saved_file)
         return {'success': True,
                 'resource': resource['id'],
                 'error': None}
 
 
-def stringify_processor():
-    def to_string(row_set, row):
-        for cell in row:
-            if cell.value is None:
-                continue
-            else:
-                cell.value = unicode(cell.value)
-        return row
-    return to_string
-
-
-def datetime_procesor():
-    ''' Stringifies dates so that they can be parsed by the db
-    '''
-    def datetime_convert(row_set, row):
-        for cell in row:
-            if isinstance(cell.value, datetime):
-                cell.value = cell.value.isoformat()
-                cell.type = messytables.StringType()
-        return row
-    return datetime_convert
+# the command whose push_to_datastore is called by the worker processes,
+# which inherit it when they are forked
+_worker_command = None
+
+
+class ResourceTimeout(BaseException):
+    '''Raised when it took too long to push a resource. It is not an
+    Exception so that it isn't handled by push_to_datastore.'''
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise ResourceTimeout()
+
+
+def _push_with_timeout(command, context, resource, timeout):
+    '''Pushes the resource with the command, giving up after ``timeout``
+    seconds if it is set.'''
+    if timeout:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(timeout)
+    try:
+        return command.push_to_datastore(context, resource)
+    except ResourceTimeout:
+        logger.error(u'Timed out pushing resource {0}.'.format(
+            resource['id']))
+        # the push may have been stopped in the middle of a transaction
+        model.Session.remove()
+        return {'success': False,
+                'resource': resource['id'],
+                'error': 'Timed out after {0} seconds'.format(timeout)}
+    finally:
+        signal.alarm(0)
+
+
+def _push_in_worker(args):
+    user, resource, timeout = args
+    context = {'username': user, 'user': user, 'model': model}
+    try:
+        return _push_with_timeout(_worker_command, context, resource,
+                                  timeout)
+    finally:
+        model.Session.remove()
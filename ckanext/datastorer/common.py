@@ -17,6 +17,34 @@ DATA_FORMATS = [
     'text/comma-separated-values',
     'application/x-zip-compressed',
     'application/zip',
+    'gz',
+    'bz2',
+    'xz',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+]
+
+
+# Formats that can be parsed as they are downloaded
+DELIMITED_FORMATS = [
+    'csv',
+    'tsv',
+    'text/csv',
+    'text/tsv',
+    'text/tab-separated-values',
+    'text/comma-separated-values',
+]
+
+
+# Types that the columns are guessed to be
+TYPES = [
+    messytables.types.StringType,
+    messytables.types.IntegerType,
+    messytables.types.FloatType,
+    messytables.types.DecimalType,
+    messytables.types.DateUtilType
 ]
 
 
@@ -30,3 +58,65 @@ TYPE_MAPPING = {
     messytables.types.DateType: 'timestamp',
     messytables.types.DateUtilType: 'timestamp'
 }
+
+
+# Options read from the CKAN ini file (prefixed with "ckanext-datastorer.")
+# that are passed on to the upload tasks in their context, with their
+# defaults.
+SETTINGS = {
+    'upload_concurrency': 4,
+    'upload_queue_size': 8,
+    'batch_target_bytes': 4 * 1024 * 1024,
+    'batch_target_seconds': 5,
+    'batch_min_rows': 10,
+    'batch_max_rows': 10000,
+    'http_pool_size': 10,
+    'batch_retries': 3,
+    'retry_delay': 2,
+    'max_retry_delay': 60,
+    'task_retries': 5,
+    'task_retry_delay': 300,
+    'max_task_retry_delay': 6 * 3600,
+    'statsd_host': '',
+    'statsd_prefix': 'datastorer',
+    'direct_write_url': None,
+    'stream_parse': False,
+    'max_content_length': 50000000,
+    'cache_dir': None,
+    'incremental': False,
+    'atomic_swap': False,
+    'type_sample_head': 1000,
+    'type_sample_middle': 0,
+    'type_sample_tail': 0,
+    'type_min_confidence': 1.0,
+    'excel_sheets': 'all',
+    'zip_tables': 'first',
+    'csv_engine': 'messytables',
+    'queue_delay': 0,
+    'queue': '',
+    'large_queue': '',
+    'large_resource_size': 10 * 1024 * 1024,
+    'bulk_queue': '',
+    'sheet_workers': 4,
+    'conditional_get': False,
+    'head_request': True,
+    'resume_downloads': False,
+    'resume_uploads': False,
+    'content_cache': False,
+    'content_cache_rows': False,
+    'content_cache_max_size': 1024 * 1024 * 1024,
+    'content_cache_max_age': 30 * 24 * 3600,
+    'schema_cache': False,
+}
+
+
+def get_settings(config):
+    '''Returns the datastorer options set in the given CKAN config.'''
+    return dict((key, config.get('ckanext-datastorer.' + key, default))
+                for key, default in SETTINGS.iteritems())
+
+
+def get_setting(context, key):
+    '''Returns the value of a datastorer option from a task context,
+    falling back to its default.'''
+    return context.get(key, SETTINGS[key])
@@ -0,0 +1,98 @@
+'''
+Converts the raw rows of a table to the values loaded in the datastore.
+
+This does in a single pass over each row what messytables' headers,
+offset and types processors followed by the datastorer's datetime and
+stringify processors do in five, and returns lists of values instead of
+dicts: the column names only need to be attached to the rows when they
+are sent to the datastore API.
+'''
+import datetime
+import itertools
+import logging
+
+from messytables.types import StringType
+
+
+log = logging.getLogger('ckanext_datastorer')
+
+
+def _string_cast(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return unicode(value.isoformat())
+    return unicode(value)
+
+
+def _make_cast(type, lenient):
+    if type is None or isinstance(type, StringType):
+        return _string_cast
+    type_cast = type.cast
+
+    def cast(value):
+        if value is None:
+            return None
+        # dates are parsed again from their ISO representation, as they
+        # used to be converted before casting
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        try:
+            value = type_cast(value)
+        except Exception:
+            if not lenient:
+                raise
+            log.debug(u'Emptying {0} value {1!r}'.format(type, value))
+            return None
+        if value is None:
+            return None
+        return unicode(value)
+    return cast
+
+
+class RowConverter(object):
+    '''Converts rows of raw values to lists of unicode (or None) values, one
+    per header, cast to the given types.
+
+    Missing cells are None, and cells beyond the last header are ignored.
+    If ``lenient`` is true, values that can't be cast are emptied instead
+    of raising an exception.
+    '''
+
+    def __init__(self, headers, types, lenient=False):
+        self.headers = headers
+        self.types = types
+        self.lenient = lenient
+        # the names messytables gives to the cells
+        self.columns = [header or u'column_%d' % i
+                        for i, header in enumerate(headers)]
+        self.width = len(headers)
+        types = list(types[:self.width])
+        types.extend([None] * (self.width - len(types)))
+        self.casts = [_make_cast(t, lenient) for t in types]
+
+    def convert(self, values):
+        if len(values) < self.width:
+            values = list(values)
+            values.extend([None] * (self.width - len(values)))
+        return [cast(value) for cast, value
+                in itertools.izip(self.casts, values)]
+
+    def rows(self, raw_rows, skip=0):
+        '''Converts the raw rows (sequences of values) after skipping the
+        first ``skip`` ones.'''
+        return itertools.imap(self.convert,
+                              itertools.islice(raw_rows, skip, None))
+
+    def dicts(self, rows):
+        '''Turns converted rows into dicts, as datastore records.'''
+        columns = self.columns
+        return [dict(itertools.izip(columns, row)) for row in rows]
+
+
+def cell_values(row_set):
+    '''Returns the raw rows of a messytables row set as lists of values.'''
+    if hasattr(row_set, 'raw_values'):
+        # read without cells by the native CSV engine
+        return row_set.raw_values()
+    return ([cell.value for cell in row] for row in row_set.raw())
@@ -0,0 +1,126 @@
+'''
+Helpers that write directly to the datastore's PostgreSQL database,
+bypassing the datastore API.
+
+The tables are still created (and registered against their resources)
+with datastore_create, only the rows are streamed in with COPY, which is
+much faster than sending them as JSON. This needs psycopg2 and a
+connection URL with write access to the datastore database, e.g. the
+same as ckan.datastore.write_url.
+'''
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+
+def is_available(write_url):
+    '''Returns whether rows can be copied to the given database.'''
+    return bool(write_url) and psycopg2 is not None
+
+
+def _identifier(name):
+    return u'"{0}"'.format(name.replace('"', '""'))
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return value.encode('utf-8').replace('\\', '\\\\').replace(
+        '\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyStream(object):
+    '''A file-like object that reads the given rows (sequences of values)
+    in the text format of PostgreSQL's COPY, one row at a time.'''
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        lines = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                row = self.rows.next()
+            except StopIteration:
+                break
+            line = '\t'.join(_copy_value(v) for v in row) + '\n'
+            lines.append(line)
+            length += len(line)
+            self.count += 1
+        data = ''.join(lines)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def copy_rows(write_url, table, columns, rows):
+    '''Appends the rows to an existing datastore table with COPY and fills
+    in their full text search column, in a single transaction.
+
+    ``rows`` are sequences of values (unicode or None) in the same order as
+    ``columns``. Returns the number of rows copied.
+    '''
+    stream = CopyStream(rows)
+    column_list = u', '.join(_identifier(c) for c in columns)
+    connection = psycopg2.connect(write_url)
+    try:
+        connection.set_client_encoding('UTF8')
+        cursor = connection.cursor()
+        cursor.copy_expert(
+            u'COPY {0} ({1}) FROM STDIN'.format(
+                _identifier(table), column_list).encode('utf-8'),
+            stream)
+        # datastore_create indexes each row as it inserts it, do the same
+        # for the copied rows
+        cursor.execute(
+            u'UPDATE {0} SET _full_text = to_tsvector(concat_ws(\' \', {1})) '
+            u'WHERE _full_text IS NULL'.format(
+                _identifier(table),
+                u', '.join(u'{0}::text'.format(_identifier(c))
+                           for c in columns)).encode('utf-8'))
+        connection.commit()
+    except:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return stream.count
+
+
+def swap_tables(write_url, table, staging_table):
+    '''Replaces the table with the staging table in a single transaction,
+    so readers see either all the old rows or all the new ones. The staging
+    table is left with the old rows, if the table existed.
+
+    Returns whether the table existed.
+    '''
+    swap_table = staging_table + '_swap'
+    connection = psycopg2.connect(write_url)
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1 FROM pg_tables WHERE tablename = %s '
+                       'AND schemaname = current_schema()', (table,))
+        existed = cursor.fetchone() is not None
+        rename = u'ALTER TABLE {0} RENAME TO {1}'
+        if existed:
+            cursor.execute(rename.format(_identifier(table),
+                                         _identifier(swap_table)))
+        cursor.execute(rename.format(_identifier(staging_table),
+                                     _identifier(table)))
+        if existed:
+            cursor.execute(rename.format(_identifier(swap_table),
+                                         _identifier(staging_table)))
+        connection.commit()
+    except:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return existed
@@ -0,0 +1,241 @@
+'''
+A faster engine than messytables' one for CSV and TSV files.
+
+It sniffs the dialect of a file the same way as messytables, on the same
+sample, and gives the same cells for the sample,
+so that the headers and types guessed from it don't change. But it then
+reads the rows with the csv module straight from the lines of the file,
+and returns them as plain lists of unicode values (see ``raw_values``)
+instead of recoding each line to UTF-8 and wrapping each value in a Cell.
+
+Files in encodings where the bytes of ASCII characters can be part of
+other characters (e.g. UTF-16), or with old Mac (CR) line endings, are
+still read by messytables.
+
+With either engine, the encoding of a file is detected once, before it is
+parsed, from a sample of its first bytes (see ``detect_encoding``), and
+the bytes that can't be decoded are replaced with U+FFFD rather than
+dropped or failing the load halfway through.
+'''
+import codecs
+import csv
+import itertools
+import logging
+
+import chardet
+from messytables import CSVTableSet, Cell
+from messytables.commas import CSVRowSet
+from messytables.core import BufferedFile
+
+
+log = logging.getLogger('ckanext_datastorer')
+
+# Number of bytes the encoding of a file is detected from
+ENCODING_SAMPLE_SIZE = 1024 * 64
+
+# The byte order marks of the encodings, longest first
+BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+
+# Encodings in which the line breaks, delimiters and quotes of a line can be
+# found in its bytes
+ASCII_COMPATIBLE_ENCODINGS = ['ascii', 'utf-8', 'utf-8-sig']
+SINGLE_BYTE_ENCODING_PREFIXES = ('iso8859', 'cp125', 'koi8', 'mac-')
+
+
+def _is_ascii_compatible(encoding):
+    return (encoding in ASCII_COMPATIBLE_ENCODINGS or
+            encoding.startswith(SINGLE_BYTE_ENCODING_PREFIXES))
+
+
+def detect_encoding(sample):
+    '''Returns the encoding of a file from a sample of its first bytes: the
+    one of its byte order mark if it has one, UTF-8 if the sample is valid
+    UTF-8 (as ASCII is), otherwise the one guessed by chardet.'''
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding
+    try:
+        # the sample can end in the middle of a character
+        codecs.getincrementaldecoder('utf-8')().decode(sample)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    return chardet.detect(sample)['encoding'] or 'windows-1252'
+
+
+def _has_cr_line_endings(head):
+    return '\r' in head.rstrip('\r').replace('\r\n', '')
+
+
+def _read_lines(fileobj, chunk_size=1024 * 64):
+    # the lines of the file, ending with LF like those of messytables (which
+    # can't be read with readline, that splits lines at the end of the
+    # buffer of messytables' BufferedFile)
+    tail = ''
+    for chunk in iter(lambda: fileobj.read(chunk_size), ''):
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            if line.endswith('\r'):
+                line = line[:-1]
+            yield line + '\n'
+    if tail:
+        yield tail
+
+
+def csv_table_set(fileobj, delimiter=None, name=None, engine='messytables',
+                  encoding=None):
+    '''Returns the table set of a CSV file, read by the given engine
+    ("messytables" or "native"), in the given encoding or the one detected
+    from its first bytes.'''
+    try:
+        fileobj.seek(0)
+    except Exception:
+        # keeps the sample so that the file can be read again from the
+        # start, as messytables does with a smaller buffer
+        fileobj = BufferedFile(fileobj, buffer_size=ENCODING_SAMPLE_SIZE)
+    if not encoding:
+        encoding = detect_encoding(fileobj.read(ENCODING_SAMPLE_SIZE))
+        fileobj.seek(0)
+        log.info(u'Detected encoding of {0}: {1}'.format(name or 'the file',
+                                                        encoding))
+    if engine == 'native':
+        return NativeCSVTableSet(fileobj, delimiter=delimiter, name=name,
+                                 encoding=encoding)
+    return CSVTableSet(RecodingFile(fileobj, encoding), delimiter=delimiter,
+                       name=name, encoding='utf-8')
+
+
+class RecodingFile(object):
+    '''
+    Reads a file in the given encoding as UTF-8, decoding it as it is read
+    and replacing the bytes that can't be decoded.
+
+    The only seek supported is back to the start.
+    '''
+
+    def __init__(self, fileobj, encoding, chunk_size=1024 * 16):
+        self.fileobj = fileobj
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.seek(0)
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise IOError('A recoded file can only be read again from the '
+                          'start')
+        self.fileobj.seek(0)
+        self._decoder = codecs.getincrementaldecoder(self.encoding)(
+            'replace')
+        self._buffer = ''
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self.fileobj.read(self.chunk_size)
+            self._eof = not data
+            self._buffer += self._decoder.decode(
+                data, final=self._eof).encode('utf-8')
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class NativeCSVTableSet(CSVTableSet):
+    '''A CSV table set in the given encoding, whose table is read by the
+    native engine if it can be.'''
+
+    @property
+    def tables(self):
+        return [open_row_set(self.name, self.fileobj, self.encoding,
+                             delimiter=self.delimiter,
+                             quotechar=self.quotechar,
+                             window=self.window)]
+
+
+def open_row_set(name, fileobj, encoding, delimiter=None, quotechar=None,
+                 window=None):
+    '''Returns a NativeCSVRowSet for the (seekable) file, or a messytables
+    CSVRowSet if the native engine can't read it.'''
+    head = fileobj.read(2000)
+    fileobj.seek(0)
+    try:
+        codec = codecs.lookup(encoding).name
+    except LookupError:
+        codec = None
+    if (codec is None or not _is_ascii_compatible(codec) or
+            _has_cr_line_endings(head)):
+        return CSVRowSet(name, RecodingFile(fileobj, encoding),
+                         delimiter=delimiter, quotechar=quotechar,
+                         encoding='utf-8', window=window)
+    return NativeCSVRowSet(name, fileobj, codec, delimiter=delimiter,
+                           quotechar=quotechar, window=window)
+
+
+class NativeCSVRowSet(CSVRowSet):
+    '''
+    A CSV row set read with the csv module, from a file in an ASCII
+    compatible encoding.
+
+    Like messytables' CSVRowSet, it reads a sample of ``window`` lines to
+    sniff the dialect. Bytes that can't be decoded are replaced.
+    '''
+
+    def __init__(self, name, fileobj, encoding, delimiter=None,
+                 quotechar=None, window=None):
+        self.name = name
+        self.fileobj = fileobj
+        self.lines = _read_lines(fileobj)
+        if encoding == 'utf-8-sig':
+            first = next(self.lines, '')
+            if first.startswith(codecs.BOM_UTF8):
+                first = first[len(codecs.BOM_UTF8):]
+            self.lines = itertools.chain([first], self.lines)
+            encoding = 'utf-8'
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        self.window = window or 1000
+        self.doublequote = None
+        self.lineterminator = None
+        self.skipinitialspace = None
+        self._sample = list(itertools.islice(self.lines, self.window))
+        # skips CSVRowSet.__init__, which reads its own sample
+        super(CSVRowSet, self).__init__()
+
+    def _rows(self, sample=False):
+        lines = self._sample
+        if not sample:
+            lines = itertools.chain(lines, self.lines)
+
+        # the same limit as messytables
+        csv.field_size_limit(256000)
+
+        encoding = self.encoding
+        try:
+            for row in csv.reader(lines, dialect=self._dialect,
+                                  **self._overrides):
+                yield [value.decode(encoding, 'replace') for value in row]
+        except csv.Error as e:
+            if 'newline inside string' in unicode(e) and sample:
+                pass
+            elif 'line contains NULL byte' in unicode(e):
+                pass
+            else:
+                raise
+
+    def raw(self, sample=False):
+        for row in self._rows(sample):
+            yield [Cell(value) for value in row]
+
+    def raw_values(self):
+        '''Returns the rows as lists of unicode values.'''
+        return self._rows()
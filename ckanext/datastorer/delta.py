@@ -0,0 +1,131 @@
+'''
+Incremental loading: works out which rows of a resource changed since it
+was last loaded, from the fingerprints (hashes) of the rows of that load.
+
+When the resource has a primary key (its ``datastorer_primary_key`` field,
+a comma separated list of columns), the fingerprints are stored per key,
+so new and changed rows can be upserted and missing rows deleted by key.
+Otherwise only new rows can be detected: they are inserted, and if any
+previous row is missing the resource has to be fully reloaded.
+'''
+import hashlib
+import json
+import tempfile
+
+
+def primary_key(resource):
+    '''Returns the list of primary key columns of the resource, or None.'''
+    key = resource.get('datastorer_primary_key')
+    if not key:
+        return None
+    return [column.strip() for column in key.split(',') if column.strip()]
+
+
+def fingerprint(row):
+    return hashlib.sha1(json.dumps(row)).hexdigest()[:16]
+
+
+class Fingerprints(object):
+    '''The fingerprints of the rows (lists of values, one per field) of a
+    load.'''
+
+    def __init__(self, fields, key=None, rows=None):
+        self.fields = fields
+        self.key = key
+        self.rows = rows if rows is not None else {}
+        ids = [field['id'] for field in fields]
+        self._key_indexes = [ids.index(column) if column in ids else None
+                             for column in key or []]
+
+    @classmethod
+    def load(cls, cache, resource_id):
+        state = cache.get(resource_id)
+        if not state:
+            return None
+        return cls(state['fields'], state['key'], state['rows'])
+
+    def save(self, cache, resource_id):
+        cache.set(resource_id, {'fields': self.fields,
+                                'key': self.key,
+                                'rows': self.rows})
+
+    def matches(self, fields, key):
+        '''Whether rows with these fields and key can be compared with these
+        fingerprints.'''
+        return self.fields == fields and self.key == key
+
+    def key_of(self, row):
+        return json.dumps([row[i] if i is not None else None
+                           for i in self._key_indexes])
+
+    def add(self, row):
+        fp = fingerprint(row)
+        if self.key:
+            self.rows[self.key_of(row)] = fp
+        else:
+            self.rows[fp] = self.rows.get(fp, 0) + 1
+        return fp
+
+    def record(self, rows):
+        '''Adds the fingerprints of the rows as they are iterated.'''
+        for row in rows:
+            self.add(row)
+            yield row
+
+
+class Delta(object):
+    '''The changes between a previous load of a resource and its current
+    rows. The rows to upsert are spooled to a temporary file.'''
+
+    def __init__(self):
+        self._upserts = tempfile.TemporaryFile()
+        self.upsert_count = 0
+        self.deletes = []
+        self.removed = 0
+
+    def add_upsert(self, row):
+        self._upserts.write(json.dumps(row) + '\n')
+        self.upsert_count += 1
+
+    def upserts(self):
+        self._upserts.seek(0)
+        for line in self._upserts:
+            yield json.loads(line)
+
+    @property
+    def needs_reload(self):
+        '''Rows without a key were changed or deleted, so they can't be
+        updated in place.'''
+        return self.removed > 0
+
+    def close(self):
+        self._upserts.close()
+
+
+def compare(previous, rows):
+    '''Compares the rows (lists of values) with the fingerprints of the previous load.
+
+    Returns the fingerprints of the rows and the Delta to apply.
+    '''
+    current = Fingerprints(previous.fields, previous.key)
+    delta = Delta()
+    if previous.key:
+        for row in rows:
+            key = current.key_of(row)
+            if key in current.rows:
+                raise ValueError('Duplicate primary key: {0}'.format(key))
+            if previous.rows.get(key) != current.add(row):
+                delta.add_upsert(row)
+        for key in previous.rows:
+            if key not in current.rows:
+                delta.deletes.append(dict(zip(previous.key, json.loads(key))))
+    else:
+        remaining = dict(previous.rows)
+        for row in rows:
+            fp = current.add(row)
+            if remaining.get(fp):
+                remaining[fp] -= 1
+            else:
+                delta.add_upsert(row)
+        delta.removed = sum(remaining.values())
+    return current, delta
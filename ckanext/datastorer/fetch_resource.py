@@ -5,10 +5,15 @@ import json
 import logging
 import os
 import requests
+import shutil
 import tempfile
+import time
 import urllib
 import urlparse
 import ckan.logic as logic
+from client import get_client
+from retries import (TRANSIENT_STATUS_CODES, TransientError, is_transient,
+                     is_transient_status)
 
 
 log = logging.getLogger('ckanext_datastorer')
@@ -31,6 +36,18 @@ class DownloadError(Exception):
     pass
 
 
+class TransientDownloadError(DownloadError, TransientError):
+    '''A download that failed in a way that may not happen again, e.g.
+    with a timeout or a 5xx response.'''
+    pass
+
+
+def _download_error(e):
+    if is_transient(e):
+        return TransientDownloadError
+    return DownloadError
+
+
 class ChooseNotToDownload(Exception):
     pass
 
@@ -51,6 +68,11 @@ class LinkHeadRequestError(LinkCheckerError):
     pass
 
 
+class TransientLinkHeadRequestError(LinkHeadRequestError, TransientError):
+    '''A HEAD request that failed in a way that may not happen again.'''
+    pass
+
+
 class CkanError(Exception):
     pass
 
@@ -64,7 +86,8 @@ def _clean_content_type(ct):
 
 
 def download(context, resource, max_content_length, data_formats,
-             url_timeout=30, check_modified=False):
+             url_timeout=30, check_modified=False, validators=None,
+             head_request=True, partials=None, metrics=None):
     '''Given a resource, tries to download it.
 
     If the size or format is not acceptable for download then
@@ -72,105 +95,131 @@ def download(context, resource, max_content_length, data_formats,
 
     If there is an error performing the download then
     DownloadError is raised.
-    '''
 
-    url = resource['url']
+    If a ``validators`` cache is given, the ETag and Last-Modified headers,
+    length and content hash of the download are kept in it. When checking
+    whether the resource was modified, they are then sent in a conditional
+    GET instead of making a HEAD request first.
 
-    if (resource.get('resource_type') == 'file.upload' and
-            not url.startswith('http')):
-        url = context['site_url'].rstrip('/') + url
+    If ``head_request`` is false, no HEAD request is made either: the
+    headers of the GET response are checked before its content is
+    downloaded.
 
-    link_context = "{}"
-    link_data = json.dumps({
-        'url': url,
-        'url_timeout': url_timeout
-    })
+    If a ``partials`` cache is given, the content is downloaded into it and
+    an interrupted download is resumed with a Range request the next time,
+    if the server supports it and the resource was not modified since.
 
-    headers = json.loads(link_checker(link_context, link_data))
+    The HEAD request is timed in the "head" stage of the ``metrics`` (an
+    UploadMetrics), if given.
+    '''
 
-    # check to see if remote resource has been modified since the CKAN
-    # resource was last updated
-    #
-    # note: checks by hashes
-    remote_last_mod = headers.get('last-modified')
-    # If the server doesn't return a last-modifed, we shouldn't get stuck
-    # in a loop saving a sha1 of None and comparing that
-    remote_last_mod_hash = None
-    if remote_last_mod is not None:
-        remote_last_mod_hash = hashlib.sha1(remote_last_mod).hexdigest()
+    url = _resource_url(context, resource)
 
     try:
         resource_hash = json.loads(resource.get('hash'))
         resource_content_hash = resource_hash['content']
         resource_header_hash = resource_hash['header']
-        if check_modified and (remote_last_mod_hash is not None and
-                               resource_header_hash == remote_last_mod_hash):
-            raise ResourceNotModified(
-                'Resource {0} not modified'.format(resource['id']))
     except ValueError:
         resource_content_hash = resource.get('hash')
         resource_header_hash = None
-    except ResourceNotModified:
-        raise ResourceNotModified
     except:
         resource_content_hash = None
         resource_header_hash = None
 
-    resource_format = resource['format'].lower()
-    ct = _clean_content_type(headers.get('content-type', '').lower())
-    cl = headers.get('content-length')
-
-    resource_changed = False
+    # the validators and partial download of each resource are kept apart,
+    # even when several resources have the same URL
+    cache_key = u'{0} {1}'.format(resource['id'], url)
+    known = None
+    if check_modified and validators is not None:
+        known = validators.get(cache_key)
+
+    res = None
+    if known or not head_request:
+        # the headers of the GET response tell as much as a HEAD request
+        res = _stream_get(url, url_timeout,
+                          known and _conditional_headers(known))
+        if res.status_code == httplib.NOT_MODIFIED:
+            res.close()
+            raise ResourceNotModified(
+                'Resource {0} not modified'.format(resource['id']))
+        headers = _lowercase_headers(res.headers)
+    else:
+        headers = _head(url, url_timeout, metrics)
 
-    if resource.get('mimetype') != ct:
-        resource_changed = True
-        resource['mimetype'] = ct
+    # check to see if remote resource has been modified since the CKAN
+    # resource was last updated
+    #
+    # note: checks by hashes
+    remote_last_mod = headers.get('last-modified')
+    # If the server doesn't return a last-modifed, we shouldn't get stuck
+    # in a loop saving a sha1 of None and comparing that
+    remote_last_mod_hash = None
+    if remote_last_mod is not None:
+        remote_last_mod_hash = hashlib.sha1(remote_last_mod).hexdigest()
 
-    # this is to store the size in case there is an error, but the real size
-    # check is done after dowloading the data file, with its real length
-    if cl is not None and (resource.get('size') != cl):
-        resource_changed = True
-        resource['size'] = cl
+    if check_modified and (remote_last_mod_hash is not None and
+                           resource_header_hash == remote_last_mod_hash):
+        if res is not None:
+            res.close()
+        raise ResourceNotModified(
+            'Resource {0} not modified'.format(resource['id']))
 
-    # make sure resource content-length does not exceed our maximum
-    if cl and int(cl) >= max_content_length:
-        if resource_changed:
-            _update_resource(context, resource)
-        # record fact that resource is too large to archive
-        log.warning('Resource too large to download: %s > max (%s). '
-                    'Resource: %s %r', cl, max_content_length, resource['id'],
-                    url)
-        raise ChooseNotToDownload("Content-length %s exceeds maximum allowed "
-                                  "value %s" % (cl, max_content_length))
+    try:
+        resource_changed = _check_headers(context, resource, url, headers,
+                                          max_content_length, data_formats)
+    except:
+        # don't download the content of a rejected resource
+        if res is not None:
+            res.close()
+        raise
 
-    # check that resource is a data file
-    if data_formats != 'all' and not (resource_format in data_formats or
-                                      ct.lower() in data_formats):
-        if resource_changed:
-            _update_resource(context, resource)
-        log.warning('Resource wrong type to download: %s / %s. Resource: %s '
-                    '%r', resource_format, ct.lower(), resource['id'], url)
-        raise ChooseNotToDownload('Of content type "%s" which is not a '
-                                  'recognised data file for download' % ct)
+    partial = None
+    if partials is not None:
+        partial = _partial_path(partials, cache_key, headers)
 
     # get the resource and archive it
-    try:
-        res = requests.get(url, timeout=url_timeout)
-    except requests.exceptions.ConnectionError, e:
-        raise DownloadError('Connection error: %s' % e)
-    except requests.exceptions.HTTPError, e:
-        raise DownloadError('Invalid HTTP response: %s' % e)
-    except requests.exceptions.Timeout, e:
-        raise DownloadError('Connection timed out after %ss' % url_timeout)
-    except requests.exceptions.TooManyRedirects, e:
-        raise DownloadError('Too many redirects')
-    except requests.exceptions.RequestException, e:
-        raise DownloadError('Error downloading: %s' % e)
-    except Exception, e:
-        raise DownloadError('Error with the download: %s' % e)
-
-    length, hash, saved_file = _save_resource(resource, res,
-                                              max_content_length)
+    resumed = False
+    if partial and os.path.exists(partial) and (
+            headers.get('accept-ranges') == 'bytes'):
+        if res is not None:
+            res.close()
+        offset = os.path.getsize(partial)
+        log.info('Resuming the download of %r from byte %s', url, offset)
+        try:
+            res = _stream_get(url, url_timeout, {
+                'Range': 'bytes=%s-' % offset,
+                'If-Range': headers.get('etag') or headers['last-modified']})
+        except DownloadError, e:
+            # e.g. the range is not satisfiable, start again
+            log.info('Could not resume the download of %r: %s', url, e)
+            res = _get(url, url_timeout)
+        else:
+            resumed = res.status_code == httplib.PARTIAL_CONTENT
+    elif res is None:
+        res = _get(url, url_timeout)
+
+    if partial:
+        # unless the rest of the content is sent, the whole content is, so
+        # it must not be appended to what was downloaded before
+        if not resumed and os.path.exists(partial):
+            os.remove(partial)
+        try:
+            length, hash, partial = _save_resource(resource, res,
+                                                   max_content_length,
+                                                   path=partial)
+        except requests.exceptions.RequestException, e:
+            raise _download_error(e)('Download interrupted, it will be '
+                                     'resumed next time: %s' % e)
+        partials.delete(cache_key)
+        fd, saved_file = tempfile.mkstemp()
+        os.close(fd)
+        shutil.move(partial, saved_file)
+    else:
+        try:
+            length, hash, saved_file = _save_resource(resource, res,
+                                                      max_content_length)
+        except requests.exceptions.RequestException, e:
+            raise _download_error(e)('Download interrupted: %s' % e)
 
     # check if resource size changed
     if unicode(length) != resource.get('size'):
@@ -179,10 +228,9 @@ def download(context, resource, max_content_length, data_formats,
 
     # check that resource did not exceed maximum size when being saved
     # (content-length header could have been invalid/corrupted, or not accurate
-    # if resource was streamed)
-    #
-    # TODO: remove partially archived file in this case
+    # if resource was streamed), in which case the download was stopped
     if length >= max_content_length:
+        os.remove(saved_file)
         if resource_changed:
             _update_resource(context, resource)
         # record fact that resource is too large to archive
@@ -195,6 +243,7 @@ def download(context, resource, max_content_length, data_formats,
 
     # zero length usually indicates a problem too
     if length == 0:
+        os.remove(saved_file)
         if resource_changed:
             _update_resource(context, resource)
         # record fact that resource is zero length
@@ -217,12 +266,234 @@ def download(context, resource, max_content_length, data_formats,
     log.info('Resource downloaded: id=%s url=%r cache_filename=%s length=%s'
                 ' hash=%s', resource['id'], url, saved_file, length, hash)
 
+    if validators is not None:
+        if headers.get('etag') or remote_last_mod:
+            validators.set(cache_key, {
+                'etag': headers.get('etag'),
+                'last-modified': remote_last_mod,
+                'length': length,
+                'hash': hash})
+        else:
+            validators.delete(cache_key)
+
+        # the server ignored the conditional request
+        if known and known['hash'] == hash:
+            os.remove(saved_file)
+            raise ResourceNotModified(
+                'Resource {0} not modified'.format(resource['id']))
+
     return {'length': length,
             'hash': resource_content_hash,
             'headers': headers,
             'saved_file': saved_file}
 
 
+def open_resource(context, resource, max_content_length, data_formats,
+                  url_timeout=30, head_request=True, metrics=None):
+    '''Given a resource, starts downloading it and returns a file-like object
+    to read its content from as it arrives, without saving it to disk.
+
+    The same checks as in ``download`` are made before the download starts,
+    and raise the same exceptions. The size limit is also enforced while
+    reading, which raises ChooseNotToDownload.
+
+    Returns a dict with the 'headers' of the resource and the 'stream'
+    (a HashingStream). Once the stream has been read completely, its length
+    and content hash are set on the resource, but the resource is not saved.
+
+    If ``head_request`` is false, the headers of the GET response are
+    checked instead of those of a HEAD request.
+
+    If ``metrics`` (an UploadMetrics) are given, the HEAD request is timed
+    in their "head" stage, and the length of the content is added to their
+    bytes downloaded once it has been read.
+    '''
+    url = _resource_url(context, resource)
+    if head_request:
+        headers = _head(url, url_timeout, metrics)
+        _check_headers(context, resource, url, headers, max_content_length,
+                       data_formats)
+        res = _stream_get(url, url_timeout)
+    else:
+        res = _stream_get(url, url_timeout)
+        headers = _lowercase_headers(res.headers)
+        try:
+            _check_headers(context, resource, url, headers,
+                           max_content_length, data_formats)
+        except:
+            res.close()
+            raise
+
+    def on_complete(stream):
+        remote_last_mod = headers.get('last-modified')
+        resource['size'] = unicode(stream.length)
+        resource['hash'] = json.dumps({
+            'content': stream.hexdigest(),
+            'header': remote_last_mod and hashlib.sha1(
+                remote_last_mod).hexdigest()})
+        log.info('Resource streamed: id=%s url=%r length=%s hash=%s',
+                 resource['id'], url, stream.length, stream.hexdigest())
+        if metrics is not None:
+            metrics.count('bytes_downloaded', stream.length)
+
+    return {'headers': headers,
+            'stream': HashingStream(res, max_content_length, on_complete)}
+
+
+def _partial_path(partials, key, headers):
+    '''Returns the path of the partial download kept under the key, or None
+    if the resource can't be resumed. A partial download of an older
+    version of the resource is deleted.'''
+    current = {'etag': headers.get('etag'),
+               'last-modified': headers.get('last-modified')}
+    if not current['etag'] and not current['last-modified']:
+        return None
+    path = partials.path(key, '.part')
+    if partials.get(key) != current:
+        if os.path.exists(path):
+            os.remove(path)
+        partials.set(key, current)
+    return path
+
+
+def _head(url, url_timeout, metrics=None):
+    '''Returns the headers of the resource, from a HEAD request made by
+    the link checker.'''
+    link_data = json.dumps({
+        'url': url,
+        'url_timeout': url_timeout
+    })
+    start = time.time()
+    try:
+        return json.loads(link_checker("{}", link_data))
+    finally:
+        if metrics is not None:
+            metrics.add_time('head', time.time() - start)
+
+
+def _get(url, url_timeout, headers=None):
+    '''Sends a GET request, whose content is streamed as it is read,
+    raising DownloadError if it fails.'''
+    try:
+        return requests.get(url, timeout=url_timeout, headers=headers,
+                            stream=True)
+    except requests.exceptions.ConnectionError, e:
+        raise TransientDownloadError('Connection error: %s' % e)
+    except requests.exceptions.HTTPError, e:
+        raise DownloadError('Invalid HTTP response: %s' % e)
+    except requests.exceptions.Timeout, e:
+        raise TransientDownloadError('Connection timed out after %ss' %
+                                     url_timeout)
+    except requests.exceptions.TooManyRedirects, e:
+        raise DownloadError('Too many redirects')
+    except requests.exceptions.RequestException, e:
+        raise DownloadError('Error downloading: %s' % e)
+    except Exception, e:
+        raise DownloadError('Error with the download: %s' % e)
+
+
+def _stream_get(url, url_timeout, headers=None):
+    '''Checks the URL and sends a GET request for it, without downloading
+    the content of the response yet. Raises DownloadError if the request
+    fails, unless the resource is not modified.'''
+    res = _get(_check_url(url), url_timeout, headers)
+    if not res.ok and res.status_code != httplib.NOT_MODIFIED:
+        res.close()
+        if is_transient_status(res.status_code):
+            raise TransientDownloadError(
+                _http_error_message(res.status_code))
+        raise DownloadError(_http_error_message(res.status_code))
+    return res
+
+
+def _conditional_headers(validators):
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last-modified'):
+        headers['If-Modified-Since'] = validators['last-modified']
+    return headers
+
+
+def _lowercase_headers(headers):
+    # make the headers serializable, with lowercase names
+    return dict((name.lower(), value) for name, value in headers.items())
+
+
+def _http_error_message(status_code):
+    if status_code in HTTP_ERROR_CODES:
+        return 'Server returned error: %s' % HTTP_ERROR_CODES[status_code]
+    return "URL unobtainable: Server returned HTTP %s" % status_code
+
+
+_TRANSIENT_MESSAGES = ('Connection error', 'Connection timed out') + tuple(
+    _http_error_message(status_code) for status_code in TRANSIENT_STATUS_CODES)
+
+
+def is_transient_message(message):
+    '''Whether the message of a download or link checker error, e.g. from
+    the archiver, which raises the same exceptions for any failure, is that
+    of a transient failure: a connection error, a timeout or a response
+    with a status worth retrying.'''
+    return any(transient in message for transient in _TRANSIENT_MESSAGES)
+
+
+def _resource_url(context, resource):
+    url = resource['url']
+    if (resource.get('resource_type') == 'file.upload' and
+            not url.startswith('http')):
+        url = context['site_url'].rstrip('/') + url
+    return url
+
+
+def _check_headers(context, resource, url, headers, max_content_length,
+                   data_formats):
+    '''Checks the size and format given in the headers of a resource, raising
+    ChooseNotToDownload if they are not acceptable.
+
+    Updates the resource mimetype and size from the headers, returns
+    whether they changed.
+    '''
+    resource_format = resource['format'].lower()
+    ct = _clean_content_type(headers.get('content-type', '').lower())
+    cl = headers.get('content-length')
+
+    resource_changed = False
+
+    if resource.get('mimetype') != ct:
+        resource_changed = True
+        resource['mimetype'] = ct
+
+    # this is to store the size in case there is an error, but the real size
+    # check is done after dowloading the data file, with its real length
+    if cl is not None and (resource.get('size') != cl):
+        resource_changed = True
+        resource['size'] = cl
+
+    # make sure resource content-length does not exceed our maximum
+    if cl and int(cl) >= max_content_length:
+        if resource_changed:
+            _update_resource(context, resource)
+        # record fact that resource is too large to archive
+        log.warning('Resource too large to download: %s > max (%s). '
+                    'Resource: %s %r', cl, max_content_length, resource['id'],
+                    url)
+        raise ChooseNotToDownload("Content-length %s exceeds maximum allowed "
+                                  "value %s" % (cl, max_content_length))
+
+    # check that resource is a data file
+    if data_formats != 'all' and not (resource_format in data_formats or
+                                      ct.lower() in data_formats):
+        if resource_changed:
+            _update_resource(context, resource)
+        log.warning('Resource wrong type to download: %s / %s. Resource: %s '
+                    '%r', resource_format, ct.lower(), resource['id'], url)
+        raise ChooseNotToDownload('Of content type "%s" which is not a '
+                                  'recognised data file for download' % ct)
+
+    return resource_changed
+
+
 def link_checker(context, data):
     """
     Check that the resource's url is valid, and accepts a HEAD request.
@@ -235,12 +506,52 @@ def link_checker(context, data):
     data = json.loads(data)
     url_timeout = data.get('url_timeout', 30)
 
-    error_message = ''
-    headers = {}
+    url = _check_url(data['url'])
+
+    # Send a head request
+    try:
+        res = requests.head(url, timeout=url_timeout)
+        headers = _lowercase_headers(res.headers)
+    except httplib.InvalidURL, ve:
+        log.warning("Could not make a head request to %r, error is: %s. "
+                    "Package is: %r. This sometimes happens when using an "
+                    "old version of requests on a URL which issues a 301 "
+                    "redirect. Version=%s", url, ve, data.get('package'),
+                    requests.__version__)
+        raise LinkHeadRequestError("Invalid URL or Redirect Link")
+    except ValueError, ve:
+        log.warning("Could not make a head request to %r, error is: %s. "
+                    "Package is: %r.", url, ve, data.get('package'))
+        raise LinkHeadRequestError("Could not make HEAD request")
+    except requests.exceptions.ConnectionError, e:
+        raise TransientLinkHeadRequestError('Connection error: %s' % e)
+    except requests.exceptions.HTTPError, e:
+        raise LinkHeadRequestError('Invalid HTTP response: %s' % e)
+    except requests.exceptions.Timeout, e:
+        raise TransientLinkHeadRequestError('Connection timed out after %ss'
+                                            % url_timeout)
+    except requests.exceptions.TooManyRedirects, e:
+        raise LinkHeadRequestError('Too many redirects')
+    except requests.exceptions.RequestException, e:
+        raise LinkHeadRequestError('Error during request: %s' % e)
+    except Exception, e:
+        raise LinkHeadRequestError('Error with the request: %s' % e)
+    else:
+        if not res.ok or res.status_code >= 400:
+            if is_transient_status(res.status_code):
+                raise TransientLinkHeadRequestError(
+                    _http_error_message(res.status_code))
+            raise LinkHeadRequestError(_http_error_message(res.status_code))
+    return json.dumps(headers)
 
+
+def _check_url(url):
+    """
+    Raises LinkInvalidError if the URL is invalid, returns it quoted as an
+    ascii string.
+    """
     # Find out if it has unicode characters, and if it does, quote them
     # so we are left with an ascii string
-    url = data['url']
     try:
         url = url.decode('ascii')
     except:
@@ -261,45 +572,7 @@ def link_checker(context, data):
     #       eg: ll.url (http://www.livinglogic.de/Python/url/Howto.html)?
     elif any(['/' in parsed_url.query, ':' in parsed_url.query]):
         raise LinkInvalidError("Invalid URL")
-    else:
-        # Send a head request
-        try:
-            res = requests.head(url, timeout=url_timeout)
-            headers = res.headers
-        except httplib.InvalidURL, ve:
-            log.warning("Could not make a head request to %r, error is: %s. "
-                        "Package is: %r. This sometimes happens when using an "
-                        "old version of requests on a URL which issues a 301 "
-                        "redirect. Version=%s", url, ve, data.get('package'),
-                        requests.__version__)
-            raise LinkHeadRequestError("Invalid URL or Redirect Link")
-        except ValueError, ve:
-            log.warning("Could not make a head request to %r, error is: %s. "
-                        "Package is: %r.", url, ve, data.get('package'))
-            raise LinkHeadRequestError("Could not make HEAD request")
-        except requests.exceptions.ConnectionError, e:
-            raise LinkHeadRequestError('Connection error: %s' % e)
-        except requests.exceptions.HTTPError, e:
-            raise LinkHeadRequestError('Invalid HTTP response: %s' % e)
-        except requests.exceptions.Timeout, e:
-            raise LinkHeadRequestError('Connection timed out after %ss'
-                                       % url_timeout)
-        except requests.exceptions.TooManyRedirects, e:
-            raise LinkHeadRequestError('Too many redirects')
-        except requests.exceptions.RequestException, e:
-            raise LinkHeadRequestError('Error during request: %s' % e)
-        except Exception, e:
-            raise LinkHeadRequestError('Error with the request: %s' % e)
-        else:
-            if not res.ok or res.status_code >= 400:
-                if res.status_code in HTTP_ERROR_CODES:
-                    error_message = ('Server returned error: %s'
-                                     % HTTP_ERROR_CODES[res.status_code])
-                else:
-                    error_message = ("URL unobtainable: Server returned "
-                                     "HTTP %s" % res.status_code)
-                raise LinkHeadRequestError(error_message)
-    return json.dumps(headers)
+    return url
 
 
 def _update_resource(context, resource):
@@ -307,18 +580,33 @@ def _update_resource(context, resource):
     Use CKAN API to update the given resource.
     Returns the content of the response.
 
+    When running outside of CKAN (e.g. in a celery task), the context has
+    no model and the resource is updated over HTTP instead.
     """
     resource['last_modified'] = datetime.now().isoformat()
     try:
-        logic.get_action('resource_update')(context, resource)
+        if 'model' in context:
+            logic.get_action('resource_update')(context, resource)
+        else:
+            client = get_client(context['site_url'], context['apikey'])
+            response = client.post('resource_update', resource)
+            response.raise_for_status()
     except Exception as e:
         log.exception(e)
         raise CkanError('ckan failed to update resource')
 
 
-def _save_resource(resource, response, max_file_size, chunk_size=1024*16):
+def _save_resource(resource, response, max_file_size, chunk_size=1024*16,
+                   path=None):
     """
-    Write the response content to disk.
+    Write the response content to disk, to a temporary file or to the given
+    path. If that file exists, the content is appended to it, and the
+    returned length and hash are those of the whole file.
+
+    The content is read from the (streamed) response one chunk at a time,
+    and the download is stopped as soon as ``max_file_size`` bytes were
+    written. If it fails, the temporary file is deleted, but the file at the
+    given path is kept so that the download can be resumed.
 
     Returns a tuple:
 
@@ -327,19 +615,106 @@ def _save_resource(resource, response, max_file_size, chunk_size=1024*16):
     resource_hash = hashlib.sha1()
     length = 0
 
-    fd, tmp_resource_file_path = tempfile.mkstemp()
+    if path is None:
+        fd, tmp_resource_file_path = tempfile.mkstemp()
+        os.close(fd)
+        mode = 'wb'
+    else:
+        tmp_resource_file_path = path
+        mode = 'ab'
+        if os.path.exists(path):
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(chunk_size), ''):
+                    length += len(chunk)
+                    resource_hash.update(chunk)
+
+    try:
+        with open(tmp_resource_file_path, mode) as fp:
+            for chunk in response.iter_content(chunk_size=chunk_size,
+                                               decode_unicode=False):
+                fp.write(chunk)
+                length += len(chunk)
+                resource_hash.update(chunk)
+
+                if length >= max_file_size:
+                    break
+    except:
+        if path is None:
+            os.remove(tmp_resource_file_path)
+        raise
+    finally:
+        # release the connection, the rest of the content is not read
+        response.close()
+
+    content_hash = unicode(resource_hash.hexdigest())
+    return length, content_hash, tmp_resource_file_path
+
+
+class HashingStream(object):
+    """
+    A file-like object that reads the content of a streamed response as it
+    arrives, computing its length and SHA1 hash on the way.
 
-    with open(tmp_resource_file_path, 'wb') as fp:
-        for chunk in response.iter_content(chunk_size=chunk_size,
-                                           decode_unicode=False):
-            fp.write(chunk)
-            length += len(chunk)
-            resource_hash.update(chunk)
+    Raises ChooseNotToDownload as soon as more than ``max_file_size`` bytes
+    have been read. ``on_complete`` is called with the stream once all the
+    content has been read.
+    """
 
-            if length >= max_file_size:
+    def __init__(self, response, max_file_size, on_complete=None,
+                 chunk_size=1024*16):
+        self.response = response
+        self.chunks = response.iter_content(chunk_size=chunk_size,
+                                            decode_unicode=False)
+        self.max_file_size = max_file_size
+        self.on_complete = on_complete
+        self.buffer = ''
+        self.length = 0
+        self.hash = hashlib.sha1()
+        self.complete = False
+
+    def _fill(self):
+        if self.complete:
+            return False
+        try:
+            chunk = self.chunks.next()
+        except StopIteration:
+            self.complete = True
+            if self.on_complete:
+                self.on_complete(self)
+            return False
+        self.length += len(chunk)
+        self.hash.update(chunk)
+        if self.length >= self.max_file_size:
+            self.close()
+            raise ChooseNotToDownload("Content-length after streaming "
+                                      "reached maximum allowed value of %s"
+                                      % self.max_file_size)
+        self.buffer += chunk
+        return True
+
+    def _take(self, size):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            if not self._fill():
                 break
+        if size < 0:
+            size = len(self.buffer)
+        return self._take(size)
 
-    os.close(fd)
+    def readline(self):
+        while '\n' not in self.buffer:
+            if not self._fill():
+                return self._take(len(self.buffer))
+        return self._take(self.buffer.index('\n') + 1)
 
-    content_hash = unicode(resource_hash.hexdigest())
-    return length, content_hash, tmp_resource_file_path
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def hexdigest(self):
+        return unicode(self.hash.hexdigest())
+
+    def close(self):
+        self.response.close()
@@ -0,0 +1,129 @@
+'''
+Column type guessing over a sample taken from the whole table.
+
+This gives the same results as messytables' strict ``type_guess`` on the
+same rows, but it works column by column, tests every distinct value only
+once, tries the narrowest types first and stops testing a type at its
+first failure, and recognises plain numbers with regular expressions
+instead of trying to cast them. That makes it fast enough to look at many
+more rows than the head of the table.
+'''
+import collections
+import itertools
+import random
+import re
+
+import messytables
+from messytables.types import StringType
+
+
+INTEGER_RE = re.compile(r'^[+-]?\d+$')
+NUMBER_RE = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+
+# values matching these are known to pass the test of the type
+FAST_TESTS = {
+    messytables.types.IntegerType: INTEGER_RE,
+    messytables.types.FloatType: NUMBER_RE,
+    messytables.types.DecimalType: NUMBER_RE,
+}
+
+
+def sample_rows(rows, head=1000, middle=1000, tail=1000, rand=random):
+    '''Reads all the rows and returns a sample of them: the first ``head``
+    rows, ``middle`` rows picked at random from the rest, and the last
+    ``tail`` rows.'''
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, head))
+    reservoir = []
+    last = collections.deque()
+    seen = 0
+    for row in rows:
+        if tail:
+            last.append(row)
+            if len(last) <= tail:
+                continue
+            row = last.popleft()
+        seen += 1
+        if len(reservoir) < middle:
+            reservoir.append(row)
+        else:
+            i = rand.randrange(seen)
+            if i < middle:
+                reservoir[i] = row
+    return sample + reservoir + list(last)
+
+
+def _guess_column(values, type_instances, min_confidence):
+    counts = collections.Counter(values)
+    total = len(values)
+    # number of values allowed not to match the type
+    allowed = round(total * (1 - min_confidence), 6)
+    for type in type_instances:
+        fast_test = FAST_TESTS.get(type.__class__)
+        failed = 0
+        for value, n in counts.iteritems():
+            if (fast_test and isinstance(value, basestring) and
+                    fast_test.match(value)):
+                continue
+            if not type.test(value):
+                failed += n
+                if failed > allowed:
+                    break
+        else:
+            return type, (total - failed) / float(total)
+    return StringType(), 1.0
+
+
+def _column_values(rows):
+    # the non-empty values of each column of the rows
+    columns = []
+    for row in rows:
+        for i, cell in enumerate(row):
+            if i == len(columns):
+                columns.append([])
+            if cell.value:
+                columns[i].append(cell.value)
+    return columns
+
+
+def guess_types(rows, types, min_confidence=1.0):
+    '''Guesses the type of each column of the rows (lists of cells).
+
+    Returns a list of (type, confidence) tuples, one per column, where the
+    type is the narrowest of ``types`` that at least ``min_confidence`` of
+    the non-empty values of the column can be cast to, and the confidence
+    is the share of those values that can actually be cast to it. Columns
+    with no values are strings.
+    '''
+    columns = _column_values(rows)
+    type_instances = sorted((i for t in types for i in t.instances()),
+                            key=lambda t: t.guessing_weight, reverse=True)
+    guesses = []
+    for values in columns:
+        if not values:
+            guesses.append((StringType(), 1.0))
+        else:
+            guesses.append(_guess_column(values, type_instances,
+                                         min_confidence))
+    return guesses
+
+
+def check_types(rows, types, min_confidence=1.0):
+    '''Checks that the rows (lists of cells) still fit the given types, one
+    per column, as guessed before.
+
+    Returns a list of booleans, one per type, telling whether at least
+    ``min_confidence`` of the non-empty values of its column can be cast to
+    it. Strings and columns with no values always fit.
+    '''
+    columns = _column_values(rows)
+    fits = []
+    for i, type in enumerate(types):
+        values = columns[i] if i < len(columns) else []
+        if not values or isinstance(type, StringType):
+            fits.append(True)
+        else:
+            guessed_type, confidence = _guess_column(values, [type],
+                                                     min_confidence)
+            fits.append(guessed_type is type)
+    return fits
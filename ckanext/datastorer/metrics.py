@@ -0,0 +1,211 @@
+'''
+Timing and throughput of the uploads.
+
+Each upload records, in an UploadMetrics, how long its stages took (e.g.
+"head", "download", "guess_types", "parse", "create_table" and "upload"),
+the number of bytes downloaded, of rows and batches loaded, the latency of
+the batches and the number of requests retried. Its ``summary`` is then
+logged as a structured record, kept in the task status of the resource,
+and sent to statsd if ``statsd_host`` is set, so that slow loads can be
+told apart (and a Prometheus server can scrape them through its statsd
+exporter).
+
+The stages overlap: rows are parsed as the previous batches are being
+sent, and streamed files are parsed as they are downloaded. "parse" is
+the time spent reading rows and "upload" the time from the first batch to
+the last one. When the rows are copied to the datastore database, the
+datastore_create request creating their table is timed as "create_table"
+(within "upload") rather than as a batch.
+'''
+import collections
+import contextlib
+import json
+import math
+import socket
+import threading
+import time
+
+from common import get_setting
+
+
+# The percentiles of the batch latencies in the summaries
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    '''Returns the p-th percentile (nearest rank) of the values, or None if
+    there are none.'''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class UploadMetrics(object):
+    '''
+    The metrics of the upload of a resource.
+
+    Batches and retries may be recorded from several threads.
+    '''
+
+    def __init__(self, resource_id):
+        self.resource_id = resource_id
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict(
+            (name, 0) for name in ('bytes_downloaded', 'rows', 'batches',
+                                   'retries'))
+        self.batch_seconds = []
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Adds the time spent in the block to the stage.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_batch(self, rows, seconds):
+        '''Records a batch of rows acknowledged by the datastore after the
+        given number of seconds.'''
+        with self._lock:
+            self.counters['rows'] += rows
+            self.counters['batches'] += 1
+            self.batch_seconds.append(seconds)
+
+    def retry(self, error=None):
+        '''Records a request sent again after failing with the given
+        error.'''
+        self.count('retries')
+
+    def timed(self, rows, stage='parse'):
+        '''Yields the rows, adding the time spent reading each of them to
+        the stage.'''
+        rows = iter(rows)
+        while True:
+            start = time.time()
+            try:
+                row = next(rows)
+            except StopIteration:
+                self.add_time(stage, time.time() - start)
+                return
+            self.add_time(stage, time.time() - start)
+            yield row
+
+    def summary(self):
+        '''Returns the metrics as a dict that can be encoded as JSON.'''
+        with self._lock:
+            elapsed = time.time() - self._start
+            summary = collections.OrderedDict([
+                ('resource_id', self.resource_id),
+                ('seconds', round(elapsed, 3)),
+                ('stages', collections.OrderedDict(
+                    (name, round(seconds, 3))
+                    for name, seconds in self.stages.iteritems())),
+            ])
+            summary.update(self.counters)
+            summary['rows_per_second'] = round(
+                self.counters['rows'] / elapsed if elapsed else 0, 1)
+            summary['batch_seconds'] = collections.OrderedDict(
+                ('p{0}'.format(p), percentile(self.batch_seconds, p))
+                for p in PERCENTILES)
+            summary['batch_seconds']['max'] = (max(self.batch_seconds)
+                                               if self.batch_seconds
+                                               else None)
+        return summary
+
+    def emit(self, logger, sink=None):
+        '''Logs the summary of the metrics as a structured record (with the
+        summary in its "datastorer_metrics" attribute), sends it to the
+        sink if one is given, and returns it.'''
+        summary = self.summary()
+        logger.info(u'Upload metrics: {0}'.format(json.dumps(summary)),
+                    extra={'datastorer_metrics': summary})
+        if sink is not None:
+            try:
+                export(summary, sink)
+            except Exception as e:
+                logger.warning(u'Could not send the upload metrics: '
+                               u'{0}'.format(e))
+        return summary
+
+
+def export(summary, sink):
+    '''Sends the metrics of the summary of an upload to the sink, as
+    timings (in milliseconds), counters and gauges.'''
+    for name, seconds in summary['stages'].iteritems():
+        sink.timing('stage.' + name, seconds * 1000)
+    sink.timing('total', summary['seconds'] * 1000)
+    for name in ('bytes_downloaded', 'rows', 'batches', 'retries'):
+        sink.incr(name, summary[name])
+    sink.gauge('rows_per_second', summary['rows_per_second'])
+    for name, seconds in summary['batch_seconds'].iteritems():
+        if seconds is not None:
+            sink.timing('batch_seconds.' + name, seconds * 1000)
+
+
+class MemorySink(object):
+    '''Keeps the metrics sent to it in ``metrics``, a list of (kind, name,
+    value) tuples, e.g. for tests.'''
+
+    def __init__(self):
+        self.metrics = []
+
+    def timing(self, name, milliseconds):
+        self.metrics.append(('timing', name, milliseconds))
+
+    def incr(self, name, n=1):
+        self.metrics.append(('incr', name, n))
+
+    def gauge(self, name, value):
+        self.metrics.append(('gauge', name, value))
+
+    def values(self, kind):
+        '''Returns the last value sent of each metric of the given kind.'''
+        return dict((name, value) for k, name, value in self.metrics
+                    if k == kind)
+
+
+class StatsdSink(object):
+    '''Sends the metrics to a statsd server over UDP, with their names
+    prefixed.'''
+
+    def __init__(self, host, port=8125, prefix='datastorer'):
+        self.address = (host, int(port))
+        self.prefix = prefix + '.' if prefix else ''
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind):
+        self.socket.sendto('{0}{1}:{2}|{3}'.format(self.prefix, name, value,
+                                                   kind), self.address)
+
+    def timing(self, name, milliseconds):
+        self._send(name, int(round(milliseconds)), 'ms')
+
+    def incr(self, name, n=1):
+        self._send(name, n, 'c')
+
+    def gauge(self, name, value):
+        self._send(name, value, 'g')
+
+
+def get_sink(context):
+    '''Returns the sink configured by the ``statsd_host`` (as "host" or
+    "host:port") and ``statsd_prefix`` options, or None.'''
+    address = get_setting(context, 'statsd_host')
+    if not address:
+        return None
+    host, _, port = address.partition(':')
+    return StatsdSink(host, port or 8125,
+                      get_setting(context, 'statsd_prefix'))
@@ -0,0 +1,244 @@
+'''
+Parsing of the files of resources: detection of the headers, guessing of
+the column types and conversion of the rows, shared by the celery task and
+the paster command.
+
+The settings are those of the task context or of the CKAN config, see
+``common.SETTINGS``.
+'''
+import datetime
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+
+import messytables
+from messytables import headers_guess, headers_processor, offset_processor
+from paste.deploy.converters import asbool
+
+from common import TYPES, get_setting
+from converter import RowConverter, cell_values
+from cache import get_cache
+import archives
+import inference
+
+
+# the types that columns can have, by name
+TYPE_NAMES = dict((t.__name__, t) for t in TYPES + [messytables.StringType])
+
+
+def datetime_procesor():
+    ''' Stringifies dates so that they can be parsed by the db
+    '''
+    def datetime_convert(row_set, row):
+        for cell in row:
+            if isinstance(cell.value, datetime.datetime):
+                cell.value = cell.value.isoformat()
+                cell.type = messytables.StringType()
+        return row
+    return datetime_convert
+
+
+def parse_resource(settings, f, content_type, resource, logger, sheet=None,
+                   content_hash=None):
+    '''Returns the rows of the resource (or of the given sheet of it),
+    converted to lists of values ready to be loaded, and the converter
+    holding its headers and guessed types.
+
+    If the content hash of the file is given, the schema of content that was
+    parsed before (for any resource) is re-used instead of being guessed
+    again, and so are its rows if they were kept. The content parsed least
+    recently is evicted from the cache when it grows over its size or age
+    bounds.
+
+    If the schema cache is enabled, the schema guessed for the resource is
+    kept, and the next time it is loaded its header offset, headers and
+    column types are re-used as long as the header row is the same and the
+    first rows still fit the types. Otherwise the types are guessed again,
+    but the columns that still fit their previous type keep it.
+    '''
+    def open_row_set():
+        return archives.open_table(f, content_type, resource['format'], sheet,
+                                   get_setting(settings, 'csv_engine'))
+
+    content_cache = None
+    if content_hash and asbool(get_setting(settings, 'content_cache')):
+        content_cache = get_cache(get_setting(settings, 'cache_dir'),
+                                  'content')
+        content_key = hashlib.sha1(json.dumps(
+            [content_hash, content_type, resource['format'].lower(),
+             sheet])).hexdigest()
+        cached = content_cache.get(content_key)
+        if cached and cached['settings'] == _guess_settings(settings):
+            logger.info('Re-using the schema of the same content parsed '
+                        'before.')
+            content_cache.touch(content_key)
+            content_cache.touch(content_key, '.rows.gz')
+            _prune(settings, content_cache)
+            converter = RowConverter(
+                cached['headers'],
+                [TYPE_NAMES[name]() for name in cached['types']],
+                lenient=cached['lenient'])
+            rows_path = content_cache.path(content_key, '.rows.gz')
+            if os.path.exists(rows_path):
+                logger.info('Re-using the rows of the same content.')
+                return _read_rows(rows_path), converter
+            rows = converter.rows(cell_values(open_row_set()),
+                                  cached['offset'] + 1)
+            return _keep_rows(settings, content_cache, content_key,
+                              rows), converter
+
+    # the schema guessed the last time the resource was loaded, re-used if
+    # its file still has the same header row
+    schema_cache = schema = None
+    if asbool(get_setting(settings, 'schema_cache')):
+        schema_cache = get_cache(get_setting(settings, 'cache_dir'),
+                                 'schemas')
+        schema_key = resource['id'] if not sheet else u'{0} {1}'.format(
+            resource['id'], sheet)
+        schema = schema_cache.get(schema_key)
+        if schema and schema['settings'] != _guess_settings(settings):
+            schema = None
+
+    row_set = open_row_set()
+    if schema:
+        header_row = next(itertools.islice(row_set.sample, schema['offset'],
+                                           None), None)
+        if (header_row is None or header_fingerprint(
+                [cell.value for cell in header_row]) !=
+                schema['fingerprint']):
+            logger.info('The header row changed since the last load.')
+            schema = None
+    if schema:
+        offset, headers = schema['offset'], schema['headers']
+    else:
+        offset, headers = headers_guess(row_set.sample)
+
+    def register_processors(row_set):
+        row_set.register_processor(headers_processor(headers))
+        row_set.register_processor(offset_processor(offset + 1))
+        row_set.register_processor(datetime_procesor())
+
+    register_processors(row_set)
+
+    logger.info('Header offset: {0}.'.format(offset))
+
+    min_confidence = float(get_setting(settings, 'type_min_confidence'))
+    guessed_types = None
+    if schema:
+        # a quick check of the first rows against the previous types
+        # rather than guessing them again over the whole table
+        previous_types = [TYPE_NAMES[name]() for name in schema['types']]
+        fits = inference.check_types(row_set.sample, previous_types,
+                                     min_confidence)
+        if all(fits):
+            logger.info('Re-using the types of the last load.')
+            guessed_types = previous_types
+
+    if guessed_types is None:
+        # guess the types from rows all over the table rather than from
+        # the first ones only, if the file can be read twice
+        sample = list(row_set.sample)
+        sample_middle = int(get_setting(settings, 'type_sample_middle'))
+        sample_tail = int(get_setting(settings, 'type_sample_tail'))
+        if (sample_middle or sample_tail) and hasattr(f, 'seek'):
+            sample = inference.sample_rows(
+                row_set, int(get_setting(settings, 'type_sample_head')),
+                sample_middle, sample_tail)
+            f.seek(0)
+            row_set = open_row_set()
+            register_processors(row_set)
+
+        guesses = inference.guess_types(sample, TYPES, min_confidence)
+        guessed_types = [guessed_type for guessed_type, confidence
+                         in guesses]
+        logger.info('Type confidences: {0}'.format(
+            [confidence for guessed_type, confidence in guesses]))
+        if schema:
+            # keep the previous types of the columns that still fit them,
+            # so that the datastore table doesn't change needlessly
+            fits = inference.check_types(sample, previous_types,
+                                         min_confidence)
+            guessed_types = [
+                previous if fit else guessed for previous, guessed, fit
+                in itertools.izip_longest(previous_types, guessed_types,
+                                          fits)
+                if guessed is not None]
+    logger.info('Guessed types: {0}'.format(guessed_types))
+    converter = RowConverter(headers, guessed_types,
+                             lenient=min_confidence < 1)
+    rows = converter.rows(cell_values(row_set), offset + 1)
+
+    type_names = [type(t).__name__ for t in guessed_types]
+    if schema_cache is not None:
+        schema_cache.set(schema_key, {
+            'settings': _guess_settings(settings),
+            'fingerprint': header_fingerprint(headers),
+            'offset': offset,
+            'headers': headers,
+            'types': type_names})
+    if content_cache is not None:
+        content_cache.set(content_key, {
+            'settings': _guess_settings(settings),
+            'offset': offset,
+            'headers': headers,
+            'types': type_names,
+            'lenient': converter.lenient})
+        _prune(settings, content_cache)
+        rows = _keep_rows(settings, content_cache, content_key, rows)
+    return rows, converter
+
+
+def header_fingerprint(headers):
+    '''Returns a hash of the values of a header row.'''
+    return hashlib.sha1(json.dumps(headers, default=unicode)).hexdigest()
+
+
+def _guess_settings(settings):
+    # the settings the guessed types depend on
+    return [unicode(get_setting(settings, key)) for key in
+            ('type_sample_head', 'type_sample_middle', 'type_sample_tail',
+             'type_min_confidence')]
+
+
+def _prune(settings, content_cache):
+    # the least recently used content is evicted to keep the cache bounded
+    content_cache.prune(
+        int(get_setting(settings, 'content_cache_max_size')),
+        int(get_setting(settings, 'content_cache_max_age')))
+
+
+def _keep_rows(settings, content_cache, content_key, rows):
+    if asbool(get_setting(settings, 'content_cache_rows')):
+        return _write_rows(content_cache.path(content_key, '.rows.gz'), rows)
+    return rows
+
+
+def _write_rows(path, rows):
+    '''Yields the rows, and writes them to the file at the given path once
+    they were all read.'''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    f = os.fdopen(fd, 'wb')
+    try:
+        out = gzip.GzipFile(fileobj=f, mode='wb')
+        for row in rows:
+            out.write(json.dumps(row) + '\n')
+            yield row
+        out.close()
+        f.close()
+        os.rename(tmp_path, path)
+    finally:
+        f.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _read_rows(path):
+    f = gzip.open(path, 'rb')
+    try:
+        for line in f:
+            yield json.loads(line)
+    finally:
+        f.close()
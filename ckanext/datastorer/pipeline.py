@@ -0,0 +1,82 @@
+import Queue
+import sys
+import threading
+
+
+_STOP = object()
+
+
+def upload_batches(batches, send, concurrency=4, max_pending=None):
+    '''Call ``send`` on every batch yielded by ``batches``.
+
+    Batches are produced in the calling thread while a pool of
+    ``concurrency`` threads sends the previous ones, so parsing and the
+    HTTP round-trips overlap. At most ``max_pending`` batches (twice the
+    concurrency by default) wait in the queue, which keeps memory bounded
+    when the senders are slower than the parser.
+
+    Batches are not necessarily sent in order. If producing or sending
+    any batch fails, no further batches are sent and the first exception
+    is re-raised in the calling thread once all the senders have stopped.
+
+    Returns the number of batches sent.
+    '''
+    if concurrency <= 1:
+        sent = 0
+        for batch in batches:
+            send(batch)
+            sent += 1
+        return sent
+
+    if not max_pending:
+        max_pending = concurrency * 2
+
+    pending = Queue.Queue(max_pending)
+    failed = threading.Event()
+    errors = []
+    sent = [0]
+    lock = threading.Lock()
+
+    def sender():
+        while True:
+            batch = pending.get()
+            try:
+                if batch is _STOP:
+                    return
+                # keep draining the queue after a failure so that the
+                # producer never blocks, but don't send anything else
+                if failed.is_set():
+                    continue
+                send(batch)
+                with lock:
+                    sent[0] += 1
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+                failed.set()
+            finally:
+                pending.task_done()
+
+    senders = [threading.Thread(target=sender) for i in range(concurrency)]
+    for thread in senders:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for batch in batches:
+            if failed.is_set():
+                break
+            pending.put(batch)
+    except:
+        failed.set()
+        raise
+    finally:
+        for thread in senders:
+            pending.put(_STOP)
+        for thread in senders:
+            thread.join()
+
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return sent[0]
@@ -1,16 +1,15 @@
 from pylons import config
 from ckan import model
-from ckan.model.types import make_uuid
 from ckan.plugins import (SingletonPlugin, implements,
                           IDomainObjectModification,
                           IResourceUrlChange, IConfigurable)
 from ckan.logic import get_action
-from ckan.lib.celery_app import celery
 import ckan.lib.helpers as h
 from ckan.lib.dictization.model_dictize import resource_dictize
-import json
-from datetime import datetime
 from logging import getLogger
+from common import get_settings
+import scheduling
+import sheets
 
 
 logger = getLogger('ckanext_datastorer')
@@ -28,6 +27,10 @@ class DatastorerPlugin(SingletonPlugin):
     def notify(self, entity, operation=None):
         if not isinstance(entity, model.Resource):
             return
+        # staging and sheet resources are loaded by the task that created
+        # them
+        if sheets.is_derived(entity.extras):
+            return
         if operation:
             if operation == model.domain_object.DomainObjectOperation.new:
                 self._create_datastorer_task(entity)
@@ -47,29 +50,21 @@ class DatastorerPlugin(SingletonPlugin):
                                             'ignore_auth': True,
                                             'defer_commit': True}, {})
 
-        context = json.dumps({
+        context = {
             'site_url': self._get_site_url(),
             'apikey': user.get('apikey'),
             'site_user_apikey': user.get('apikey'),
             'username': user.get('name'),
-        })
-        data = json.dumps(resource_dictize(resource, {'model': model}))
-
-        task_id = make_uuid()
-        datastorer_task_status = {
-            'entity_id': resource.id,
-            'entity_type': u'resource',
-            'task_type': u'datastorer',
-            'key': u'celery_task_id',
-            'value': task_id,
-            'last_updated': datetime.now().isoformat()
         }
+        context.update(get_settings(config))
+        data = resource_dictize(resource, {'model': model})
+
         archiver_task_context = {
             'model': model,
             'user': user.get('name'),
         }
-        get_action('task_status_update')(archiver_task_context,
-                                         datastorer_task_status)
-        celery.send_task("datastorer.upload",
-                         args=[context, data],
-                         task_id=task_id)
+        scheduling.queue_upload(
+            context, data,
+            lambda status: get_action('task_status_update')(
+                archiver_task_context, status),
+            scheduling.UI)
@@ -0,0 +1,115 @@
+'''
+The retry policy of the uploads.
+
+Failures are either transient, e.g. a connection error, a timeout or a 5xx
+response from the datastore, which may not happen again if the request is
+sent again, or permanent, e.g. a 4xx response, or a file that can't be
+parsed or whose values don't fit the types of its columns, which would
+fail the same way every time.
+
+Requests that are safe to send twice (e.g. an upsert keyed on a primary
+key) are sent again after any transient error, with an exponential backoff
+with jitter, before failing the upload. The others, such as the batches of
+rows inserted with datastore_create, are only sent again when they were
+certainly not processed: the connection could not be made, or the
+datastore answered 429 or 503. A timeout or a dropped connection may come
+after the rows were written, and sending them again could load them twice.
+
+An upload that still fails with a transient error is retried as a whole
+later, with the same backoff, and one that fails with a permanent error
+fails at once.
+'''
+import random
+import socket
+import time
+
+import requests
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+
+
+# The status codes of the responses worth sending the request again for
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# The status codes of the responses to requests that were not processed
+UNPROCESSED_STATUS_CODES = (429, 503)
+
+
+class TransientError(Exception):
+    '''An error that may not happen again if the request is retried.'''
+    pass
+
+
+class UnprocessedError(TransientError):
+    '''A transient error of a request that was certainly not processed, so
+    that it can be sent again even if it isn't idempotent.'''
+    pass
+
+
+def is_transient_status(status_code):
+    '''Whether a response with the given status code (or none at all) is
+    worth retrying.'''
+    return not status_code or status_code in TRANSIENT_STATUS_CODES
+
+
+def is_transient(error):
+    '''Whether the error is transient, all the others being permanent.'''
+    if isinstance(error, TransientError):
+        return True
+    if isinstance(error, (requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout,
+                          requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError):
+        response = error.response
+        return response is not None and is_transient_status(
+            response.status_code)
+    return isinstance(error, socket.error)
+
+
+def is_unprocessed(error):
+    '''Whether the error certainly happened before the request was
+    processed: UnprocessedError, or a failure to connect.'''
+    if isinstance(error, UnprocessedError):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        # the MaxRetryError of urllib3 has the error that made the request
+        # fail as its reason, NewConnectionError being a ConnectTimeoutError
+        reason = getattr(error.args[0] if error.args else None, 'reason',
+                         None)
+        return isinstance(reason, ConnectTimeoutError)
+    return False
+
+
+def backoff_delay(attempt, base_delay, max_delay, rand=random):
+    '''Returns the number of seconds to wait before the given retry (from
+    0): a random delay (the "full jitter" of the backoff, so that workers
+    that failed together don't retry together) of up to ``base_delay``
+    doubled at each attempt, and never more than ``max_delay``.'''
+    return rand.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_retries(func, retries, base_delay, max_delay, logger=None,
+                      sleep=time.sleep, rand=random, on_retry=None,
+                      retry_if=is_transient):
+    '''Calls ``func`` until it doesn't fail with an error for which
+    ``retry_if`` is true (by default, a transient error), at most
+    ``retries`` times more, and returns what it returns. The other errors,
+    and the error of the last attempt, are raised.
+
+    ``on_retry`` is called with the error before each retry.'''
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= retries or not retry_if(e):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay, rand)
+            if logger:
+                logger.warning(u'{0}: {1}, retrying in {2:.1f}s.'.format(
+                    e.__class__.__name__, e, delay))
+            if on_retry:
+                on_retry(e)
+            sleep(delay)
+            attempt += 1
+
@@ -0,0 +1,146 @@
+'''
+Queuing of the datastorer.upload tasks.
+
+The id of the latest task queued for a resource is kept in its
+"celery_task_id" task status, and a task that finds that a later one was
+queued for its resource since does nothing, as the later task loads the
+resource anyway. Tasks can also be held back for ``queue_delay`` seconds,
+so that all the requests made for a resource within that delay (e.g. by a
+harvester updating it several times) end up as a single load.
+
+The tasks record whether they are running, complete or failed in the
+separate "upload_state" task status of their resource, so that a task
+finishing never overwrites the id of a task queued while it was running,
+which still has to load the latest changes.
+
+Tasks are sent to the celery queue configured for their origin and size
+(see ``route``), so that large files and bulk loads don't hold back the
+uploads users are waiting for. Workers have to consume these queues, e.g.
+with ``celeryd -Q``.
+'''
+import datetime
+import json
+import uuid
+
+from common import get_setting
+
+
+TASK_TYPE = u'datastorer'
+TASK_KEY = u'celery_task_id'
+STATE_KEY = u'upload_state'
+METRICS_KEY = u'upload_metrics'
+
+# The origins of the tasks: changes made to resources in CKAN, and the queue
+# paster command
+UI = u'ui'
+BULK = u'bulk'
+
+
+def task_status(resource_id, task_id, state=u'pending'):
+    '''Returns the task status recording the task queued for the
+    resource.'''
+    return {
+        'entity_id': resource_id,
+        'entity_type': u'resource',
+        'task_type': TASK_TYPE,
+        'key': TASK_KEY,
+        'value': task_id,
+        'state': state,
+        'last_updated': datetime.datetime.now().isoformat()
+    }
+
+
+def state_status(resource_id, task_id, state, error=None):
+    '''Returns the task status recording the state of the task loading the
+    resource, which leaves the id of the latest task queued for it
+    alone.'''
+    status = {
+        'entity_id': resource_id,
+        'entity_type': u'resource',
+        'task_type': TASK_TYPE,
+        'key': STATE_KEY,
+        'value': task_id,
+        'state': state,
+        'last_updated': datetime.datetime.now().isoformat()
+    }
+    if error is not None:
+        status['error'] = error
+    return status
+
+
+def metrics_status(resource_id, summary):
+    '''Returns the task status keeping the summary of the metrics of the
+    latest upload of the resource (see ``metrics``).'''
+    return {
+        'entity_id': resource_id,
+        'entity_type': u'resource',
+        'task_type': TASK_TYPE,
+        'key': METRICS_KEY,
+        'value': json.dumps(summary),
+        'state': u'complete',
+        'last_updated': datetime.datetime.now().isoformat()
+    }
+
+
+def is_superseded(latest_status, task_id):
+    '''Whether the task was superseded by a later one, according to the
+    latest task status of its resource (or None if it has none).'''
+    return bool(latest_status and latest_status.get('value') and
+                latest_status['value'] != task_id)
+
+
+def _size(resource):
+    try:
+        return int(resource.get('size'))
+    except (TypeError, ValueError):
+        return None
+
+
+def route(context, resource):
+    '''Returns the name of the celery queue to send the upload of the
+    resource to, or None for the default one.
+
+    Tasks queued by the queue command go to the ``bulk_queue``, the others
+    to the ``large_queue`` if the size of their resource (as last seen in
+    its Content-Length header) is at least ``large_resource_size`` bytes,
+    and to the ``queue`` otherwise, if these are set.
+    '''
+    if context.get('origin') == BULK and get_setting(context, 'bulk_queue'):
+        return get_setting(context, 'bulk_queue')
+    size = _size(resource)
+    if (size is not None and get_setting(context, 'large_queue') and
+            size >= int(get_setting(context, 'large_resource_size'))):
+        return get_setting(context, 'large_queue')
+    return get_setting(context, 'queue') or None
+
+
+def send_upload(context, resource, task_id):
+    '''Sends the datastorer.upload task for the resource to its queue, to be
+    run after the configured ``queue_delay``.'''
+    # imported here so that the CKAN config is loaded first by the commands
+    from ckan.lib.celery_app import celery
+    delay = int(get_setting(context, 'queue_delay'))
+    options = {}
+    queue = route(context, resource)
+    if queue:
+        options['queue'] = queue
+    celery.send_task('datastorer.upload',
+                     args=[json.dumps(context), json.dumps(resource)],
+                     task_id=task_id, countdown=delay or None, **options)
+
+
+def queue_upload(context, resource, save_task_status, origin=None):
+    '''Queues the upload of the resource, superseding any task already
+    queued for it, and returns the id of the new task.
+
+    ``save_task_status`` is called with the task status to record before
+    the task is sent. The ``origin`` of the task (UI or BULK) is kept in
+    its context, so that the tasks it queues in turn (e.g. for the sheets
+    of a workbook) have the same.
+    '''
+    if origin is not None:
+        context = dict(context, origin=origin)
+    task_id = unicode(uuid.uuid4())
+    save_task_status(task_status(resource['id'], task_id))
+    send_upload(context, resource, task_id)
+    return task_id
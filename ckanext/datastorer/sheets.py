@@ -0,0 +1,83 @@
+'''
+Loading all the sheets of a workbook.
+
+The first selected sheet is loaded into the datastore table of the resource
+itself, and each of the others into the table of a resource created for it
+in the same dataset. The ``datastorer_sheet`` field of a sheet resource
+names its sheet and its ``datastorer_sheet_of`` field the resource of the
+workbook. Sheet resources are loaded separately from their workbook, so
+that the sheets are parsed and uploaded in parallel.
+
+The tables of a zip archive are loaded the same way (see ``archives``).
+'''
+import fnmatch
+
+
+# Formats that can have several sheets
+SPREADSHEET_FORMATS = [
+    'xls',
+    'xlsx',
+    'application/ms-excel',
+    'application/vnd.ms-excel',
+    'application/xls',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+]
+
+
+def is_spreadsheet(resource, content_type):
+    return (content_type in SPREADSHEET_FORMATS or
+            resource.get('format', '').lower() in SPREADSHEET_FORMATS)
+
+
+def select_sheets(names, selection):
+    '''Returns the names of the sheets to load, in the workbook order.
+
+    ``selection`` is "all", "first" or a comma separated list of sheet
+    names or shell-style patterns (e.g. "*.csv").
+    '''
+    if selection == 'all':
+        return list(names)
+    if selection == 'first':
+        return list(names[:1])
+    patterns = [pattern.strip() for pattern in selection.split(',')]
+    return [name for name in names
+            if any(name == pattern or fnmatch.fnmatchcase(name, pattern)
+                   for pattern in patterns)]
+
+
+def find_table(table_set, name=None):
+    '''Returns the row set of the named sheet, or the first one.'''
+    tables = table_set.tables
+    if name is None:
+        return tables[0]
+    for table in tables:
+        if getattr(table, 'name', None) == name:
+            return table
+    raise ValueError(u'Sheet not found: {0}'.format(name))
+
+
+def sheet_resources(package, resource):
+    '''Returns the sheet resources of the resource, by sheet name.'''
+    return dict((r['datastorer_sheet'], r)
+                for r in package.get('resources', [])
+                if r.get('datastorer_sheet_of') == resource['id'])
+
+
+def new_sheet_resource(resource, name):
+    '''Returns the resource to create for a sheet of the resource.'''
+    return {
+        'package_id': resource['package_id'],
+        'url': resource['url'],
+        'format': resource.get('format', ''),
+        'name': u'{0} - {1}'.format(resource.get('name') or resource['id'],
+                                    name),
+        'datastorer_sheet_of': resource['id'],
+        'datastorer_sheet': name,
+    }
+
+
+def is_derived(resource):
+    '''Whether the resource was created by the datastorer for another one,
+    which loads it.'''
+    return bool(resource.get('datastorer_staging_for') or
+                resource.get('datastorer_sheet_of'))
@@ -1,17 +1,32 @@
 import json
+import os
 import requests
 import datetime
-import itertools
+import shutil
+import tempfile
+import time
 
 import locale
 
-import messytables
-from messytables import (any_tableset, types_processor,
-                         headers_guess, headers_processor, headers_make_unique,
-                         type_guess, offset_processor)
-from ckanext.archiver.tasks import download, update_task_status
+from ckanext.archiver.tasks import (download, update_task_status,
+                                    DownloadError, LinkCheckerError)
 from ckan.lib.celery_app import celery
-from common import DATA_FORMATS, TYPE_MAPPING
+from paste.deploy.converters import asbool
+from common import DATA_FORMATS, DELIMITED_FORMATS, TYPE_MAPPING, get_setting
+import fetch_resource
+from pipeline import upload_batches
+from batching import AdaptiveBatcher
+from client import get_client
+import datastore_db
+import delta
+import sheets
+import archives
+import scheduling
+import retries
+from metrics import UploadMetrics, get_sink
+from parsing import parse_resource
+from cache import get_cache
+from checkpoint import Checkpoint, file_hash
 
 if not locale.getlocale()[0]:
     locale.setlocale(locale.LC_ALL, '')
@@ -33,167 +48,537 @@ def get_response_error(response):
     return repr(response) + "\n" + json.dumps(d, sort_keys=True, indent=4) + "\n"
 
 
-def check_response_and_retry(response, datastore_create_request_url, logger):
-    try:
-        if not response.status_code:
-            raise DatastorerException('Datastore is not reponding at %s with '
-                    'response %s' % (datastore_create_request_url, response))
-    except Exception, e:
-        datastorer_upload.retry(exc=e)
+def check_response(response, url, logger):
+    '''Raises TransientError if the datastore didn't respond or failed with
+    a status worth retrying (UnprocessedError if it didn't process the
+    request), or DatastorerException if it rejected the request.'''
+    if response.status_code in retries.UNPROCESSED_STATUS_CODES:
+        raise retries.UnprocessedError(
+            'Datastore is not processing requests at %s with response %s' %
+            (url, response))
+    if retries.is_transient_status(response.status_code):
+        raise retries.TransientError(
+            'Datastore is not responding at %s with response %s' %
+            (url, response))
 
     if response.status_code not in (201, 200):
         logger.error('Response was {0}'.format(get_response_error(response)))
         raise DatastorerException('Datastorer bad response code (%s) on %s. Response was %s' %
-                (response.status_code, datastore_create_request_url, response))
-
-
-def stringify_processor():
-    def to_string(row_set, row):
-        for cell in row:
-            if cell.value is None:
-                continue
-            else:
-                cell.value = unicode(cell.value)
-        return row
-    return to_string
-
-
-def datetime_procesor():
-    ''' Stringifies dates so that they can be parsed by the db
-    '''
-    def datetime_convert(row_set, row):
-        for cell in row:
-            if isinstance(cell.value, datetime.datetime):
-                cell.value = cell.value.isoformat()
-                cell.type = messytables.StringType()
-        return row
-    return datetime_convert
-
-
-@celery.task(name="datastorer.upload", max_retries=24 * 7,
-             default_retry_delay=3600)
+                (response.status_code, url, response))
+
+
+def post_with_retries(context, client, action, data, logger, metrics=None,
+                      idempotent=False):
+    '''Posts to the action and checks its response, sending the request
+    again after a backoff if it fails with a transient error, and returns
+    the response. The retries are counted in the metrics, if given.
+
+    Unless the request is ``idempotent``, it is only sent again if it was
+    certainly not processed, so that rows are never inserted twice.'''
+    def post():
+        response = client.post(action, data)
+        check_response(response, client.url(action), logger)
+        return response
+    return retries.call_with_retries(
+        post, int(get_setting(context, 'batch_retries')),
+        float(get_setting(context, 'retry_delay')),
+        float(get_setting(context, 'max_retry_delay')), logger,
+        on_retry=metrics and metrics.retry,
+        retry_if=(retries.is_transient if idempotent
+                  else retries.is_unprocessed))
+
+
+# the retries are limited by the task_retries setting instead
+@celery.task(name="datastorer.upload", max_retries=None)
 def datastorer_upload(context, data):
     logger = datastorer_upload.get_logger()
+    task_id = unicode(datastorer_upload.request.id)
     try:
         data = json.loads(data)
         context = json.loads(context)
-        return _datastorer_upload(context, data, logger)
+        # a later task loads the resource anyway
+        if scheduling.is_superseded(
+                _latest_task_status(context, data['id'], logger), task_id):
+            logger.info('Skipping resource {0}, another upload was queued '
+                        'since.'.format(data['id']))
+            return
+        update_task_status(context, scheduling.state_status(
+            data['id'], task_id, u'running'), logger)
+        metrics = UploadMetrics(data['id'])
+        try:
+            result = _datastorer_upload(context, data, logger, metrics)
+        finally:
+            _record_metrics(context, metrics, logger)
+        update_task_status(context, scheduling.state_status(
+            data['id'], task_id, u'complete'), logger)
+        return result
     except Exception, e:
-        update_task_status(context, {
-            'entity_id': data['id'],
-            'entity_type': u'resource',
-            'task_type': 'datastorer',
-            'key': u'celery_task_id',
-            'value': unicode(datastorer_upload.request.id),
-            'error': '%s: %s' % (e.__class__.__name__,  unicode(e)),
-            'last_updated': datetime.datetime.now().isoformat()
-        }, logger)
+        # transient failures are retried later, the others are final
+        attempt = datastorer_upload.request.retries or 0
+        retry = (retries.is_transient(e) and
+                 attempt < int(get_setting(context, 'task_retries')))
+        status = scheduling.state_status(
+            data['id'], task_id, u'pending' if retry else u'error',
+            '%s: %s' % (e.__class__.__name__,  unicode(e)))
+        update_task_status(context, status, logger)
+        if retry:
+            countdown = retries.backoff_delay(
+                attempt, float(get_setting(context, 'task_retry_delay')),
+                float(get_setting(context, 'max_task_retry_delay')))
+            logger.warning('Upload of {0} failed, retrying in {1:.0f}s: '
+                           '{2}'.format(data['id'], countdown, status['error']))
+            datastorer_upload.retry(exc=e, countdown=countdown)
         raise
 
 
-def _datastorer_upload(context, resource, logger):
-    result = download(context, resource, data_formats=DATA_FORMATS)
+def _record_metrics(context, metrics, logger):
+    '''Logs the metrics of the upload, sends them to statsd if configured,
+    and keeps their summary in the "upload_metrics" task status of the
+    resource.'''
+    summary = metrics.emit(logger, get_sink(context))
+    try:
+        update_task_status(context, scheduling.metrics_status(
+            metrics.resource_id, summary), logger)
+    except Exception as e:
+        logger.warning('Could not save the upload metrics of {0}: {1}'
+                       .format(metrics.resource_id, e))
+
+
+def _open_resource(context, resource, logger, metrics):
+    '''Downloads the resource, returns the file to read it from and its
+    content type.
+
+    If enabled, CSV and TSV files are read as they are downloaded instead of
+    being saved to disk first.
+    '''
+    if asbool(get_setting(context, 'stream_parse')):
+        result = fetch_resource.open_resource(
+            context, resource,
+            int(get_setting(context, 'max_content_length')),
+            DATA_FORMATS,
+            head_request=asbool(get_setting(context, 'head_request')),
+            metrics=metrics)
+        content_type = result['headers'].get('content-type', '')\
+                                        .split(';', 1)[0]  # remove parameters
+        if ((content_type in DELIMITED_FORMATS or
+                resource['format'].lower() in DELIMITED_FORMATS) and
+                not archives.is_compressed(resource, content_type)):
+            logger.info('Parsing the resource as it is downloaded.')
+            return result['stream'], content_type
+        # spreadsheets and compressed files can't be parsed as a stream
+        f = tempfile.TemporaryFile()
+        shutil.copyfileobj(result['stream'], f)
+        f.seek(0)
+        return f, content_type
+
+    try:
+        result = download(context, resource, data_formats=DATA_FORMATS)
+    except (DownloadError, LinkCheckerError), e:
+        # the archiver raises the same errors for any failure, so the
+        # transient ones are told by their message, to be retried
+        if fetch_resource.is_transient_message(unicode(e)):
+            raise fetch_resource.TransientDownloadError(unicode(e))
+        raise
+    metrics.count('bytes_downloaded', os.path.getsize(result['saved_file']))
 
     content_type = result['headers'].get('content-type', '')\
                                     .split(';', 1)[0]  # remove parameters
 
-    f = open(result['saved_file'], 'rb')
-    table_sets = any_tableset(f, mimetype=content_type, extension=resource['format'].lower())
+    return open(result['saved_file'], 'rb'), content_type
 
-    ##only first sheet in xls for time being
-    row_set = table_sets.tables[0]
-    offset, headers = headers_guess(row_set.sample)
-    row_set.register_processor(headers_processor(headers))
-    row_set.register_processor(offset_processor(offset + 1))
-    row_set.register_processor(datetime_procesor())
 
-    logger.info('Header offset: {0}.'.format(offset))
+def _datastorer_upload(context, resource, logger, metrics):
+    with metrics.stage('download'):
+        f, content_type = _open_resource(context, resource, logger, metrics)
 
-    guessed_types = type_guess(
-        row_set.sample,
-        [
-            messytables.types.StringType,
-            messytables.types.IntegerType,
-            messytables.types.FloatType,
-            messytables.types.DecimalType,
-            messytables.types.DateUtilType
-        ],
-        strict=True
-    )
-    logger.info('Guessed types: {0}'.format(guessed_types))
-    row_set.register_processor(types_processor(guessed_types, strict=True))
-    row_set.register_processor(stringify_processor())
+    # a load of the same content that failed can be resumed, and content
+    # that was parsed before doesn't need to be parsed again
+    content_hash = None
+    if hasattr(f, 'seek') and (
+            asbool(get_setting(context, 'resume_uploads')) or
+            asbool(get_setting(context, 'content_cache'))):
+        content_hash = file_hash(f)
 
-    ckan_url = context['site_url'].rstrip('/')
+    client = get_client(context['site_url'], context['apikey'],
+                        get_setting(context, 'http_pool_size'))
 
-    datastore_create_request_url = '%s/api/action/datastore_create' % (ckan_url)
+    # the other sheets of a workbook (or tables of an archive) are loaded by
+    # their own tasks
+    sheet = resource.get('datastorer_sheet')
+    if not sheet and (sheets.is_spreadsheet(resource, content_type) or
+                      hasattr(f, 'seek') and archives.is_archive(f)):
+        sheet = _queue_sheets(context, client, f, content_type, resource,
+                              logger)
 
-    guessed_type_names = [TYPE_MAPPING[type(gt)] for gt in guessed_types]
+    with metrics.stage('guess_types'):
+        rows, converter = parse_resource(context, f, content_type, resource,
+                                         logger, sheet, content_hash)
+    rows = metrics.timed(rows)
+
+    guessed_type_names = [TYPE_MAPPING[type(gt)] for gt in converter.types]
+    fields = [dict(id=name, type=typename) for name, typename in zip(converter.headers, guessed_type_names)]
+    primary_key = delta.primary_key(resource)
+
+    batcher = AdaptiveBatcher(
+        target_bytes=int(get_setting(context, 'batch_target_bytes')),
+        target_seconds=float(get_setting(context, 'batch_target_seconds')),
+        min_rows=int(get_setting(context, 'batch_min_rows')),
+        max_rows=int(get_setting(context, 'batch_max_rows')))
+
+    # the table the rows are loaded into, which is a staging table when
+    # swapping tables
+    table_id = resource['id']
 
     def send_request(data):
-        request = {'resource_id': resource['id'],
-                   'fields': [dict(id=name, type=typename) for name, typename in zip(headers, guessed_type_names)],
+        request = {'resource_id': table_id,
+                   'fields': fields,
                    'force': True,
-                   'records': data}
-        response = requests.post(datastore_create_request_url,
-                         data=json.dumps(request),
-                         headers={'Content-Type': 'application/json',
-                                  'Authorization': context['apikey']},
-                         )
-        check_response_and_retry(response, datastore_create_request_url, logger)
+                   'records': converter.dicts(data)}
+        if primary_key:
+            request['primary_key'] = primary_key
+        body = json.dumps(request)
+        start = time.time()
+        # creating the table without rows can be done twice
+        post_with_retries(context, client, 'datastore_create', body, logger,
+                          metrics, idempotent=not data)
+        seconds = time.time() - start
+        if data:
+            batcher.record(len(data), len(body), seconds)
+            metrics.record_batch(len(data), seconds)
+        else:
+            # the table created before copying the rows isn't a batch
+            metrics.add_time('create_table', seconds)
+
+    # Only load the rows that changed since the previous load, if possible
+    fingerprints_cache = None
+    fingerprints = None
+    if asbool(get_setting(context, 'incremental')):
+        fingerprints_cache = get_cache(get_setting(context, 'cache_dir'),
+                                       'fingerprints')
+        previous = delta.Fingerprints.load(fingerprints_cache, resource['id'])
+        if not previous or not previous.matches(fields, primary_key):
+            logger.info('No comparable previous load, loading all rows.')
+        elif not hasattr(f, 'seek'):
+            logger.info('Streamed resources are always loaded in full.')
+        else:
+            logger.info('Comparing with the previous load.')
+            with metrics.stage('compare'):
+                fingerprints, changes = delta.compare(previous, rows)
+            try:
+                if not changes.needs_reload:
+                    try:
+                        with metrics.stage('upload'):
+                            _apply_delta(context, client, resource,
+                                         converter, changes, batcher, logger,
+                                         metrics)
+                    except:
+                        # the datastore no longer matches the fingerprints
+                        fingerprints_cache.delete(resource['id'])
+                        raise
+                    fingerprints.save(fingerprints_cache, resource['id'])
+                    _mark_active(client, resource)
+                    return
+            finally:
+                changes.close()
+            logger.info('{0} rows were changed or removed, loading all rows.'
+                        .format(changes.removed))
+            f.seek(0)
+            with metrics.stage('guess_types'):
+                rows, converter = parse_resource(context, f, content_type,
+                                                 resource, logger, sheet,
+                                                 content_hash)
+            rows = metrics.timed(rows)
+
+    write_url = get_setting(context, 'direct_write_url')
+    staging = None
+    if asbool(get_setting(context, 'atomic_swap')):
+        if datastore_db.is_available(write_url):
+            staging = _create_staging_resource(client, resource, logger)
+            table_id = staging['id']
+        else:
+            logger.warning('Swapping tables needs direct_write_url and '
+                           'psycopg2, deleting the existing table instead.')
+
+    checkpoint = None
+    if (content_hash and asbool(get_setting(context, 'resume_uploads')) and
+            not staging and not datastore_db.is_available(write_url)):
+        checkpoint = Checkpoint.load(
+            get_cache(get_setting(context, 'cache_dir'), 'checkpoints'),
+            resource['id'], content_hash, fields)
+
+    if checkpoint and checkpoint.ranges:
+        logger.info('Resuming the previous load, {0} rows were already '
+                    'committed.'.format(checkpoint.committed_rows))
+    elif not staging:
+        _delete_datastore(client, resource['id'], logger)
+
+    logger.info('Creating: {0}.'.format(table_id))
+
+    # record the fingerprints of the rows for the next incremental load,
+    # unless they were already computed while comparing
+    recorder = None
+    if fingerprints_cache is not None and fingerprints is None:
+        fingerprints = recorder = delta.Fingerprints(fields, primary_key)
+
+    try:
+        with metrics.stage('upload'):
+            if datastore_db.is_available(write_url):
+                count = _copy_to_datastore(write_url, table_id,
+                                           converter.headers, rows,
+                                           send_request, logger, recorder)
+                metrics.count('rows', count)
+            else:
+                count = _send_to_datastore(context, rows, batcher,
+                                           send_request, recorder, checkpoint)
+
+        if staging:
+            logger.info('Swapping {0} into {1}.'.format(table_id,
+                                                        resource['id']))
+            with metrics.stage('swap'):
+                swapped = datastore_db.swap_tables(write_url, resource['id'],
+                                                   table_id)
+            if not swapped:
+                resource['datastore_active'] = True
+    finally:
+        # after the swap, the staging table holds the previous rows
+        if staging:
+            _delete_resource(client, staging, logger)
+
+    logger.info("There should be {n} entries in {res_id}.".format(n=count, res_id=resource['id']))
+
+    if checkpoint:
+        checkpoint.delete()
 
+    if fingerprints is not None:
+        fingerprints.save(fingerprints_cache, resource['id'])
+
+    _mark_active(client, resource)
+
+
+def _delete_datastore(client, resource_id, logger):
     # Delete any existing data before proceeding. Otherwise 'datastore_create' will
     # append to the existing datastore. And if the fields have significantly changed,
     # it may also fail.
     try:
-        logger.info('Deleting existing datastore (it may not exist): {0}.'.format(resource['id']))
-        response = requests.post('%s/api/action/datastore_delete' % (ckan_url),
-                                 data=json.dumps({'resource_id': resource['id'], 'force': True}),
-                        headers={'Content-Type': 'application/json',
-                                'Authorization': context['apikey']}
-                        )
+        logger.info('Deleting existing datastore (it may not exist): {0}.'.format(resource_id))
+        response = client.post('datastore_delete',
+                               {'resource_id': resource_id, 'force': True})
         if not response.status_code or response.status_code not in (200, 404):
             # skips 200 (OK) or 404 (datastore does not exist, no need to delete it)
             logger.error('Deleting existing datastore failed: {0}'.format(get_response_error(response)))
+            if retries.is_transient_status(response.status_code):
+                raise retries.TransientError("Deleting existing datastore failed.")
             raise DatastorerException("Deleting existing datastore failed.")
     except requests.exceptions.RequestException as e:
         logger.error('Deleting existing datastore failed: {0}'.format(str(e)))
+        if retries.is_transient(e):
+            raise retries.TransientError("Deleting existing datastore failed.")
         raise DatastorerException("Deleting existing datastore failed.")
 
-    logger.info('Creating: {0}.'.format(resource['id']))
-
-    # generates chunks of data that can be loaded into ckan
-    # n is the maximum size of a chunk
-    def chunky(iterable, n):
-        it = iter(iterable)
-        while True:
-            chunk = list(
-                itertools.imap(
-                    dict, itertools.islice(it, n)))
-            if not chunk:
-                return
-            yield chunk
-
-    count = 0
-    for data in chunky(row_set.dicts(), 100):
-        count += len(data)
-        send_request(data)
 
-    logger.info("There should be {n} entries in {res_id}.".format(n=count, res_id=resource['id']))
+def _create_staging_resource(client, resource, logger):
+    '''Creates a resource, next to the given one, whose datastore table the
+    rows are loaded into before being swapped with the table of the given
+    resource. The plugin doesn't upload staging resources.'''
+    response = client.post('resource_create', {
+        'package_id': resource['package_id'],
+        'url': resource['url'],
+        'format': resource.get('format', ''),
+        'name': u'{0} (loading)'.format(resource.get('name') or resource['id']),
+        'datastorer_staging_for': resource['id'],
+    })
+    if response.status_code not in (201, 200):
+        raise DatastorerException('Creating the staging resource failed: %s' %
+                                  get_response_error(response))
+    staging = json.loads(response.content)['result']
+    logger.info('Created staging resource {0}.'.format(staging['id']))
+    return staging
 
-    ckan_request_url = ckan_url + '/api/action/resource_update'
 
+def _delete_resource(client, resource, logger):
+    '''Deletes a resource created by the datastorer and its datastore
+    table.'''
+    try:
+        _delete_datastore(client, resource['id'], logger)
+        response = client.post('resource_delete', {'id': resource['id']})
+        if response.status_code not in (201, 200):
+            logger.error('Deleting the resource {0} failed: {1}'.format(
+                resource['id'], get_response_error(response)))
+    except Exception as e:
+        logger.error('Deleting the resource {0} failed: {1}'.format(
+            resource['id'], e))
+
+
+def _queue_sheets(context, client, f, content_type, resource, logger):
+    '''Queues the upload of the selected sheets of the workbook (or tables
+    of the zip archive) into their sheet resources, creating and deleting
+    sheet resources as needed, and returns the name of the sheet to load
+    into the resource itself.
+
+    The task of each sheet resource downloads the file again, as it may
+    run on another worker. When a single sheet is selected, or the resource
+    has no dataset, the sheet resources are left alone and the dataset is
+    not even looked up.'''
+    selection = get_setting(context, 'zip_tables' if archives.is_archive(f)
+                            else 'excel_sheets')
+    names = archives.table_names(f, content_type, resource['format'])
+    selected = sheets.select_sheets(names, selection)
+    if not selected:
+        logger.warning('None of the sheets {0} is selected, loading the '
+                       'first one.'.format(names))
+        selected = names[:1]
+    if len(selected) < 2:
+        return selected[0]
+    if not resource.get('package_id'):
+        logger.warning('Resource {0} has no dataset, only loading sheet '
+                       '{1}.'.format(resource['id'], selected[0]))
+        return selected[0]
+
+    response = client.post('package_show', {'id': resource['package_id']})
+    if response.status_code != 200:
+        raise DatastorerException('Getting the dataset failed: %s' %
+                                  get_response_error(response))
+    existing = sheets.sheet_resources(json.loads(response.content)['result'],
+                                      resource)
+
+    for name in selected[1:]:
+        sheet_resource = existing.pop(name, None)
+        if sheet_resource is None:
+            response = client.post('resource_create',
+                                   sheets.new_sheet_resource(resource, name))
+        elif sheet_resource['url'] != resource['url']:
+            sheet_resource['url'] = resource['url']
+            response = client.post('resource_update', sheet_resource)
+        else:
+            response = None
+        if response is not None:
+            if response.status_code not in (201, 200):
+                raise DatastorerException(
+                    'Saving the resource of sheet %s failed: %s' %
+                    (name, get_response_error(response)))
+            sheet_resource = json.loads(response.content)['result']
+        logger.info(u'Queuing sheet {0} into {1}.'.format(
+            name, sheet_resource['id']))
+        _queue_upload(context, sheet_resource, logger)
+
+    for name, sheet_resource in existing.iteritems():
+        logger.info(u'Deleting the resource of removed sheet {0}.'.format(
+            name))
+        _delete_resource(client, sheet_resource, logger)
+
+    return selected[0]
+
+
+def _queue_upload(context, resource, logger):
+    scheduling.queue_upload(
+        context, resource,
+        lambda status: update_task_status(context, status, logger))
+
+
+def _latest_task_status(context, resource_id, logger):
+    '''Returns the task status of the latest task queued for the resource,
+    or None if it can't be found.'''
+    client = get_client(context['site_url'], context['apikey'],
+                        get_setting(context, 'http_pool_size'))
+    response = client.post('task_status_show', {
+        'entity_id': resource_id,
+        'task_type': scheduling.TASK_TYPE,
+        'key': scheduling.TASK_KEY})
+    if response.status_code != 200:
+        if response.status_code != 404:
+            logger.warning('Getting the task status of resource {0} failed: '
+                           '{1}'.format(resource_id,
+                                        get_response_error(response)))
+        return None
+    return json.loads(response.content)['result']
+
+
+def _mark_active(client, resource):
     resource.update({
         'webstore_url': 'active',
         'webstore_last_updated': datetime.datetime.now().isoformat()
     })
 
-    response = requests.post(
-        ckan_request_url,
-        data=json.dumps(resource),
-        headers={'Content-Type': 'application/json',
-                 'Authorization': context['apikey']})
+    response = client.post('resource_update', resource)
 
     if response.status_code not in (201, 200):
         raise DatastorerException('Ckan bad response code (%s). Response was %s' %
                              (response.status_code, response.content))
+
+
+def _send_to_datastore(context, rows, batcher, send_request,
+                       fingerprints=None, checkpoint=None):
+    '''Sends the rows to datastore_create in batches, returns the number of
+    rows loaded.
+
+    If a checkpoint is given, the rows it holds as committed are skipped
+    and the rows of each batch sent are committed to it.'''
+    count = [0]
+    if fingerprints is not None:
+        rows = fingerprints.record(rows)
+
+    def indexed_rows():
+        for index, row in enumerate(rows):
+            count[0] = index + 1
+            yield index, row
+
+    pending = indexed_rows()
+    if checkpoint:
+        pending = checkpoint.pending(pending)
+
+    def send_batch(batch):
+        send_request([row for index, row in batch])
+        if checkpoint:
+            checkpoint.commit(index for index, row in batch)
+
+    # parse the next batches while the previous ones are being sent, the
+    # batch size follows the payload size and response times
+    upload_batches(batcher.batches(pending), send_batch,
+                   concurrency=int(get_setting(context, 'upload_concurrency')),
+                   max_pending=int(get_setting(context, 'upload_queue_size')))
+    return count[0]
+
+
+def _copy_to_datastore(write_url, table_id, headers, rows, send_request,
+                       logger, fingerprints=None):
+    '''Creates the datastore table with no records and then copies the rows
+    straight into its database, returns the number of rows copied.'''
+    send_request([])
+    logger.info('Copying rows directly to the datastore database.')
+    if fingerprints is not None:
+        rows = fingerprints.record(rows)
+    return datastore_db.copy_rows(write_url, table_id, headers, rows)
+
+
+def _apply_delta(context, client, resource, converter, changes, batcher,
+                 logger, metrics):
+    '''Deletes the removed rows and upserts the new and changed ones.'''
+    logger.info('Upserting {0} rows and deleting {1} rows in {2}.'.format(
+        changes.upsert_count, len(changes.deletes), resource['id']))
+
+    for filters in changes.deletes:
+        post_with_retries(context, client, 'datastore_delete',
+                          {'resource_id': resource['id'],
+                           'filters': filters,
+                           'force': True}, logger, metrics,
+                          idempotent=True)
+
+    method = 'upsert' if delta.primary_key(resource) else 'insert'
+
+    def send_upsert(data):
+        body = json.dumps({'resource_id': resource['id'],
+                           'records': converter.dicts(data),
+                           'method': method,
+                           'force': True})
+        start = time.time()
+        # upserting rows by their primary key twice updates them to the
+        # same values, inserting them twice would duplicate them
+        post_with_retries(context, client, 'datastore_upsert', body, logger,
+                          metrics, idempotent=method == 'upsert')
+        seconds = time.time() - start
+        batcher.record(len(data), len(body), seconds)
+        metrics.record_batch(len(data), seconds)
+
+    upload_batches(batcher.batches(changes.upserts()), send_upsert,
+                   concurrency=int(get_setting(context, 'upload_concurrency')),
+                   max_pending=int(get_setting(context, 'upload_queue_size')))
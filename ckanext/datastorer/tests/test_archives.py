@@ -0,0 +1,112 @@
+import bz2
+import gzip
+import logging
+import os
+import tempfile
+import zipfile
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.datastorer import archives, parsing
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+logger = logging.getLogger(__name__)
+
+
+def static(name):
+    with open(os.path.join(STATIC, name), 'rb') as f:
+        return f.read()
+
+
+def gzipped(content):
+    f = tempfile.TemporaryFile()
+    out = gzip.GzipFile(fileobj=f, mode='wb')
+    out.write(content)
+    out.close()
+    f.seek(0)
+    return f
+
+
+def zipped(members):
+    f = tempfile.TemporaryFile()
+    archive = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+    for name, content in members:
+        archive.writestr(name, content)
+    archive.close()
+    f.seek(0)
+    return f
+
+
+def rows(row_set):
+    return [[cell.value for cell in row] for row in row_set]
+
+
+class TestDecompressingFile(object):
+
+    def test_read(self):
+        content = static('october_2011.csv')
+        f = archives.DecompressingFile(gzipped(content), 'gzip',
+                                       chunk_size=100)
+        assert_equal(f.read(10), content[:10])
+        assert_equal(f.readline(), content[10:content.index('\n') + 1])
+        f.seek(0)
+        assert_equal(f.read(), content)
+        assert_equal(f.read(), '')
+
+    def test_several_streams(self):
+        f = tempfile.TemporaryFile()
+        f.write(bz2.compress('a,b\n1,2\n') + bz2.compress('3,4\n'))
+        f.seek(0)
+        assert_equal(archives.detect(f), 'bz2')
+        f = archives.DecompressingFile(f, 'bz2', chunk_size=7)
+        assert_equal(list(f), ['a,b\n', '1,2\n', '3,4\n'])
+
+
+class TestArchives(object):
+
+    def test_compressed_csv(self):
+        content = static('simple.csv')
+        expected = rows(archives.open_table(gzipped(content), 'text/csv',
+                                            'csv'))
+        f = gzipped(content)
+        assert_equal(archives.detect(f), 'gzip')
+        for extension in ('csv.gz', 'gz'):
+            assert_equal(rows(archives.open_table(f, 'application/gzip',
+                                                  extension)), expected)
+            f.seek(0)
+
+    def test_zip_tables(self):
+        f = zipped([('readme.txt.orig', 'not a table'),
+                    ('data/simple.csv', static('simple.csv')),
+                    ('simple.tsv', static('simple.tsv')),
+                    ('simple.xls', static('simple.xls'))])
+        assert archives.is_archive(f)
+        names = archives.table_names(f, 'application/zip', 'zip')
+        assert_equal(names[:2], [u'data/simple.csv', u'simple.tsv'])
+        assert names[2].startswith(u'simple.xls/')
+        expected = rows(archives.open_table(
+            open(os.path.join(STATIC, 'simple.csv'), 'rb'), 'text/csv',
+            'csv'))
+        assert_equal(rows(archives.open_table(f, 'application/zip', 'zip')),
+                     expected)
+        f.seek(0)
+        assert_equal(rows(archives.open_table(f, 'application/zip', 'zip',
+                                              u'simple.tsv')), expected)
+        f.seek(0)
+        assert rows(archives.open_table(f, 'application/zip', 'zip',
+                                        names[2]))
+        f.seek(0)
+        assert_raises(ValueError, archives.open_table, f, 'application/zip',
+                      'zip', u'missing.csv')
+
+    def test_parse_compressed(self):
+        content = static('october_2011.csv')
+        expected_rows, expected = parsing.parse_resource(
+            {}, open(os.path.join(STATIC, 'october_2011.csv'), 'rb'),
+            'text/csv', {'format': 'csv'}, logger)
+        settings = {'type_sample_tail': 10}
+        parsed_rows, converter = parsing.parse_resource(
+            settings, gzipped(content), 'application/x-gzip',
+            {'format': 'csv'}, logger)
+        assert_equal(converter.types, expected.types)
+        assert_equal(list(parsed_rows), list(expected_rows))
@@ -0,0 +1,38 @@
+from nose.tools import assert_equal
+
+from ckanext.datastorer.batching import AdaptiveBatcher
+
+
+class TestAdaptiveBatcher(object):
+
+    def test_initial_batches(self):
+        batcher = AdaptiveBatcher(min_rows=1, initial_rows=3)
+        batches = list(batcher.batches(range(7)))
+        assert_equal(batches, [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_grows_for_narrow_rows(self):
+        batcher = AdaptiveBatcher(target_bytes=100000, target_seconds=None,
+                                  initial_rows=100, max_rows=100000)
+        for i in range(10):
+            batcher.record(batcher.rows, batcher.rows * 10, 0.1)
+        assert_equal(batcher.rows, 10000)
+
+    def test_shrinks_for_wide_rows(self):
+        batcher = AdaptiveBatcher(target_bytes=100000, target_seconds=None,
+                                  initial_rows=100, min_rows=1)
+        batcher.record(100, 100 * 5000, 1)
+        assert_equal(batcher.rows, 20)
+
+    def test_shrinks_for_slow_responses(self):
+        batcher = AdaptiveBatcher(target_seconds=1, initial_rows=1000,
+                                  min_rows=1)
+        batcher.record(1000, 1000, 10)
+        assert_equal(batcher.rows, 100)
+
+    def test_limits(self):
+        batcher = AdaptiveBatcher(target_bytes=10, min_rows=5, max_rows=50)
+        batcher.record(100, 100000, 1)
+        assert_equal(batcher.rows, 5)
+        batcher = AdaptiveBatcher(min_rows=5, max_rows=50, initial_rows=40)
+        batcher.record(40, 40, 0.001)
+        assert_equal(batcher.rows, 50)
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import assert_equal
+
+from ckanext.datastorer.cache import FileCache
+
+
+class TestFileCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FileCache(self.directory + '/cache')
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_set_and_get(self):
+        assert_equal(self.cache.get('http://example.com/a', 1), 1)
+        self.cache.set('http://example.com/a', {'a': 1})
+        assert_equal(self.cache.get('http://example.com/a'), {'a': 1})
+        self.cache.delete('http://example.com/a')
+        assert_equal(self.cache.get('http://example.com/a'), None)
+
+    def test_lock(self):
+        lock = self.cache.lock('run')
+        assert lock is not None
+        # flock locks are held per open file
+        assert_equal(self.cache.lock('run'), None)
+        lock.close()
+        self.cache.lock('run').close()
+
+    def used(self, key, seconds_ago, extension='.json'):
+        when = time.time() - seconds_ago
+        os.utime(self.cache.path(key, extension), (when, when))
+
+    def test_prune(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, 'x' * 100)
+        with open(self.cache.path('a', '.rows.gz'), 'wb') as f:
+            f.write('x' * 100)
+        self.used('a', 30)
+        self.used('a', 30, '.rows.gz')
+        self.used('b', 20)
+        self.used('c', 10)
+        lock = self.cache.lock('run')
+
+        assert_equal(self.cache.prune(max_size=1000), 0)
+        # the least recently used keys go first, with all their files
+        assert_equal(self.cache.prune(max_size=250), 1)
+        assert_equal(self.cache.get('a'), None)
+        assert not os.path.exists(self.cache.path('a', '.rows.gz'))
+        assert self.cache.get('b')
+
+        # touching a key makes it the most recently used
+        self.cache.touch('b')
+        assert_equal(self.cache.prune(max_size=150), 1)
+        assert self.cache.get('b')
+        assert_equal(self.cache.get('c'), None)
+
+        self.used('b', 100)
+        assert_equal(self.cache.prune(max_age=50), 1)
+        assert_equal(self.cache.get('b'), None)
+        # locks are kept
+        assert os.path.exists(self.cache.path('run', '.lock'))
+        lock.close()
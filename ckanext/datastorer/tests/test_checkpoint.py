@@ -0,0 +1,50 @@
+import shutil
+import StringIO
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.datastorer import checkpoint
+from ckanext.datastorer.cache import FileCache
+
+FIELDS = [{'id': 'id', 'type': 'numeric'}]
+
+
+class TestCheckpoint(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FileCache(self.directory + '/checkpoints')
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_merge_ranges(self):
+        assert_equal(checkpoint.merge_ranges([[5, 6], [0, 2], [2, 3], [1, 2]]),
+                     [[0, 3], [5, 6]])
+
+    def test_resume(self):
+        first = checkpoint.Checkpoint.load(self.cache, 'res-id', u'hash',
+                                           FIELDS)
+        first.commit([3, 4])
+        first.commit([0, 1, 2])
+        first.commit([7])
+
+        resumed = checkpoint.Checkpoint.load(self.cache, 'res-id', u'hash',
+                                             FIELDS)
+        assert_equal(resumed.ranges, [[0, 5], [7, 8]])
+        assert_equal(resumed.committed_rows, 6)
+        assert_equal([i for i, row in resumed.pending(enumerate('abcdefghi'))],
+                     [5, 6, 8])
+
+        changed = checkpoint.Checkpoint.load(self.cache, 'res-id', u'other',
+                                             FIELDS)
+        assert_equal(changed.ranges, [])
+        resumed.delete()
+        assert_equal(self.cache.get('res-id'), None)
+
+    def test_file_hash(self):
+        f = StringIO.StringIO('abc')
+        assert_equal(checkpoint.file_hash(f),
+                     u'a9993e364706816aba3e25717850c26c9cd0d89d')
+        assert_equal(f.read(), 'abc')
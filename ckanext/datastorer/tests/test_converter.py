@@ -0,0 +1,70 @@
+import datetime
+import os
+
+from messytables import (any_tableset, headers_guess, headers_processor,
+                         offset_processor, type_guess, types_processor)
+from messytables.types import StringType, IntegerType, DateUtilType
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.datastorer.common import TYPES
+from ckanext.datastorer.converter import RowConverter, cell_values
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+
+def datetime_procesor():
+    # the processor of the tasks module, which can't be imported without
+    # the archiver
+    def datetime_convert(row_set, row):
+        for cell in row:
+            if isinstance(cell.value, datetime.datetime):
+                cell.value = cell.value.isoformat()
+        return row
+    return datetime_convert
+
+
+def row_set(name):
+    f = open(os.path.join(STATIC, name), 'rb')
+    extension = name.rsplit('.', 1)[1]
+    return any_tableset(f, extension=extension).tables[0]
+
+
+class TestRowConverter(object):
+
+    def test_same_as_processors(self):
+        for name in ('simple.csv', 'october_2011.csv', 'simple.xls',
+                     '3ffdcd42-5c63-4089-84dd-c23876259973.csv'):
+            processed = row_set(name)
+            offset, headers = headers_guess(processed.sample)
+            processed.register_processor(headers_processor(headers))
+            processed.register_processor(offset_processor(offset + 1))
+            processed.register_processor(datetime_procesor())
+            types = type_guess(processed.sample, TYPES, strict=True)
+            processed.register_processor(types_processor(types, strict=True))
+            expected = [dict((cell.column, None if cell.value is None
+                              else unicode(cell.value)) for cell in row)
+                        for row in processed]
+
+            converter = RowConverter(headers, types)
+            rows = converter.rows(cell_values(row_set(name)), offset + 1)
+            assert_equal(converter.dicts(rows), expected)
+
+    def test_convert(self):
+        converter = RowConverter([u'a', u'', u'c'],
+                                 [IntegerType(), StringType()])
+        assert_equal(converter.columns, [u'a', u'column_1', u'c'])
+        assert_equal(converter.convert(['1', 2, datetime.datetime(2012, 1, 1),
+                                        'extra']),
+                     [u'1', u'2', u'2012-01-01T00:00:00'])
+        assert_equal(converter.convert(['']), [None, None, None])
+
+    def test_dates(self):
+        converter = RowConverter([u'date'], [DateUtilType()])
+        assert_equal(converter.convert([datetime.datetime(2012, 1, 2, 3)]),
+                     [u'2012-01-02 03:00:00'])
+
+    def test_lenient(self):
+        assert_raises(ValueError,
+                      RowConverter([u'a'], [IntegerType()]).convert, ['x'])
+        converter = RowConverter([u'a'], [IntegerType()], lenient=True)
+        assert_equal(converter.convert(['x']), [None])
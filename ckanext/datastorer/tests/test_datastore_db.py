@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import ConfigParser
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+
+from ckanext.datastorer import datastore_db
+
+
+class TestCopyStream(object):
+
+    def test_escapes_values(self):
+        stream = datastore_db.CopyStream([
+            [u'a\tb', None, u'c\\d'],
+            [u'line\nbreak', u'\xe9', 3],
+        ])
+        assert_equal(stream.read(),
+                     'a\\tb\t\\N\tc\\\\d\n'
+                     'line\\nbreak\t\xc3\xa9\t3\n')
+        assert_equal(stream.count, 2)
+
+    def test_reads_in_chunks(self):
+        rows = [[unicode(i), u'x' * 10] for i in range(100)]
+        stream = datastore_db.CopyStream(rows)
+        chunks = []
+        while True:
+            chunk = stream.read(7)
+            if not chunk:
+                break
+            assert len(chunk) <= 7
+            chunks.append(chunk)
+        assert_equal(''.join(chunks),
+                     datastore_db.CopyStream(rows).read())
+
+
+class TestCopyRows(object):
+
+    @classmethod
+    def setup_class(cls):
+        config = ConfigParser.RawConfigParser({'datastore_write_url': ''})
+        config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'tests_config.cfg'))
+        cls.write_url = config.get('tests', 'datastore_write_url')
+        if not datastore_db.is_available(cls.write_url):
+            raise SkipTest('No datastore_write_url configured or psycopg2 '
+                           'is not installed')
+
+    def setup(self):
+        self.connection = datastore_db.psycopg2.connect(self.write_url)
+        cursor = self.connection.cursor()
+        cursor.execute('CREATE TABLE "copy-test" (_id serial PRIMARY KEY, '
+                       '_full_text tsvector, "name" text, "amount" numeric)')
+        self.connection.commit()
+
+    def teardown(self):
+        self.connection.rollback()
+        cursor = self.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS "copy-test", "copy-test-staging"')
+        self.connection.commit()
+        self.connection.close()
+
+    def test_copy_rows(self):
+        count = datastore_db.copy_rows(
+            self.write_url, 'copy-test', ['name', 'amount'],
+            [[u'caf\xe9\tbar', u'1.5'], [None, u'2'], [u'back\\slash', None]])
+        assert_equal(count, 3)
+
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT name, amount::text, _full_text IS NOT NULL '
+                       'FROM "copy-test" ORDER BY _id')
+        assert_equal(cursor.fetchall(), [('caf\xc3\xa9\tbar', '1.5', True),
+                                         (None, '2', True),
+                                         ('back\\slash', None, True)])
+
+    def test_swap_tables(self):
+        cursor = self.connection.cursor()
+        cursor.execute('INSERT INTO "copy-test" (name) VALUES (\'old\')')
+        cursor.execute('CREATE TABLE "copy-test-staging" (name text)')
+        cursor.execute('INSERT INTO "copy-test-staging" VALUES (\'new\')')
+        self.connection.commit()
+
+        assert datastore_db.swap_tables(self.write_url, 'copy-test',
+                                        'copy-test-staging')
+        cursor.execute('SELECT name FROM "copy-test"')
+        assert_equal(cursor.fetchall(), [('new',)])
+        cursor.execute('SELECT name FROM "copy-test-staging"')
+        assert_equal(cursor.fetchall(), [('old',)])
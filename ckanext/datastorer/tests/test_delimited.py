@@ -0,0 +1,112 @@
+import codecs
+import logging
+import os
+import tempfile
+
+from messytables import CSVTableSet
+from messytables.commas import CSVRowSet
+from nose.tools import assert_equal
+
+from ckanext.datastorer import delimited, parsing
+from ckanext.datastorer.converter import cell_values
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+logger = logging.getLogger(__name__)
+
+
+def temporary_file(content):
+    f = tempfile.TemporaryFile()
+    f.write(content)
+    f.seek(0)
+    return f
+
+
+def cells(row_set, sample=False):
+    return [[(cell.value, type(cell.value)) for cell in row]
+            for row in row_set.raw(sample)]
+
+
+class TestNativeEngine(object):
+
+    def assert_same_as_messytables(self, content, delimiter=None):
+        expected = delimited.csv_table_set(temporary_file(content),
+                                           delimiter=delimiter).tables[0]
+        row_set = delimited.csv_table_set(temporary_file(content),
+                                          delimiter=delimiter,
+                                          engine='native').tables[0]
+        assert isinstance(row_set, delimited.NativeCSVRowSet)
+        assert_equal(cells(row_set, sample=True),
+                     cells(expected, sample=True))
+        assert_equal(list(cell_values(row_set)), list(cell_values(expected)))
+
+    def test_static_files(self):
+        for name in ('october_2011.csv', 'bus-stops.csv', 'long.csv',
+                     'simple.ssv'):
+            with open(os.path.join(STATIC, name), 'rb') as f:
+                content = f.read()
+            self.assert_same_as_messytables(content)
+            # as read by messytables on its own
+            expected = CSVTableSet(temporary_file(content)).tables[0]
+            row_set = delimited.csv_table_set(temporary_file(content),
+                                              engine='native').tables[0]
+            assert_equal(list(cell_values(row_set)),
+                         list(cell_values(expected)))
+        with open(os.path.join(STATIC, 'simple.tsv'), 'rb') as f:
+            self.assert_same_as_messytables(f.read(), '\t')
+
+    def test_line_endings_and_quotes(self):
+        self.assert_same_as_messytables(
+            'a,b\r\n1,"x\r\ny"\r\n2,"z, ""w"""\r\n3,last')
+
+    def test_encodings(self):
+        self.assert_same_as_messytables(
+            codecs.BOM_UTF8 + u'na\xefve,b\n\xe9t\xe9,1\n'.encode('utf-8'))
+        self.assert_same_as_messytables(
+            u'caf\xe9,b\n'.encode('latin-1') + u'd\xe9j\xe0 vu,1\n'.encode(
+                'latin-1') * 10)
+
+    def test_invalid_bytes(self):
+        content = 'a,b\n' + '1,2\n' * 20000 + 'caf\xe9,3\n'
+        for engine in ('messytables', 'native'):
+            row_set = delimited.csv_table_set(temporary_file(content),
+                                              engine=engine).tables[0]
+            assert_equal(list(cell_values(row_set))[-1],
+                         [u'caf\ufffd', u'3'])
+
+    def test_fallback(self):
+        content = u'a,b\n1,2\n'.encode('utf-16')
+        row_set = delimited.csv_table_set(temporary_file(content),
+                                          engine='native').tables[0]
+        assert not isinstance(row_set, delimited.NativeCSVRowSet)
+        assert isinstance(row_set, CSVRowSet)
+        assert_equal(list(cell_values(row_set)), [[u'a', u'b'],
+                                                  [u'1', u'2']])
+        row_set = delimited.csv_table_set(temporary_file('a,b\r1,2\r'),
+                                          engine='native').tables[0]
+        assert not isinstance(row_set, delimited.NativeCSVRowSet)
+
+    def test_parse_resource(self):
+        path = os.path.join(STATIC, 'october_2011.csv')
+        expected_rows, expected = parsing.parse_resource(
+            {}, open(path, 'rb'), 'text/csv', {'format': 'csv'}, logger)
+        rows, converter = parsing.parse_resource(
+            {'csv_engine': 'native'}, open(path, 'rb'), 'text/csv',
+            {'format': 'csv'}, logger)
+        assert_equal(converter.headers, expected.headers)
+        assert_equal(converter.types, expected.types)
+        assert_equal(list(rows), list(expected_rows))
+
+
+class TestDetectEncoding(object):
+
+    def test_detect_encoding(self):
+        assert_equal(delimited.detect_encoding('a,b\n'), 'utf-8')
+        # the sample ends in the middle of a character
+        assert_equal(delimited.detect_encoding(
+            u'a,\xe9'.encode('utf-8')[:-1]), 'utf-8')
+        assert_equal(delimited.detect_encoding(
+            codecs.BOM_UTF8 + 'a,b\n'), 'utf-8-sig')
+        assert_equal(delimited.detect_encoding(
+            u'a,b\n'.encode('utf-16')), 'utf-16')
+        assert delimited.detect_encoding(
+            u'caf\xe9 d\xe9j\xe0 vu,b\n'.encode('latin-1') * 10) != 'utf-8'
@@ -0,0 +1,68 @@
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.datastorer import delta
+from ckanext.datastorer.cache import FileCache
+
+FIELDS = [{'id': 'id', 'type': 'numeric'}, {'id': 'name', 'type': 'text'}]
+
+
+def rows(*names):
+    return [[unicode(i), name] for i, name in enumerate(names)]
+
+
+def recorded(key, data):
+    fingerprints = delta.Fingerprints(FIELDS, key)
+    list(fingerprints.record(data))
+    return fingerprints
+
+
+class TestCompare(object):
+
+    def test_appended_rows(self):
+        previous = recorded(None, rows(u'a', u'b'))
+        current, changes = delta.compare(previous, rows(u'a', u'b', u'c'))
+        assert not changes.needs_reload
+        assert_equal(list(changes.upserts()), [[u'2', u'c']])
+        assert_equal(current.rows, recorded(None, rows(u'a', u'b', u'c')).rows)
+
+    def test_changed_rows_without_key(self):
+        previous = recorded(None, rows(u'a', u'b'))
+        current, changes = delta.compare(previous, rows(u'a', u'x'))
+        assert changes.needs_reload
+        assert_equal(changes.removed, 1)
+
+    def test_changed_rows_with_key(self):
+        previous = recorded(['id'], rows(u'a', u'b', u'c'))
+        current, changes = delta.compare(previous, rows(u'a', u'x'))
+        assert not changes.needs_reload
+        assert_equal(list(changes.upserts()), [[u'1', u'x']])
+        assert_equal(changes.deletes, [{'id': u'2'}])
+
+    def test_duplicate_key(self):
+        previous = recorded(['name'], rows(u'a'))
+        assert_raises(ValueError, delta.compare, previous, rows(u'a', u'a'))
+
+    def test_primary_key(self):
+        assert_equal(delta.primary_key({}), None)
+        assert_equal(delta.primary_key({'datastorer_primary_key': 'a, b'}),
+                     ['a', 'b'])
+
+
+class TestFingerprintsCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        cache = FileCache(self.directory + '/fingerprints')
+        assert_equal(delta.Fingerprints.load(cache, 'res-id'), None)
+        recorded(['id'], rows(u'a')).save(cache, 'res-id')
+        loaded = delta.Fingerprints.load(cache, 'res-id')
+        assert loaded.matches(FIELDS, ['id'])
+        assert not loaded.matches(FIELDS, None)
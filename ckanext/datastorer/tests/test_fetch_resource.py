@@ -0,0 +1,376 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import requests
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.datastorer import fetch_resource, parsing, retries
+from ckanext.datastorer.cache import get_cache
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+logger = logging.getLogger(__name__)
+
+
+def static(name):
+    with open(os.path.join(STATIC, name), 'rb') as f:
+        return f.read()
+
+
+class FakeResponse(object):
+    '''A streamed response, whose content is read in chunks of at most
+    ``chunk_size`` bytes, failing with ``error`` at the end if given.'''
+
+    def __init__(self, content='', status_code=200, headers=None,
+                 chunk_size=None, error=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.chunk_size = chunk_size
+        self.error = error
+        self.closed = False
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        chunk_size = self.chunk_size or chunk_size
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRequests(object):
+    '''Replaces requests.get and requests.head, answering with the given
+    responses in turn and keeping the headers of the requests.'''
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def __enter__(self):
+        self.get, self.head = requests.get, requests.head
+        requests.get = requests.head = self.send
+        return self
+
+    def __exit__(self, *args):
+        requests.get, requests.head = self.get, self.head
+
+    def send(self, url, timeout=None, headers=None, stream=False):
+        self.requests.append(headers or {})
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class TestHashingStream(object):
+
+    def test_read(self):
+        content = static('simple.csv')
+        completed = []
+        response = FakeResponse(content, chunk_size=7)
+        stream = fetch_resource.HashingStream(response, len(content) + 1,
+                                              completed.append)
+        assert_equal(stream.readline(), content[:content.index('\n') + 1])
+        assert not completed
+        assert_equal(stream.read(10), content[content.index('\n') + 1:][:10])
+        stream.read()
+        assert_equal(completed, [stream])
+        assert_equal(stream.length, len(content))
+        assert_equal(stream.hexdigest(), hashlib.sha1(content).hexdigest())
+
+    def test_max_file_size(self):
+        response = FakeResponse('a,b\n' * 100, chunk_size=40)
+        stream = fetch_resource.HashingStream(response, 100)
+        assert_equal(stream.read(4), 'a,b\n')
+        assert_raises(fetch_resource.ChooseNotToDownload, stream.read)
+        assert response.closed
+
+    def test_open_resource(self):
+        content = static('simple.csv')
+        resource = {'id': u'resource', 'format': 'csv',
+                    'url': u'http://example.com/simple.csv'}
+        response = FakeResponse(content, headers={
+            'Content-Type': 'text/csv', 'Last-Modified': 'yesterday'})
+        with FakeRequests(response):
+            result = fetch_resource.open_resource(
+                {}, resource, 1000000, ['csv'], head_request=False)
+        assert_equal(result['headers']['content-type'], 'text/csv')
+        assert_equal(result['stream'].read(), content)
+        # the size and hash are known once the content was read
+        assert_equal(resource['size'], unicode(len(content)))
+        assert_equal(json.loads(resource['hash']), {
+            'content': hashlib.sha1(content).hexdigest(),
+            'header': hashlib.sha1('yesterday').hexdigest()})
+
+    def test_parse_stream(self):
+        content = static('october_2011.csv')
+        resource = {'id': u'resource', 'format': 'csv'}
+        expected_rows, expected = parsing.parse_resource(
+            {}, open(os.path.join(STATIC, 'october_2011.csv'), 'rb'),
+            'text/csv', resource, logger)
+        stream = fetch_resource.HashingStream(
+            FakeResponse(content, chunk_size=1000), len(content) + 1)
+        rows, converter = parsing.parse_resource({}, stream, 'text/csv',
+                                                 resource, logger)
+        assert_equal(converter.headers, expected.headers)
+        assert_equal(converter.types, expected.types)
+        assert_equal(list(rows), list(expected_rows))
+
+
+class TestTransientErrors(object):
+
+    def test_link_checker(self):
+        data = json.dumps({'url': u'http://example.com/simple.csv'})
+        for response, transient in [
+                (FakeResponse(status_code=503), True),
+                (requests.exceptions.ConnectionError('Refused'), True),
+                (requests.exceptions.ReadTimeout(), True),
+                (FakeResponse(status_code=404), False)]:
+            with FakeRequests(response):
+                try:
+                    fetch_resource.link_checker('{}', data)
+                except fetch_resource.LinkHeadRequestError, e:
+                    assert_equal(retries.is_transient(e), transient)
+                else:
+                    assert False, 'LinkHeadRequestError not raised'
+
+    def test_download(self):
+        resource = {'id': u'resource', 'format': 'csv',
+                    'url': u'http://example.com/simple.csv'}
+        with FakeRequests(FakeResponse(status_code=502)):
+            assert_raises(fetch_resource.TransientDownloadError,
+                          fetch_resource.download, {}, resource, 1000,
+                          ['csv'], head_request=False)
+
+    def test_is_transient_message(self):
+        # the messages of the errors raised by the archiver
+        assert fetch_resource.is_transient_message(
+            'Connection timed out after 30s')
+        assert fetch_resource.is_transient_message(
+            'Server returned error: Service unavailable')
+        assert fetch_resource.is_transient_message(
+            'URL unobtainable: Server returned HTTP 429')
+        assert not fetch_resource.is_transient_message(
+            'URL unobtainable: Server returned HTTP 404')
+        assert not fetch_resource.is_transient_message('Too many redirects')
+
+
+class DownloadTestCase(object):
+    '''Downloads a resource from fake responses.'''
+
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.content = static('simple.csv')
+        # matches the headers of the responses, so that it isn't updated
+        self.resource = {'id': u'resource', 'format': 'csv',
+                         'url': u'http://example.com/simple.csv',
+                         'mimetype': 'text/csv',
+                         'size': unicode(len(self.content))}
+        self.saved_files = []
+
+    def teardown(self):
+        for path in self.saved_files:
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(self.cache_dir)
+
+    def response(self, status_code=200, **headers):
+        headers.setdefault('Content-Type', 'text/csv')
+        return FakeResponse(self.content if status_code == 200 else '',
+                            status_code, headers)
+
+    def download(self, **kwargs):
+        result = fetch_resource.download({}, self.resource, 1000000, ['csv'],
+                                         **kwargs)
+        self.saved_files.append(result['saved_file'])
+        return result
+
+
+class TestDownload(DownloadTestCase):
+
+    def test_conditional_get(self):
+        validators = get_cache(self.cache_dir, 'validators')
+        # the first time, the validators are unknown: HEAD and GET
+        with FakeRequests(self.response(ETag='"v1"'),
+                          self.response(ETag='"v1"')):
+            self.download(validators=validators, check_modified=True)
+
+        # not modified
+        response = self.response(304)
+        with FakeRequests(response) as fake:
+            assert_raises(fetch_resource.ResourceNotModified, self.download,
+                          validators=validators, check_modified=True)
+        assert_equal(fake.requests, [{'If-None-Match': '"v1"'}])
+        assert response.closed
+
+        # modified
+        self.content = self.content.replace('a', 'b')
+        with FakeRequests(self.response(ETag='"v2"')) as fake:
+            result = self.download(validators=validators, check_modified=True)
+        # no HEAD request was made
+        assert_equal(fake.requests, [{'If-None-Match': '"v1"'}])
+        with open(result['saved_file'], 'rb') as f:
+            assert_equal(f.read(), self.content)
+        validator = validators.get(u'resource http://example.com/simple.csv')
+        assert_equal(validator['etag'], '"v2"')
+        assert_equal(validator['hash'], hashlib.sha1(self.content).hexdigest())
+
+    def test_no_head_request(self):
+        with FakeRequests(self.response()) as fake:
+            result = self.download(head_request=False)
+        assert_equal(len(fake.requests), 1)
+        assert_equal(result['headers']['content-type'], 'text/csv')
+        with open(result['saved_file'], 'rb') as f:
+            assert_equal(f.read(), self.content)
+
+        # the headers of the GET response are checked before its content is
+        # read
+        response = self.response(**{'Content-Length': '2000000'})
+        self.resource['size'] = u'2000000'
+        with FakeRequests(response):
+            assert_raises(fetch_resource.ChooseNotToDownload, self.download,
+                          head_request=False)
+        assert response.closed
+
+    def partial_path(self, partials):
+        return partials.path(u'{0} {1}'.format(self.resource['id'],
+                                               self.resource['url']), '.part')
+
+    def interrupted_download(self, partials):
+        '''Downloads the first half of the content, then fails.'''
+        half = len(self.content) / 2
+        headers = {'ETag': '"v1"', 'Accept-Ranges': 'bytes'}
+        interrupted = FakeResponse(
+            self.content[:half], headers=dict(headers),
+            error=requests.exceptions.ChunkedEncodingError('Interrupted'))
+        with FakeRequests(self.response(**headers), interrupted):
+            assert_raises(fetch_resource.DownloadError, self.download,
+                          partials=partials)
+        with open(self.partial_path(partials), 'rb') as f:
+            assert_equal(f.read(), self.content[:half])
+        return half
+
+    def test_resume(self):
+        partials = get_cache(self.cache_dir, 'partials')
+        half = self.interrupted_download(partials)
+
+        rest = FakeResponse(self.content[half:], 206)
+        with FakeRequests(self.response(ETag='"v1"', **{
+                'Accept-Ranges': 'bytes'}), rest) as fake:
+            result = self.download(partials=partials)
+        assert_equal(fake.requests[1], {'Range': 'bytes=%s-' % half,
+                                        'If-Range': '"v1"'})
+        with open(result['saved_file'], 'rb') as f:
+            assert_equal(f.read(), self.content)
+        # the hash is that of the whole content
+        assert_equal(json.loads(self.resource['hash'])['content'],
+                     hashlib.sha1(self.content).hexdigest())
+        assert not os.path.exists(self.partial_path(partials))
+
+    def test_range_ignored(self):
+        partials = get_cache(self.cache_dir, 'partials')
+        self.interrupted_download(partials)
+
+        # the server sends the whole content again
+        with FakeRequests(self.response(ETag='"v1"', **{
+                'Accept-Ranges': 'bytes'}), self.response()):
+            result = self.download(partials=partials)
+        with open(result['saved_file'], 'rb') as f:
+            assert_equal(f.read(), self.content)
+        assert_equal(json.loads(self.resource['hash'])['content'],
+                     hashlib.sha1(self.content).hexdigest())
+
+    def test_no_range_support(self):
+        partials = get_cache(self.cache_dir, 'partials')
+        self.interrupted_download(partials)
+
+        # the server doesn't advertise range requests anymore
+        with FakeRequests(self.response(ETag='"v1"'),
+                          self.response()) as fake:
+            result = self.download(partials=partials)
+        assert 'Range' not in fake.requests[1]
+        with open(result['saved_file'], 'rb') as f:
+            assert_equal(f.read(), self.content)
+        assert_equal(json.loads(self.resource['hash'])['content'],
+                     hashlib.sha1(self.content).hexdigest())
+
+    def test_same_url(self):
+        partials = get_cache(self.cache_dir, 'partials')
+        self.interrupted_download(partials)
+
+        # another resource with the same URL doesn't resume the download
+        first = self.resource
+        self.resource = dict(first, id=u'other')
+        with FakeRequests(self.response(ETag='"v1"', **{
+                'Accept-Ranges': 'bytes'}), self.response()) as fake:
+            result = self.download(partials=partials)
+        assert 'Range' not in fake.requests[1]
+        with open(result['saved_file'], 'rb') as f:
+            assert_equal(f.read(), self.content)
+        assert not os.path.exists(self.partial_path(partials))
+        self.resource = first
+        assert os.path.exists(self.partial_path(partials))
+
+
+class TestSaveResource(DownloadTestCase):
+    '''The files of failed downloads are deleted, unless they can be
+    resumed.'''
+
+    def setup(self):
+        super(TestSaveResource, self).setup()
+        self.tempdir = tempfile.tempdir
+        tempfile.tempdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(tempfile.tempdir)
+        tempfile.tempdir = self.tempdir
+        super(TestSaveResource, self).teardown()
+
+    def assert_no_files(self):
+        assert_equal(os.listdir(tempfile.tempdir), [])
+
+    def test_interrupted(self):
+        response = FakeResponse(
+            'a,b\n', error=requests.exceptions.ChunkedEncodingError())
+        assert_raises(requests.exceptions.ChunkedEncodingError,
+                      fetch_resource._save_resource, self.resource, response,
+                      1000)
+        assert response.closed
+        self.assert_no_files()
+
+        # a partial download is kept
+        path = os.path.join(self.cache_dir, 'download.part')
+        response = FakeResponse(
+            'a,b\n', error=requests.exceptions.ChunkedEncodingError())
+        assert_raises(requests.exceptions.ChunkedEncodingError,
+                      fetch_resource._save_resource, self.resource, response,
+                      1000, path=path)
+        with open(path, 'rb') as f:
+            assert_equal(f.read(), 'a,b\n')
+
+    def test_too_large(self):
+        self.resource['size'] = unicode(len(self.content))
+        with FakeRequests(self.response()):
+            assert_raises(fetch_resource.ChooseNotToDownload,
+                          fetch_resource.download, {}, self.resource,
+                          len(self.content) - 1, ['csv'], head_request=False)
+        self.assert_no_files()
+
+    def test_zero_length(self):
+        self.content = ''
+        self.resource['size'] = u'0'
+        with FakeRequests(self.response()):
+            assert_raises(fetch_resource.DownloadError,
+                          fetch_resource.download, {}, self.resource, 1000,
+                          ['csv'], head_request=False)
+        self.assert_no_files()
@@ -0,0 +1,69 @@
+import os
+import random
+
+from messytables import (CSVTableSet, headers_guess, headers_processor,
+                         offset_processor, type_guess, Cell)
+from messytables.types import StringType, IntegerType, DecimalType
+from nose.tools import assert_equal
+
+from ckanext.datastorer import inference
+from ckanext.datastorer.common import TYPES
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+
+def row_set(name):
+    row_set = CSVTableSet(open(os.path.join(STATIC, name), 'rb')).tables[0]
+    offset, headers = headers_guess(row_set.sample)
+    row_set.register_processor(headers_processor(headers))
+    row_set.register_processor(offset_processor(offset + 1))
+    return row_set
+
+
+def cells(*rows):
+    return [[Cell(value) for value in row] for row in rows]
+
+
+class TestGuessTypes(object):
+
+    def test_same_as_messytables(self):
+        for name in ('simple.csv', 'october_2011.csv', 'long.csv',
+                     '3ffdcd42-5c63-4089-84dd-c23876259973.csv'):
+            sample = list(row_set(name).sample)
+            guesses = inference.guess_types(sample, TYPES)
+            assert_equal([t for t, confidence in guesses],
+                         type_guess(sample, TYPES, strict=True))
+
+    def test_narrowest_type(self):
+        guesses = inference.guess_types(
+            cells(['1', '1.5', 'foo bar', '', '2012-01-01']), TYPES)
+        assert_equal([t for t, confidence in guesses],
+                     [IntegerType(), DecimalType(), StringType(),
+                      StringType(), TYPES[4]()])
+
+    def test_confidence(self):
+        rows = cells(*[[unicode(i)] for i in range(9)] + [['x']])
+        assert_equal(inference.guess_types(rows, TYPES),
+                     [(StringType(), 1.0)])
+        assert_equal(inference.guess_types(rows, TYPES, 0.9),
+                     [(IntegerType(), 0.9)])
+
+
+class TestSampleRows(object):
+
+    def test_small_table(self):
+        assert_equal(inference.sample_rows(range(8), 3, 3, 3),
+                     range(8))
+
+    def test_sample(self):
+        sample = inference.sample_rows(range(1000), 10, 20, 10,
+                                       random.Random(1))
+        assert_equal(len(sample), 40)
+        assert_equal(sample[:10], range(10))
+        assert_equal(sample[-10:], range(990, 1000))
+        assert all(10 <= i < 990 for i in sample[10:30])
+        assert_equal(len(set(sample)), 40)
+
+    def test_no_tail(self):
+        sample = inference.sample_rows(range(100), 10, 5, 0)
+        assert_equal(len(sample), 15)
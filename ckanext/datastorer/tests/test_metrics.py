@@ -0,0 +1,63 @@
+import json
+import logging
+
+from nose.tools import assert_equal
+
+from ckanext.datastorer import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TestMetrics(object):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        assert_equal(metrics.percentile(values, 50), 50)
+        assert_equal(metrics.percentile(values, 99), 99)
+        assert_equal(metrics.percentile([3], 90), 3)
+        assert_equal(metrics.percentile([], 50), None)
+
+    def test_summary(self):
+        upload = metrics.UploadMetrics(u'resource')
+        with upload.stage('download'):
+            upload.count('bytes_downloaded', 1000)
+        rows = list(upload.timed(iter(range(5))))
+        assert_equal(rows, range(5))
+        upload.record_batch(3, 0.5)
+        upload.record_batch(2, 1.5)
+        upload.retry()
+
+        summary = upload.summary()
+        assert_equal(summary['resource_id'], u'resource')
+        assert_equal(summary['stages'].keys(), ['download', 'parse'])
+        assert_equal(summary['bytes_downloaded'], 1000)
+        assert_equal(summary['rows'], 5)
+        assert_equal(summary['batches'], 2)
+        assert_equal(summary['retries'], 1)
+        assert_equal(summary['batch_seconds']['p50'], 0.5)
+        assert_equal(summary['batch_seconds']['max'], 1.5)
+        assert summary['rows_per_second'] > 0
+        # it can be kept in a task status
+        assert_equal(json.loads(json.dumps(summary))['rows'], 5)
+
+    def test_emit(self):
+        upload = metrics.UploadMetrics(u'resource')
+        with upload.stage('upload'):
+            upload.record_batch(10, 0.25)
+        sink = metrics.MemorySink()
+        summary = upload.emit(logger, sink)
+        timings = sink.values('timing')
+        assert_equal(timings['batch_seconds.p50'], 250)
+        assert 'stage.upload' in timings
+        assert_equal(sink.values('incr')['rows'], 10)
+        assert_equal(sink.values('gauge')['rows_per_second'],
+                     summary['rows_per_second'])
+
+    def test_get_sink(self):
+        assert_equal(metrics.get_sink({}), None)
+        sink = metrics.get_sink({'statsd_host': 'localhost:9125',
+                                 'statsd_prefix': 'ckan'})
+        assert_equal(sink.address, ('localhost', 9125))
+        assert_equal(sink.prefix, 'ckan.')
+        # nothing needs to be listening
+        sink.incr('rows', 10)
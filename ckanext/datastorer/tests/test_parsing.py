@@ -0,0 +1,105 @@
+import logging
+import os
+import shutil
+import tempfile
+
+from messytables.types import DecimalType, IntegerType, StringType
+from nose.tools import assert_equal
+
+from ckanext.datastorer import parsing
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+RESOURCE = {'id': u'resource-id', 'format': 'csv'}
+logger = logging.getLogger(__name__)
+
+
+def parse(settings, content_hash=None):
+    f = open(os.path.join(STATIC, 'october_2011.csv'), 'rb')
+    rows, converter = parsing.parse_resource(settings, f, 'text/csv',
+                                             RESOURCE, logger,
+                                             content_hash=content_hash)
+    return list(rows), converter
+
+
+def parse_content(settings, content):
+    f = tempfile.TemporaryFile()
+    f.write(content)
+    f.seek(0)
+    rows, converter = parsing.parse_resource(settings, f, 'text/csv',
+                                             RESOURCE, logger)
+    return list(rows), converter
+
+
+class TestContentCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = {'cache_dir': self.directory,
+                         'content_cache': 'true',
+                         'content_cache_rows': 'true'}
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_as_parsing(self):
+        expected_rows, expected = parse({})
+        for i in range(3):
+            rows, converter = parse(self.settings, u'hash')
+            assert_equal(rows, expected_rows)
+            assert_equal(converter.headers, expected.headers)
+            assert_equal(converter.types, expected.types)
+        assert_equal(len(os.listdir(self.directory + '/content')), 2)
+
+    def test_settings_change(self):
+        parse(self.settings, u'hash')
+        self.settings['type_min_confidence'] = 0.9
+        rows, converter = parse(self.settings, u'hash')
+        assert converter.lenient
+
+    def test_bounded(self):
+        directory = self.directory + '/content'
+        parse(self.settings, u'hash')
+        size = sum(os.path.getsize(os.path.join(directory, name))
+                   for name in os.listdir(directory))
+        # room for the content parsed last only
+        self.settings['content_cache_max_size'] = size + 10
+        parse(self.settings, u'other hash')
+        names = os.listdir(directory)
+        assert_equal(len(names), 2)
+        assert_equal(len(set(name.split('.')[0] for name in names)), 1)
+        # re-used from the cache
+        parse(self.settings, u'other hash')
+        assert_equal(sorted(os.listdir(directory)), sorted(names))
+
+
+class TestSchemaCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = {'cache_dir': self.directory,
+                         'schema_cache': 'true'}
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_as_parsing(self):
+        expected_rows, expected = parse({})
+        for i in range(2):
+            rows, converter = parse(self.settings)
+            assert_equal(rows, expected_rows)
+            assert_equal(converter.headers, expected.headers)
+            assert_equal(converter.types, expected.types)
+        assert_equal(os.listdir(self.directory + '/schemas'),
+                     ['resource-id.json'])
+
+    def test_types_kept(self):
+        parse_content(self.settings, 'a,b\n1,2.5\n3,4\n')
+        rows, converter = parse_content(self.settings, 'a,b\n1.5,2\n3,4\n')
+        assert_equal(converter.types, [DecimalType(), DecimalType()])
+        assert_equal(rows, [[u'1.5', u'2'], [u'3', u'4']])
+
+    def test_headers_changed(self):
+        parse_content(self.settings, 'a,b\n1,2.5\n')
+        rows, converter = parse_content(self.settings, 'a,c\n1,x\n')
+        assert_equal(converter.headers, [u'a', u'c'])
+        assert_equal(converter.types, [IntegerType(), StringType()])
@@ -0,0 +1,50 @@
+import time
+
+from nose.tools import assert_raises, assert_equal
+
+from ckanext.datastorer.pipeline import upload_batches
+
+
+class TestUploadBatches(object):
+
+    def test_sends_every_batch(self):
+        sent = []
+
+        def send(batch):
+            time.sleep(0.001)
+            sent.append(batch)
+
+        count = upload_batches(iter(range(50)), send, concurrency=4,
+                               max_pending=2)
+        assert_equal(count, 50)
+        assert_equal(sorted(sent), range(50))
+
+    def test_sequential(self):
+        sent = []
+        count = upload_batches(iter(range(10)), sent.append, concurrency=1)
+        assert_equal(count, 10)
+        assert_equal(sent, range(10))
+
+    def test_failed_batch_aborts_upload(self):
+        produced = []
+
+        def batches():
+            for i in range(1000):
+                produced.append(i)
+                yield i
+
+        def send(batch):
+            if batch == 5:
+                raise ValueError(batch)
+
+        assert_raises(ValueError, upload_batches, batches(), send,
+                      concurrency=4, max_pending=2)
+        assert len(produced) < 1000, len(produced)
+
+    def test_producer_error_is_raised(self):
+        def batches():
+            yield 1
+            raise KeyError('parse error')
+
+        assert_raises(KeyError, upload_batches, batches(), lambda b: None,
+                      concurrency=3)
@@ -0,0 +1,89 @@
+import random
+import socket
+
+import requests
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.datastorer import retries
+
+
+def response(status_code):
+    r = requests.models.Response()
+    r.status_code = status_code
+    return r
+
+
+class TestRetries(object):
+
+    def test_is_transient(self):
+        assert retries.is_transient(retries.TransientError())
+        assert retries.is_transient(requests.exceptions.ConnectionError())
+        assert retries.is_transient(requests.exceptions.ReadTimeout())
+        assert retries.is_transient(socket.error())
+        assert retries.is_transient(requests.exceptions.HTTPError(
+            response=response(503)))
+        assert not retries.is_transient(requests.exceptions.HTTPError(
+            response=response(404)))
+        assert not retries.is_transient(ValueError('Not a number'))
+        assert retries.is_transient_status(None)
+        assert retries.is_transient_status(429)
+        assert not retries.is_transient_status(409)
+
+    def test_is_unprocessed(self):
+        assert retries.is_unprocessed(retries.UnprocessedError())
+        refused = requests.packages.urllib3.exceptions.NewConnectionError(
+            None, 'Connection refused')
+        assert retries.is_unprocessed(requests.exceptions.ConnectionError(
+            requests.packages.urllib3.exceptions.MaxRetryError(
+                None, '/', refused)))
+        # the request may have been processed before these
+        assert not retries.is_unprocessed(retries.TransientError())
+        assert not retries.is_unprocessed(
+            requests.exceptions.ConnectionError('Connection reset'))
+        assert not retries.is_unprocessed(requests.exceptions.ReadTimeout())
+        assert not retries.is_unprocessed(socket.error())
+
+    def test_backoff_delay(self):
+        rand = random.Random(0)
+        for attempt, limit in enumerate([1, 2, 4, 8, 10, 10]):
+            delay = retries.backoff_delay(attempt, 1, 10, rand)
+            assert 0 <= delay <= limit
+
+    def test_call_with_retries(self):
+        calls = []
+        delays = []
+
+        def func():
+            calls.append(1)
+            if len(calls) < 3:
+                raise requests.exceptions.ConnectionError()
+            return 'done'
+
+        assert_equal(retries.call_with_retries(func, 3, 1, 10,
+                                               sleep=delays.append), 'done')
+        assert_equal(len(calls), 3)
+        assert_equal(len(delays), 2)
+
+        # the last transient error is raised
+        calls[:] = []
+        assert_raises(requests.exceptions.ConnectionError,
+                      retries.call_with_retries, func, 1, 1, 10,
+                      sleep=delays.append)
+        assert_equal(len(calls), 2)
+
+        # permanent errors are never retried
+        def fail():
+            calls.append(1)
+            raise ValueError('Not a number')
+
+        calls[:] = []
+        assert_raises(ValueError, retries.call_with_retries, fail, 3, 1, 10,
+                      sleep=delays.append)
+        assert_equal(len(calls), 1)
+
+        # only the errors for which retry_if is true are retried
+        calls[:] = []
+        assert_raises(requests.exceptions.ConnectionError,
+                      retries.call_with_retries, func, 3, 1, 10,
+                      sleep=delays.append, retry_if=retries.is_unprocessed)
+        assert_equal(len(calls), 1)
@@ -0,0 +1,64 @@
+from nose.tools import assert_equal
+
+from ckanext.datastorer import scheduling
+
+
+class TestScheduling(object):
+
+    def test_task_status(self):
+        status = scheduling.task_status(u'resource', u'task')
+        assert_equal(status['entity_id'], u'resource')
+        assert_equal(status['key'], scheduling.TASK_KEY)
+        assert_equal(status['value'], u'task')
+        assert_equal(status['state'], u'pending')
+
+    def test_is_superseded(self):
+        latest = scheduling.task_status(u'resource', u'task')
+        assert not scheduling.is_superseded(latest, u'task')
+        assert scheduling.is_superseded(latest, u'earlier task')
+        # the task status is missing or couldn't be read
+        assert not scheduling.is_superseded(None, u'task')
+
+    def test_queued_while_running(self):
+        statuses = {}
+
+        def save_task_status(status):
+            statuses[status['key']] = status
+
+        send_upload = scheduling.send_upload
+        scheduling.send_upload = lambda context, resource, task_id: None
+        try:
+            first = scheduling.queue_upload({}, {'id': u'resource'},
+                                            save_task_status)
+            assert not scheduling.is_superseded(
+                statuses[scheduling.TASK_KEY], first)
+            save_task_status(scheduling.state_status(u'resource', first,
+                                                     u'running'))
+            second = scheduling.queue_upload({}, {'id': u'resource'},
+                                             save_task_status)
+        finally:
+            scheduling.send_upload = send_upload
+
+        # the first task completes, the second one still loads the resource
+        save_task_status(scheduling.state_status(u'resource', first,
+                                                 u'complete'))
+        assert not scheduling.is_superseded(statuses[scheduling.TASK_KEY],
+                                            second)
+        assert_equal(statuses[scheduling.STATE_KEY]['value'], first)
+        assert_equal(statuses[scheduling.STATE_KEY]['state'], u'complete')
+
+        # a failure is recorded with its error
+        status = scheduling.state_status(u'resource', second, u'error',
+                                         u'ValueError: Not a number')
+        assert_equal(status['error'], u'ValueError: Not a number')
+
+    def test_route(self):
+        context = {'queue': 'small', 'large_queue': 'large',
+                   'large_resource_size': '1000', 'bulk_queue': 'bulk'}
+        assert_equal(scheduling.route(context, {'size': u'999'}), 'small')
+        assert_equal(scheduling.route(context, {'size': u'1000'}), 'large')
+        # the size is unknown
+        assert_equal(scheduling.route(context, {'size': None}), 'small')
+        assert_equal(scheduling.route(dict(context, origin=scheduling.BULK),
+                                      {'size': u'999'}), 'bulk')
+        assert_equal(scheduling.route({}, {'size': u'1000000000'}), None)
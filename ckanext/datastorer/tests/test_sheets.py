@@ -0,0 +1,35 @@
+import os
+
+from messytables import any_tableset
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.datastorer import sheets
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+
+class TestSheets(object):
+
+    def test_select_sheets(self):
+        names = [u'a', u'b', u'c']
+        assert_equal(sheets.select_sheets(names, 'all'), names)
+        assert_equal(sheets.select_sheets(names, 'first'), [u'a'])
+        assert_equal(sheets.select_sheets(names, 'c, a, x'), [u'a', u'c'])
+
+    def test_find_table(self):
+        table_set = any_tableset(open(os.path.join(STATIC, 'simple.xls'),
+                                      'rb'), extension='xls')
+        name = table_set.tables[0].name
+        assert_equal(sheets.find_table(table_set).name, name)
+        assert_equal(sheets.find_table(table_set, name).name, name)
+        assert_raises(ValueError, sheets.find_table, table_set, u'missing')
+
+    def test_sheet_resources(self):
+        resource = {'id': 'workbook', 'package_id': 'dataset',
+                    'url': 'http://example.com/a.xls', 'format': 'XLS'}
+        sheet = sheets.new_sheet_resource(resource, u'Totals')
+        assert sheets.is_derived(sheet)
+        assert not sheets.is_derived(resource)
+        package = {'resources': [resource, dict(sheet, id='sheet')]}
+        assert_equal(sheets.sheet_resources(package, resource).keys(),
+                     [u'Totals'])